@@ -0,0 +1,67 @@
+"""
+Measures log calls per second through the CDLS logging facade.
+
+Compares the old inspect.stack() context lookup against the frame-walking
+lookup, and against context lookup switched off entirely; then synchronous
+writes against the background sink.  Output goes to a throwaway log file and
+/dev/null so only the facade itself is measured.
+
+Usage:
+
+    python benchmarks/bench_logging.py [calls]
+
+"""
+
+import contextlib
+import inspect
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cdls.config
+import cdls.logging
+
+
+def legacy_invoking_method_name(depth):
+	return inspect.stack()[depth][3]
+
+
+def run(calls):
+	start = time.perf_counter()
+	for i in range(calls):
+		cdls.logging.info("Found fake record #{0:03d}", i, tag="bench", degree=0)
+	cdls.logging.flush()
+	return calls / (time.perf_counter() - start)
+
+
+def main():
+	calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	current = cdls.logging._get_invoking_method_name
+
+	with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+		cdls.logging._OUTFILE = os.path.join(tmp, "bench.log")
+
+		results = []
+		with contextlib.redirect_stdout(devnull):
+			cdls.config.LOGGING_ASYNC = False
+			cdls.logging._get_invoking_method_name = legacy_invoking_method_name
+			results.append(("inspect.stack()", run(calls)))
+
+			cdls.logging._get_invoking_method_name = current
+			results.append(("frame walk", run(calls)))
+
+			cdls.config.LOGGING_CONTEXT = False
+			results.append(("context off", run(calls)))
+
+			cdls.config.LOGGING_ASYNC = True
+			results.append(("async sink", run(calls)))
+
+	for name, rate in results:
+		print("{0:>16} : {1:>10,.0f} calls/s ({2:0.1f}x)".format(name, rate, rate / results[0][1]))
+
+
+if "__main__" == __name__:
+	main()
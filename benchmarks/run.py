@@ -0,0 +1,320 @@
+"""
+End-to-end and micro benchmarks for the CDLS.
+
+End-to-end benchmarks load each source registered in benchmarks/sources.json
+(through the normal cdls.initialize() path) into a scratch database.  Every
+source runs in a fresh child process so peak memory is measured per source.
+Micro benchmarks time the hot functions on their own.
+
+Results are written as JSON; given a baseline, any metric that got worse by
+more than the threshold is flagged and the exit status is 1.
+
+Usage:
+
+    python benchmarks/run.py [-o results.json] [-c baseline.json] [-t 0.10]
+
+"""
+
+import datetime
+import glob
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources.json")
+
+sys.path.insert(0, ROOT)
+
+import cdls
+import cdls.backends
+import cdls.backends.memory
+import cdls.backends.segment
+import cdls.columnar
+import cdls.config
+import cdls.datasources
+import cdls.db
+import cdls.logging
+
+# Metrics where a smaller number is better; everything else is a throughput
+LOWER_IS_BETTER = ("peak_rss_kb", "db_bytes_per_record", "seconds")
+
+
+def main():
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("-o", "--output", metavar="FILE", help="Writes the results to FILE")
+	parser.add_option("-c", "--compare", metavar="FILE", help="Compares the results against a baseline FILE")
+	parser.add_option("-t", "--threshold", type="float", default=0.10, help="Relative change that counts as a regression [default: %default]")
+	parser.add_option("-s", "--sources", metavar="FILE", default=SOURCES, help="Source configuration to load [default: %default]")
+	parser.add_option("--only", metavar="NAME", action="append", help="Only runs benchmarks whose name contains NAME")
+	parser.add_option("--child", metavar="ID", help=optparse.SUPPRESS_HELP)
+	(options, args) = parser.parse_args()
+
+	if options.child:
+		print(json.dumps(run_end_to_end(options.child, options.sources)))
+		return
+
+	results = {
+		"meta": {
+			"timestamp": datetime.datetime.now().isoformat(),
+			"python":    platform.python_version(),
+			"platform":  platform.platform()
+		},
+		"benchmarks": {}
+	}
+
+	benchmarks = [("e2e." + identifier, _spawn_end_to_end, (identifier, options.sources))
+	              for identifier in _source_identifiers(options.sources)]
+	benchmarks += [("micro." + name, func, ()) for name, func in MICRO_BENCHMARKS]
+
+	for name, func, args in benchmarks:
+		if options.only and not any(pattern in name for pattern in options.only):
+			continue
+		results["benchmarks"][name] = func(*args)
+		print("{0:<32} {1}".format(name, _format_metrics(results["benchmarks"][name])))
+
+	if options.output:
+		with open(options.output, "w") as fp:
+			json.dump(results, fp, indent=4, sort_keys=True)
+
+	if options.compare:
+		with open(options.compare) as fp:
+			baseline = json.load(fp)
+
+		regressions = compare(baseline, results, options.threshold)
+		for name, metric, before, after, change in regressions:
+			print("REGRESSION {0} {1}: {2:.4g} -> {3:.4g} ({4:+.1%})".format(name, metric, before, after, change))
+
+		if regressions:
+			exit(1)
+		print("No regressions beyond {:.0%}".format(options.threshold))
+
+
+def compare(baseline, results, threshold):
+	"""Finds metrics that got worse by more than `threshold`.
+
+	Args:
+	  baseline (dict): Earlier results
+	  results (dict): Current results
+	  threshold (float): Relative change that counts as a regression
+
+	Returns:
+	  list of tuple: (benchmark, metric, before, after, relative change)
+
+	"""
+	regressions = []
+	for name, metrics in sorted(results["benchmarks"].items()):
+		for metric, after in sorted(metrics.items()):
+			before = baseline.get("benchmarks", {}).get(name, {}).get(metric)
+			if not before:
+				continue
+
+			change = (after - before) / before
+			worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+			if worse:
+				regressions.append((name, metric, before, after, change))
+
+	return regressions
+
+
+def run_end_to_end(identifier, sources):
+	"""Loads a single source into a scratch database.
+
+	Meant to run in its own process (see `_spawn_end_to_end`).
+
+	Returns:
+	  dict: records_per_second, seconds, peak_rss_kb, db_bytes_per_record
+
+	"""
+	with tempfile.TemporaryDirectory() as tmp:
+		_use_scratch(tmp, sources)
+		cdls.initialize()
+		cdls.db.install()
+
+		db_bytes = os.path.getsize(cdls.db._DBPATH)
+		started = time.perf_counter()
+		report = cdls.perform_load(identifier)
+		seconds = time.perf_counter() - started
+		cdls.db.close()
+		growth = sum(os.path.getsize(path) for path in glob.glob(os.path.join(tmp, "*.db"))) - db_bytes
+
+		cdls.logging.flush()
+
+	return {
+		"records_per_second":  report.number_processed / seconds,
+		"seconds":             seconds,
+		"peak_rss_kb":         cdls.datasources._get_peak_rss(),
+		"db_bytes_per_record": growth / max(report.number_processed, 1)
+	}
+
+
+def bench_log_entry():
+	with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+		cdls.logging._OUTFILE = os.path.join(tmp, "bench.log")
+		stdout, sys.stdout = sys.stdout, devnull
+		try:
+			result = _time(lambda: cdls.logging._log_entry("info", "Found record #{0}", 1, tag="bench"), 20000)
+			cdls.logging.flush()
+		finally:
+			sys.stdout = stdout
+	return {"ops_per_second": result}
+
+
+def bench_string_to_date():
+	return {"ops_per_second": _time(lambda: cdls.datasources._string_to_date("1999-07-04T11:00:00"), 20000)}
+
+
+def bench_warehouse():
+	record = {"id": 1, "title": "lorem ipsum", "payload": "x" * 256}
+	now = datetime.datetime.now()
+	with tempfile.TemporaryDirectory() as tmp:
+		_use_scratch(tmp, SOURCES)
+		cdls.db.install()
+		result = _time(lambda: cdls.db.warehouse(record, "bench", now), 2000)
+		cdls.db.close()
+	return {"ops_per_second": result}
+
+
+def bench_warehouse_many():
+	batch = [({"id": n, "title": "lorem ipsum", "payload": "x" * 256}, datetime.datetime.now()) for n in range(500)]
+	with tempfile.TemporaryDirectory() as tmp:
+		_use_scratch(tmp, SOURCES)
+		cdls.db.install()
+		result = _time(lambda: cdls.db.warehouse_many(batch, "bench"), 20) * len(batch)
+		cdls.db.close()
+	return {"records_per_second": result}
+
+
+def bench_memory_warehouse_many():
+	batch = [({"id": n, "title": "lorem ipsum", "payload": "x" * 256}, datetime.datetime.now()) for n in range(500)]
+	backend = cdls.backends.memory.MemoryBackend()
+	return {"records_per_second": _time(lambda: backend.warehouse_many(batch, "bench", workers=0), 20) * len(batch)}
+
+
+def bench_segment_warehouse_many():
+	batch = [({"id": n, "title": "lorem ipsum", "payload": "x" * 256}, datetime.datetime.now()) for n in range(500)]
+	with tempfile.TemporaryDirectory() as tmp:
+		backend = cdls.backends.segment.SegmentBackend(tmp, cdls.config.DB_SEGMENT_MAX_BYTES)
+		backend.install()
+		result = _time(lambda: backend.warehouse_many(batch, "bench", workers=0), 20) * len(batch)
+		backend.close()
+	return {"records_per_second": result}
+
+
+def bench_get_many():
+	with tempfile.TemporaryDirectory() as tmp:
+		_seed_scan(tmp, 5000)
+		guids = [row[0] for row in cdls.db._connect().execute("SELECT guid FROM warehouse ORDER BY seq DESC LIMIT 100")]
+
+		def cold():
+			cdls.db._cache.clear()
+			cdls.db.get_many(guids)
+
+		result = {
+			"cold_lookups_per_second": _time(cold, 20) * len(guids),
+			"warm_lookups_per_second": _time(lambda: cdls.db.get_many(guids), 20) * len(guids)
+		}
+		cdls.db.close()
+	return result
+
+
+def bench_json_scan():
+	with tempfile.TemporaryDirectory() as tmp:
+		_seed_scan(tmp)
+		documents = [change.json for export_range in cdls.db.export_ranges("bench") for batch in cdls.db.read_range(export_range) for change in batch]
+		cdls.db.close()
+
+	def scan():
+		total = 0.0
+		for document in documents:
+			contents = json.loads(document)["$contents"]
+			if contents["status"] == "open":
+				total += contents["total"]
+		return total
+
+	return {"rows_per_second": _time(scan, 1) * len(documents)}
+
+
+def bench_columnar_scan():
+	with tempfile.TemporaryDirectory() as tmp:
+		_seed_scan(tmp)
+		rows = cdls.columnar.write_snapshot("bench", os.path.join(tmp, "snapshot"), {"status": "text", "total": "real"})
+		cdls.db.close()
+
+		with cdls.columnar.Snapshot(os.path.join(tmp, "snapshot")) as snapshot:
+			def scan():
+				code = snapshot.dictionary("status").index("open")
+				return sum(total for total, status in zip(snapshot.column("total"), snapshot.column("status")) if status == code)
+
+			result = _time(scan, 1) * rows
+	return {"rows_per_second": result}
+
+
+MICRO_BENCHMARKS = (
+	("log_entry", bench_log_entry),
+	("string_to_date", bench_string_to_date),
+	("warehouse", bench_warehouse),
+	("warehouse_many", bench_warehouse_many),
+	("memory.warehouse_many", bench_memory_warehouse_many),
+	("segment.warehouse_many", bench_segment_warehouse_many),
+	("get_many", bench_get_many),
+	("json_scan", bench_json_scan),
+	("columnar_scan", bench_columnar_scan),
+)
+
+
+def _format_metrics(metrics):
+	return ", ".join("{}={:,.1f}".format(k, v) for k, v in sorted(metrics.items()))
+
+
+def _seed_scan(tmp, count=20000):
+	"""Fills a scratch database with records for the scan benchmarks. """
+	_use_scratch(tmp, SOURCES)
+	cdls.db.install()
+	statuses = ("open", "shipped", "cancelled")
+	batch = [({"id": n, "status": statuses[n % 3], "total": n * 0.25, "title": "lorem ipsum", "payload": "x" * 256},
+	          datetime.datetime(2015, 1 + n % 12, 1)) for n in range(count)]
+	for n in range(0, count, 500):
+		cdls.db.warehouse_many(batch[n:n + 500], "bench", workers=0)
+
+
+def _source_identifiers(sources):
+	with open(sources) as fp:
+		return [node["id"] for node in json.load(fp)["registered"]]
+
+
+def _spawn_end_to_end(identifier, sources):
+	"""Runs `run_end_to_end` in a fresh interpreter. """
+	output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", identifier, "--sources", sources],
+	                                 cwd=ROOT)
+	return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def _time(func, number, repeat=5):
+	"""Returns the best calls per second for `func` over `repeat` runs. """
+	best = None
+	for n in range(repeat):
+		started = time.perf_counter()
+		for i in range(number):
+			func()
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+	return number / best
+
+
+def _use_scratch(tmp, sources):
+	"""Points the CDLS at a scratch database, log file and source config. """
+	cdls.db.close()
+	cdls.db._DBPATH = os.path.join(tmp, "bench.db")
+	cdls.logging._OUTFILE = os.path.join(tmp, "bench.log")
+	cdls.config.PATH_SOURCECONFIG = sources
+	cdls.config.LOGGING_LEVEL = "warn"
+
+
+if "__main__" == __name__:
+	main()
@@ -4,28 +4,40 @@ Cloudy Data Load Subsystem
 Attributes:
   _datasources (dict): Once a datasource is registered, it will be stored in
     this hash.
-  _db (mixed): Any object or module that implements the database interface.
+  _db (mixed): Any object or module that implements the storage backend
+    interface (see `cdls.backends.BaseBackend`).
   _logger (mixed): Any object or module that implements the standard logging
     interface (i.e., info, warning, error, exception).
 
 """
 
+import concurrent.futures
 import datetime
+import functools
 import importlib
 import json
 import os
+import threading
 
+from . import backends
 from . import db
 from . import config
 from . import logging
 from . import errors
 from . import datasources
+from . import exporting
+from . import metrics
+from . import tracing
 from cdls.errors import (DatabaseError, SourceConfigurationError, UnregisteredSourceError, CDLSError)
 
 _datasources = {}
 _db = None
 _logger = None
 
+_METRIC_LOADS = metrics.counter("cdls_loads_total", "Load operations by outcome", ("source", "result"))
+_METRIC_LOAD_SECONDS = metrics.gauge("cdls_load_duration_seconds", "Duration of the most recent load", ("source",))
+_METRIC_LOAD_RECORDS = metrics.gauge("cdls_load_records", "Records processed by the most recent load", ("source",))
+
 def initialize():
 	"""Intended to fully initialize the CDLS so that it can begin accepting
 	load requests.
@@ -33,21 +45,69 @@ def initialize():
 	Raises:
 	  DatabaseError
 	  SourceConfigurationError
+	  ConfigurationError
 	  CDLSError
 
 	"""
 
-	# Initialize logging to the logging module
-	register_logger(logging)
+	with tracing.span("initialize"):
+
+		# Initialize logging to the logging module
+		logging.check_config()
+		register_logger(logging)
+
+		# Start publishing metrics, if anything is collecting them
+		if config.METRICS_TEXTFILE_PATH:
+			metrics.start_exporter(config.METRICS_TEXTFILE_PATH, config.METRICS_INTERVAL)
+
+		# Attempt to connect to database
+		register_database(backends.create(config.DB_BACKEND))
+
+		# Read the source configuration from disk
+		with tracing.span("parse_config", path=config.PATH_SOURCECONFIG):
+			source_configurations = _get_source_configurations(config.PATH_SOURCECONFIG)
+
+		# Register datasources into the CDLS
+		_register_all_datasources(source_configurations)
 
-	# Attempt to connect to database
-	register_database(db)
 
-	# Read the source configuration from disk
-	source_configurations = _get_source_configurations(config.PATH_SOURCECONFIG)
+def install():
+	"""Installs (or wipes) the registered database's storage.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	_logger.info("Installing the {} database", config.DB_BACKEND)
+	_db.install()
 
-	# Register datasources into the CDLS
-	_register_all_datasources(source_configurations)
+
+def export_source(identifier, path, format="jsonl", since=None, until=None, compress=False, part_rows=None, workers=1, fields=None):
+	"""Exports a source's warehouse rows to JSONL, CSV or a columnar snapshot
+	(see `cdls.exporting.export`).
+
+	Returns:
+	  ExportResult
+
+	Raises:
+	  CDLSError
+	  DatabaseError
+
+	"""
+	if _db is not db:
+		raise CDLSError("Exports are only supported by the sqlite backend")
+
+	identifier = identifier.strip()
+	_logger.info("Exporting '{}' to {}", identifier, path)
+	try:
+		with tracing.span("export", source=identifier):
+			result = exporting.export(identifier, path, format, since, until, compress, part_rows, workers, fields)
+	except CDLSError as e:
+		_logger.exception(e)
+		raise e
+
+	_logger.info("Exported {} rows from '{}' to {} files", result.rows, identifier, len(result.files))
+	return result
 
 
 def list_registered_sources():
@@ -64,12 +124,15 @@ def list_registered_sources():
 	return [source_to_tuple(ds) for (k, ds) in sorted(_datasources.items())]
 
 
-def perform_all_loads(halt_on_error=False):
+def perform_all_loads(halt_on_error=False, profiler=None, workers=None):
 	"""Executes a load operation on every registered source in the CDLS.
 
 	Args:
 	  halt_on_error (bool): If True, will fail fast instead of attempting to
 	    perform a load on the next source.
+	  profiler (Profiler, optional): Profiles each load if given.
+	  workers (int, optional): How many sources to load at once (defaults to
+	    LOAD_WORKERS).  Worth raising when sources write to different shards.
 
 	Returns:
 	  list of LoadReport
@@ -80,29 +143,48 @@ def perform_all_loads(halt_on_error=False):
 
 	"""
 	_logger.info("Loading all sources")
+	workers = workers or config.LOAD_WORKERS
+
+	# Loads run in order as they're waited on, or all at once in a pool
+	executor = None
+	if workers > 1:
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cdls-load")
+		loads = [(datasource, executor.submit(_execute, datasource, profiler).result) for datasource in _datasources.values()]
+	else:
+		loads = [(datasource, functools.partial(_execute, datasource, profiler)) for datasource in _datasources.values()]
+
 	reports = []
-	for datasource in _datasources.values():
-		try:
-			reports.append(datasource.execute())
-		except CDLSError as e:
-			_logger.exception(e)
-			if halt_on_error:
-				raise e
+	try:
+		for datasource, load in loads:
+			try:
+				reports.append(load())
+				_record_load_metrics(reports[-1])
+			except CDLSError as e:
+				_METRIC_LOADS.labels(datasource.get_identifier(), "error").inc()
+				_logger.exception(e)
+				if halt_on_error:
+					raise e
+	finally:
+		if executor:
+			executor.shutdown(cancel_futures=True)
 
 	# List results for everything
 	_logger.info("Loads complete")
 	N = len(reports)
 	for n, report in enumerate(reports):
 		_logger.info(str(report))
+		if profiler:
+			_logger.info(profiler.summary(report.identifier))
 
 	return tuple(reports)
 
 
-def perform_load(identifier):
+def perform_load(identifier, profiler=None):
 	"""Executes a load on a single datasource.
 
 	Args:
 	  identifier (string): The identifier for the datasource to be executed.
+	  profiler (Profiler, optional): Profiles the load if given.
 
 	Returns:
 	  LoadReport
@@ -120,19 +202,48 @@ def perform_load(identifier):
 
 	try:
 		_logger.info("Attempting load for '{}'", identifier)
-		load_report = datasource.execute()
+		load_report = _execute(datasource, profiler)
+		_record_load_metrics(load_report)
 		_logger.info(str(load_report))
+		if profiler:
+			_logger.info(profiler.summary(identifier))
 		return load_report
 	except CDLSError as e:
+		_METRIC_LOADS.labels(identifier, "error").inc()
 		_logger.exception(e)
 		raise e
 
 
+def replay_rejects(identifier=None):
+	"""Re-drives records that were rejected by the warehouse.
+
+	Args:
+	  identifier (string, optional): Only replay rejects from this source.
+
+	Returns:
+	  tuple: (number replayed, number still failing)
+
+	Raises:
+	  DatabaseError
+
+	"""
+	_logger.info("Replaying rejects for '{}'", identifier or "all sources")
+	try:
+		(replayed, failed) = _db.replay_rejects(identifier)
+	except CDLSError as e:
+		_logger.exception(e)
+		raise e
+
+	_logger.info("Replayed {} rejects, {} still failing", replayed, failed)
+	return (replayed, failed)
+
+
 def register_database(db):
 	"""Registers a database connection to be used by all registered components.
 
 	Args:
-	  db (mixed): Anything that implements the database interface.
+	  db (mixed): Anything that implements the storage backend interface (see
+	    `cdls.backends.BaseBackend`).
 
 	Raises:
 	  DatabaseError
@@ -157,9 +268,10 @@ def register_datasource(datasource):
 
 	"""
 	try:
-		datasource.register_logger(_logger)
-		datasource.register_database(_db)
-		_datasources[datasource.get_identifier()] = datasource
+		with tracing.span("register_datasource", source=datasource.get_identifier()):
+			datasource.register_logger(_logger)
+			datasource.register_database(_db)
+			_datasources[datasource.get_identifier()] = datasource
 	except CDLSError as e:
 		_logger.exception(e)
 		raise e
@@ -187,6 +299,97 @@ def register_logger(logger):
 		exit(1)
 
 
+def watch_sources(identifiers=None, stop=None):
+	"""Watches sources for new data and ingests it as it arrives, until
+	`stop` is set (or the process is interrupted).
+
+	Args:
+	  identifiers (list of string, optional): The sources to watch; defaults
+	    to every registered source that can be watched.
+	  stop (Event, optional): Set to stop watching.
+
+	Returns:
+	  list of LoadReport: One per source, covering everything it ingested.
+
+	Raises:
+	  CDLSError
+	  UnregisteredSourceError
+
+	"""
+	if identifiers:
+		try:
+			datasources = [_datasources[identifier.strip()] for identifier in identifiers]
+		except KeyError as e:
+			raise UnregisteredSourceError(e.args[0])
+	else:
+		datasources = [datasource for datasource in _datasources.values() if hasattr(datasource, "watch")]
+
+	for datasource in datasources:
+		if not hasattr(datasource, "watch"):
+			raise CDLSError("'{}' can't be watched".format(datasource.get_identifier()))
+	if not datasources:
+		raise CDLSError("No registered sources can be watched")
+
+	stop = stop or threading.Event()
+	reports = {}
+
+	def watch(datasource):
+		try:
+			with tracing.span("watch", source=datasource.get_identifier()):
+				reports[datasource.get_identifier()] = datasource.watch(stop)
+		except Exception as e:
+			_logger.exception(e)
+			stop.set()
+
+	threads = [threading.Thread(target=watch, args=(datasource,), name="cdls-watch-" + datasource.get_identifier())
+	           for datasource in datasources]
+	for thread in threads:
+		thread.start()
+
+	try:
+		while any(thread.is_alive() for thread in threads):
+			for thread in threads:
+				thread.join(0.5)
+	except KeyboardInterrupt:
+		_logger.info("Stopping watchers")
+		stop.set()
+		for thread in threads:
+			thread.join()
+
+	for identifier, report in sorted(reports.items()):
+		_logger.info(str(report))
+	return [report for identifier, report in sorted(reports.items())]
+
+
+def _execute(datasource, profiler=None):
+	"""Executes a datasource, under the profiler if there is one, then applies
+	its retention policy.
+
+	Args:
+	  datasource (BaseDataSource)
+	  profiler (Profiler, optional)
+
+	Returns:
+	  LoadReport
+
+	"""
+	identifier = datasource.get_identifier()
+	with tracing.span("load", source=identifier):
+		if not profiler:
+			report = datasource.execute()
+		else:
+			with profiler.profile(identifier):
+				report = datasource.execute()
+
+	# Age out old partitions now that the new records are in
+	with tracing.span("retention", source=identifier):
+		dropped = _db.apply_retention(identifier)
+	if dropped:
+		_logger.info("Dropped {} partitions past the retention period for '{}'", len(dropped), identifier)
+
+	return report
+
+
 def _get_qualified_class_ref(config_node):
 	"""Returns a class reference for a given source configuration node.
 
@@ -246,6 +449,18 @@ def _get_source_configurations(source_config_path):
 		raise SourceConfigurationError("File '{}' does not exist".format(source_config_path))
 
 
+def _record_load_metrics(report):
+	"""Publishes the outcome of a load operation to the metrics registry.
+
+	Args:
+	  report (LoadReport)
+
+	"""
+	_METRIC_LOADS.labels(report.identifier, "success" if report.successful else "failure").inc()
+	_METRIC_LOAD_SECONDS.labels(report.identifier).set(report.time_elapsed)
+	_METRIC_LOAD_RECORDS.labels(report.identifier).set(report.number_processed)
+
+
 def _register_all_datasources(source_configurations):
 	"""Registers all datasources from the configuration collection.
 
@@ -259,7 +474,8 @@ def _register_all_datasources(source_configurations):
 
 	try:
 		for config_node in source_configurations:
-			_DataSourceClassReference = _get_qualified_class_ref(config_node)
+			with tracing.span("import_class", class_name=config_node.get("@QualifiedClassName")):
+				_DataSourceClassReference = _get_qualified_class_ref(config_node)
 
 			assert issubclass(_DataSourceClassReference, datasources.BaseDataSource)
 
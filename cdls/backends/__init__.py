@@ -0,0 +1,337 @@
+"""
+Storage backends for the CDLS.
+
+Anything registered with `cdls.register_database()` is a storage backend:
+an object (or module, like `cdls.db`) that implements the interface laid
+out by `BaseBackend`.  Besides SQLite, there's an in-memory backend for
+tests and benchmarks and an append-only segment file backend for
+ingest-heavy sources.
+
+Attributes:
+  BACKENDS (dict): Backend names (for DB_BACKEND) to factories.
+  FILTER_OPERATORS (tuple): Comparisons `BaseBackend.query` accepts.
+
+"""
+
+import datetime
+import importlib
+import json
+import time
+
+import cdls.config
+import cdls.serialization
+from cdls.errors import CDLSError, DatabaseError
+
+FILTER_OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "in")
+
+
+class BaseBackend:
+	"""Abstract representation of a storage backend.
+
+	Subclasses must implement `install`, `warehouse_many`, `query` and
+	`stats`; the rest have sensible defaults.
+
+	"""
+
+	def install(self):
+		"""Initializes (or wipes) the backend's storage. """
+		raise CDLSError("Not yet implemented")
+
+
+	def apply_retention(self, source=None, now=None):
+		"""Drops records past their source's retention period.
+
+		Args:
+		  source (string, optional): Only apply this source's policy.
+		  now (datetime, optional): The current time.
+
+		Returns:
+		  list of string: Whatever was dropped (backends which don't support
+		    retention drop nothing).
+
+		"""
+		return []
+
+
+	def configure_source(self, source, config):
+		"""Receives a source's configuration node when it registers.
+
+		Args:
+		  source (string): The datasource identifier.
+		  config (dict): The datasource's configuration node.
+
+		"""
+		pass
+
+
+	def get_watermark(self, source):
+		"""Returns the high-watermark a source's last incremental load reached.
+
+		Returns:
+		  mixed: The watermark, or None if there isn't one (backends which
+		    don't keep watermarks never have one, so every load is a full
+		    load).
+
+		"""
+		return None
+
+
+	def query(self, source, filters=None, since=None, until=None, limit=None):
+		"""Finds a source's records.
+
+		Args:
+		  source (string): The datasource identifier.
+		  filters (dict, optional): Field (dotted path) to value for equality,
+		    or to an (operator, value) pair where the operator is one of
+		    `FILTER_OPERATORS` (`in` takes a list of values).
+		  since (datetime, optional): Only records dated at or after this.
+		  until (datetime, optional): Only records dated before this.
+		  limit (int, optional): The most records to return.
+
+		Returns:
+		  list of Change: Matching records in the order they were written.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		raise CDLSError("Not yet implemented")
+
+
+	def replay_rejects(self, source=None, limit=None):
+		"""Re-drives rejected records.
+
+		Returns:
+		  tuple: (number replayed, number still failing)
+
+		Raises:
+		  DatabaseError
+
+		"""
+		raise DatabaseError("{} can't replay rejects".format(type(self).__name__))
+
+
+	def set_watermark(self, source, value):
+		"""Records how far a source's incremental loads have got.
+
+		Backends store the value as JSON (see `encode_watermark`), so
+		`get_watermark` gives back what JSON would: datetimes come back as
+		date strings, tuples as lists.
+
+		Args:
+		  source (string): The datasource identifier.
+		  value (mixed): Anything that can be serialized to JSON, or a
+		    datetime.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		pass
+
+
+	def stats(self):
+		"""Summarizes what's stored.
+
+		Returns:
+		  dict: At least `backend`, `records`, `rejects`, `bytes` and
+		    per-source `records` under `sources`.
+
+		"""
+		raise CDLSError("Not yet implemented")
+
+
+	def warehouse(self, data, source, record_date):
+		"""Saves a single record.
+
+		Args:
+		  data (mixed): Any object that can be serialized to JSON.
+		  source (string): The identifier for the datasource where the data
+		    came from.
+		  record_date (datetime): The record's date.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		errors = self.warehouse_many([(data, record_date)], source, workers=0, reject=False)
+		if errors:
+			raise errors[0][1]
+
+
+	def warehouse_many(self, records, source, workers=None, stats=None, reject=True):
+		"""Saves a batch of records.
+
+		Args:
+		  records (list of tuple): (data, record_date) pairs.
+		  source (string): The identifier for the datasource where the data
+		    came from.
+		  workers (int, optional): Overrides the configured number of
+		    serializer processes.
+		  stats (dict, optional): If given, `serialize_ns`, `write_ns` and
+		    `bytes_written` are accumulated into it.
+		  reject (bool, optional): Whether to keep failed records for later.
+
+		Returns:
+		  list of tuple: (index, DatabaseError) for every record that failed.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		raise CDLSError("Not yet implemented")
+
+
+	def _encode(self, records, source, workers):
+		"""Serializes a batch the same way `cdls.db` does.
+
+		Returns:
+		  tuple: ((index, params) for each encoded record, (index,
+		    DatabaseError) for each failure, serialization time in ns)
+
+		"""
+		time_started = time.perf_counter_ns()
+		pending = []
+		errors = []
+		for index, (params, error) in enumerate(cdls.serialization.encode_batch(records, source, workers)):
+			if error:
+				errors.append((index, DatabaseError(error[1], error_type=error[0])))
+			else:
+				pending.append((index, params))
+		return (pending, errors, time.perf_counter_ns() - time_started)
+
+
+def create(name):
+	"""Returns a storage backend by name.
+
+	Args:
+	  name (string): `sqlite`, `memory`, `segment` or the qualified name of a
+	    backend class.
+
+	Returns:
+	  mixed: The backend.
+
+	Raises:
+	  CDLSError
+
+	"""
+	try:
+		return BACKENDS[name]()
+	except KeyError:
+		pass
+
+	try:
+		(module_name, class_name) = name.rsplit(".", 1)
+		return getattr(importlib.import_module(module_name), class_name)()
+	except (ValueError, ImportError, AttributeError) as e:
+		raise CDLSError("Unknown storage backend '{}'".format(name)) from e
+
+
+def encode_watermark(source, value):
+	"""Serializes a watermark to JSON, with datetimes formatted like record
+	dates.
+
+	Args:
+	  source (string): The datasource identifier.
+	  value (mixed): The watermark.
+
+	Returns:
+	  string
+
+	Raises:
+	  DatabaseError
+
+	"""
+	def default(o):
+		if isinstance(o, datetime.datetime):
+			return cdls.serialization.date_to_string(o)
+		raise TypeError("{} is not JSON serializable".format(type(o).__name__))
+
+	try:
+		return json.dumps(value, default=default, sort_keys=True)
+	except (TypeError, ValueError) as e:
+		raise DatabaseError("Watermark for '{}' can't be stored: {}".format(source, e)) from e
+
+
+def matches(change, source, filters=None, since=None, until=None):
+	"""Checks a record against `query` criteria, for backends which evaluate
+	them in Python.
+
+	Args:
+	  change (Change): The record.
+	  source (string): The upper-cased datasource identifier.
+	  filters (dict, optional): As in `BaseBackend.query`.
+	  since (string, optional): The formatted start of the date range.
+	  until (string, optional): The formatted end of the date range.
+
+	Returns:
+	  bool
+
+	Raises:
+	  DatabaseError
+
+	"""
+	if change.source != source:
+		return False
+	if since and change.record_date < since:
+		return False
+	if until and change.record_date >= until:
+		return False
+	if not filters:
+		return True
+
+	contents = json.loads(change.json).get("$contents")
+	for path, value in filters.items():
+		operator, value = value if isinstance(value, tuple) else ("=", value)
+		if operator not in FILTER_OPERATORS:
+			raise DatabaseError("Unsupported filter operator '{}'".format(operator))
+
+		field = contents
+		for key in path.split("."):
+			field = field.get(key) if isinstance(field, dict) else None
+
+		# Like SQL, nothing compares to a missing value
+		if field is None:
+			return False
+
+		try:
+			if operator == "in":
+				matched = field in value
+			else:
+				matched = {
+					"=":  lambda a, b: a == b,
+					"!=": lambda a, b: a != b,
+					"<":  lambda a, b: a < b,
+					"<=": lambda a, b: a <= b,
+					">":  lambda a, b: a > b,
+					">=": lambda a, b: a >= b
+				}[operator](field, value)
+		except TypeError:
+			matched = False
+
+		if not matched:
+			return False
+
+	return True
+
+
+def _create_sqlite():
+	import cdls.db
+	return cdls.db
+
+
+def _create_memory():
+	from cdls.backends.memory import MemoryBackend
+	return MemoryBackend()
+
+
+def _create_segment():
+	from cdls.backends.segment import SegmentBackend
+	return SegmentBackend(cdls.config.DB_SEGMENT_DIRECTORY, cdls.config.DB_SEGMENT_MAX_BYTES)
+
+
+BACKENDS = {
+	"sqlite":  _create_sqlite,
+	"memory":  _create_memory,
+	"segment": _create_segment
+}
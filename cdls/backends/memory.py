@@ -0,0 +1,109 @@
+"""
+In-memory storage backend.
+
+Records are kept in a list for the life of the process, which makes this
+backend handy for tests and for benchmarking everything upstream of storage.
+
+"""
+
+import collections
+import json
+import threading
+import time
+
+import cdls.backends
+import cdls.serialization
+from cdls.db import Change
+
+
+class MemoryBackend(cdls.backends.BaseBackend):
+	"""Keeps the warehouse in memory.
+
+	Attributes:
+	  records (list of Change): Everything warehoused, in write order.
+	  rejects (list of tuple): (source, data, record_date, DatabaseError) for
+	    each rejected record.
+	  watermarks (dict): Watermarks by upper-cased source.
+
+	"""
+	def __init__(self):
+		self.records    = []
+		self.rejects    = []
+		self.watermarks = {}
+		self._lock      = threading.Lock()
+
+
+	def get_watermark(self, source):
+		return self.watermarks.get(source.strip().upper())
+
+
+	def install(self):
+		with self._lock:
+			self.records = []
+			self.rejects = []
+			self.watermarks = {}
+
+
+	def query(self, source, filters=None, since=None, until=None, limit=None):
+		source = source.strip().upper()
+		since = since and cdls.serialization.date_to_string(since)
+		until = until and cdls.serialization.date_to_string(until)
+
+		results = []
+		for change in list(self.records):
+			if cdls.backends.matches(change, source, filters, since, until):
+				results.append(change)
+				if limit and len(results) >= limit:
+					break
+		return results
+
+
+	def replay_rejects(self, source=None, limit=None):
+		with self._lock:
+			chosen = [n for n, reject in enumerate(self.rejects) if not source or reject[0] == source.strip().upper()][:limit]
+			selected = [self.rejects[n] for n in chosen]
+			chosen = set(chosen)
+			self.rejects = [reject for n, reject in enumerate(self.rejects) if n not in chosen]
+
+		batches = collections.OrderedDict()
+		for reject_source, data, record_date, error in selected:
+			batches.setdefault(reject_source, []).append((data, record_date))
+
+		failed = 0
+		for reject_source, records in batches.items():
+			failed += len(self.warehouse_many(records, reject_source))
+		return (len(selected) - failed, failed)
+
+
+	def set_watermark(self, source, value):
+		# Round-tripped through JSON, to give back what the other backends do
+		self.watermarks[source.strip().upper()] = json.loads(cdls.backends.encode_watermark(source, value))
+
+
+	def stats(self):
+		sources = collections.Counter(change.source for change in self.records)
+		return {
+			"backend": "memory",
+			"records": len(self.records),
+			"rejects": len(self.rejects),
+			"bytes":   sum(len(change.json) for change in self.records),
+			"sources": {source: {"records": count} for source, count in sources.items()}
+		}
+
+
+	def warehouse_many(self, records, source, workers=None, stats=None, reject=True):
+		(pending, errors, serialize_ns) = self._encode(records, source, workers)
+
+		time_started = time.perf_counter_ns()
+		with self._lock:
+			seq = len(self.records) + 1
+			self.records.extend(Change(seq + offset, *params) for offset, (index, params) in enumerate(pending))
+			if reject:
+				self.rejects.extend((source.strip().upper(),) + records[index] + (error,) for index, error in errors)
+
+		if stats is not None:
+			stats["serialize_ns"] = stats.get("serialize_ns", 0) + serialize_ns
+			stats["write_ns"] = stats.get("write_ns", 0) + time.perf_counter_ns() - time_started
+			stats["bytes_written"] = stats.get("bytes_written", 0) + sum(len(params[3]) for index, params in pending)
+
+		return errors
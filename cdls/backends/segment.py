@@ -0,0 +1,373 @@
+"""
+Append-only segment file storage backend.
+
+Each source is written to a series of segment files, skipping SQLite's
+B-tree maintenance entirely.  A segment is a run of length-prefixed frames:
+
+    <length:u32> <seq:u64> <guid:36 bytes> <record date:26 bytes> <json>
+
+Alongside every segment is a sidecar index of fixed-size (seq, offset,
+record date) entries, appended after the frames they point to.  Readers only
+follow the index and mmap the segment, so a frame torn by a crash is never
+read (and is truncated the next time the segment is opened for writing).
+
+Attributes:
+  _FRAME (Struct): The frame header.
+  _ENTRY (Struct): An index entry.
+  _NAME_CHARACTERS (string): Characters kept as they are in file names.
+  _REJECTS_FILE (string): Where rejected records are logged.
+  _WATERMARKS_FILE (string): Where incremental load watermarks are kept.
+
+"""
+
+import datetime
+import glob
+import json
+import mmap
+import os
+import re
+import string
+import struct
+import threading
+import time
+
+import cdls.backends
+import cdls.config
+import cdls.serialization
+from cdls.db import Change
+from cdls.errors import DatabaseError
+
+_FRAME = struct.Struct("<IQ36s26s")
+_ENTRY = struct.Struct("<QQ26s")
+_NAME_CHARACTERS = string.ascii_uppercase + string.digits
+_REJECTS_FILE = "rejects.jsonl"
+_WATERMARKS_FILE = "watermarks.json"
+
+
+class SegmentBackend(cdls.backends.BaseBackend):
+	"""Writes each source to append-only segment files.
+
+	Args:
+	  directory (string): Where the segment files live.
+	  max_bytes (int): Segment size to roll over to a new segment at.
+
+	"""
+	def __init__(self, directory, max_bytes):
+		self._directory = directory
+		self._max_bytes = max_bytes
+		self._writers   = {}
+		self._lock      = threading.Lock()
+		self._seq       = None
+
+
+	def close(self):
+		"""Closes every open segment. """
+		with self._lock:
+			for writer in self._writers.values():
+				writer.close()
+			self._writers = {}
+
+
+	def get_watermark(self, source):
+		return self._read_watermarks().get(source.strip().upper())
+
+
+	def install(self):
+		self.close()
+		os.makedirs(self._directory, exist_ok=True)
+		for path in glob.glob(os.path.join(self._directory, "*.seg")) + glob.glob(os.path.join(self._directory, "*.idx")):
+			os.remove(path)
+		for name in (_REJECTS_FILE, _WATERMARKS_FILE):
+			if os.path.exists(os.path.join(self._directory, name)):
+				os.remove(os.path.join(self._directory, name))
+		self._seq = 0
+
+
+	def query(self, source, filters=None, since=None, until=None, limit=None):
+		source = source.strip().upper()
+		since = since and cdls.serialization.date_to_string(since)
+		until = until and cdls.serialization.date_to_string(until)
+
+		results = []
+		for segment in self._segments(source):
+			for change in self._read(segment, source, since, until):
+				if filters and not cdls.backends.matches(change, source, filters):
+					continue
+				results.append(change)
+				if limit and len(results) >= limit:
+					return results
+		return results
+
+
+	def set_watermark(self, source, value):
+		# Rewritten whole and swapped into place, so it's never half written
+		path = os.path.join(self._directory, _WATERMARKS_FILE)
+		value = json.loads(cdls.backends.encode_watermark(source, value))
+		with self._lock:
+			watermarks = self._read_watermarks()
+			watermarks[source.strip().upper()] = value
+			os.makedirs(self._directory, exist_ok=True)
+			with open(path + ".tmp", "w") as fp:
+				json.dump(watermarks, fp, sort_keys=True)
+				fp.flush()
+				if cdls.config.DB_SEGMENT_FSYNC:
+					os.fsync(fp.fileno())
+			os.replace(path + ".tmp", path)
+
+
+	def stats(self):
+		summary = {"backend": "segment", "records": 0, "rejects": 0, "bytes": 0, "sources": {}}
+		for path in sorted(glob.glob(os.path.join(self._directory, "*.idx"))):
+			source = _source_name(os.path.basename(path).rsplit("-", 1)[0])
+			records = os.path.getsize(path) // _ENTRY.size
+			size = os.path.getsize(path) + os.path.getsize(path[:-len(".idx")] + ".seg")
+
+			node = summary["sources"].setdefault(source, {"records": 0, "segments": 0, "bytes": 0})
+			node["records"] += records
+			node["segments"] += 1
+			node["bytes"] += size
+			summary["records"] += records
+			summary["bytes"] += size
+
+		rejects = os.path.join(self._directory, _REJECTS_FILE)
+		if os.path.exists(rejects):
+			with open(rejects) as fp:
+				summary["rejects"] = sum(1 for line in fp)
+		return summary
+
+
+	def warehouse_many(self, records, source, workers=None, stats=None, reject=True):
+		(pending, errors, serialize_ns) = self._encode(records, source, workers)
+
+		time_started = time.perf_counter_ns()
+		bytes_written = 0
+		if pending:
+			writer = self._writer(source.strip().upper())
+			with writer.lock:
+				seq = self._allocate(len(pending))
+				bytes_written = writer.append([(seq + offset,) + params for offset, (index, params) in enumerate(pending)])
+
+		if errors and reject:
+			self._reject(records, errors, source)
+
+		if stats is not None:
+			stats["serialize_ns"] = stats.get("serialize_ns", 0) + serialize_ns
+			stats["write_ns"] = stats.get("write_ns", 0) + time.perf_counter_ns() - time_started
+			stats["bytes_written"] = stats.get("bytes_written", 0) + bytes_written
+
+		return errors
+
+
+	def _allocate(self, count):
+		"""Reserves a block of SEQ values, which are unique across sources. """
+		with self._lock:
+			if self._seq is None:
+				self._seq = 0
+				for path in glob.glob(os.path.join(self._directory, "*.idx")):
+					entries = os.path.getsize(path) // _ENTRY.size
+					if entries:
+						with open(path, "rb") as fp:
+							fp.seek((entries - 1) * _ENTRY.size)
+							self._seq = max(self._seq, _ENTRY.unpack(fp.read(_ENTRY.size))[0])
+
+			first = self._seq + 1
+			self._seq += count
+			return first
+
+
+	def _read(self, segment, source, since, until):
+		"""Yields a segment's records, optionally only within a date range.
+
+		Args:
+		  segment (string): The segment's path, less its extension.
+		  source (string): The upper-cased datasource identifier.
+		  since (string, optional): The formatted start of the date range.
+		  until (string, optional): The formatted end of the date range.
+
+		"""
+		with open(segment + ".idx", "rb") as fp:
+			index = fp.read()
+		index = index[:len(index) - len(index) % _ENTRY.size]
+		if not index:
+			return
+
+		with open(segment + ".seg", "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			for seq, offset, record_date in _ENTRY.iter_unpack(index):
+				record_date = record_date.decode()
+				if (since and record_date < since) or (until and record_date >= until):
+					continue
+
+				(length, seq, guid, record_date) = _FRAME.unpack_from(data, offset)
+				start = offset + _FRAME.size
+				yield Change(seq, guid.decode(), source, record_date.decode(), data[start:start + length].decode())
+
+
+	def _read_watermarks(self):
+		try:
+			with open(os.path.join(self._directory, _WATERMARKS_FILE)) as fp:
+				return json.load(fp)
+		except FileNotFoundError:
+			return {}
+
+
+	def _reject(self, records, errors, source):
+		"""Logs rejected records to the rejects file. """
+		rejected_on = cdls.serialization.date_to_string(datetime.datetime.now())
+		lines = []
+		for index, error in errors:
+			data, record_date = records[index]
+			try:
+				payload_text = json.dumps(data, default=lambda o: getattr(o, "__dict__", repr(o)), sort_keys=True)
+			except Exception:
+				payload_text = repr(data)
+
+			lines.append(json.dumps({
+				"source":        source.strip().upper(),
+				"record_date":   str(record_date),
+				"rejected_on":   rejected_on,
+				"error_type":    error.error_type,
+				"error_message": str(error),
+				"payload_text":  payload_text
+			}) + "\n")
+
+		with self._lock, open(os.path.join(self._directory, _REJECTS_FILE), "a") as fp:
+			fp.writelines(lines)
+
+
+	def _segments(self, source):
+		"""Lists a source's segments (less their extensions), oldest first. """
+		pattern = os.path.join(self._directory, "{}-*.idx".format(_file_name(source)))
+		return sorted(path[:-len(".idx")] for path in glob.glob(pattern))
+
+
+	def _writer(self, source):
+		"""Returns the source's open segment writer. """
+		with self._lock:
+			if source not in self._writers:
+				segments = self._segments(source)
+				number = int(segments[-1].rsplit("-", 1)[1]) if segments else 1
+				self._writers[source] = _SegmentWriter(self._directory, source, number, self._max_bytes)
+			return self._writers[source]
+
+
+class _SegmentWriter:
+	"""Appends frames to a source's current segment, rolling over to a new one
+	once it's full.
+
+	Args:
+	  directory (string): Where the segment files live.
+	  source (string): The upper-cased datasource identifier.
+	  number (int): The segment to start appending to.
+	  max_bytes (int): Segment size to roll over at.
+
+	Attributes:
+	  lock (Lock): Held while appending.
+
+	"""
+	def __init__(self, directory, source, number, max_bytes):
+		self.lock       = threading.Lock()
+		self._directory = directory
+		self._source    = source
+		self._max_bytes = max_bytes
+		self._data      = None
+		self._index     = None
+		self._open(number)
+
+
+	def append(self, rows):
+		"""Appends rows to the segment, frames first and then their index
+		entries.
+
+		Args:
+		  rows (list of tuple): (seq, guid, source, record_date, json) rows.
+
+		Returns:
+		  int: Bytes of JSON written.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		frames = []
+		entries = []
+		offset = self._size
+		bytes_written = 0
+		for seq, guid, source, record_date, document in rows:
+			document = document.encode()
+			frame = _FRAME.pack(len(document), seq, guid.encode(), record_date.encode()) + document
+
+			# Roll over to a new segment when this one's full
+			if offset > 0 and offset + len(frame) > self._max_bytes:
+				self._write(frames, entries)
+				frames, entries = [], []
+				self._open(self._number + 1)
+				offset = 0
+
+			frames.append(frame)
+			entries.append(_ENTRY.pack(seq, offset, record_date.encode()))
+			offset += len(frame)
+			bytes_written += len(document)
+
+		self._write(frames, entries)
+		return bytes_written
+
+
+	def close(self):
+		if self._data:
+			self._data.close()
+			self._index.close()
+
+
+	def _open(self, number):
+		"""Opens a segment for appending, dropping any frames its index
+		doesn't cover.
+		"""
+		self.close()
+		os.makedirs(self._directory, exist_ok=True)
+		self._number = number
+		prefix = os.path.join(self._directory, "{}-{:06d}".format(_file_name(self._source), number))
+
+		self._index = open(prefix + ".idx", "ab")
+		self._data = open(prefix + ".seg", "ab")
+
+		entries = self._index.tell() // _ENTRY.size
+		self._index.truncate(entries * _ENTRY.size)
+
+		self._size = 0
+		if entries:
+			with open(prefix + ".idx", "rb") as fp:
+				fp.seek((entries - 1) * _ENTRY.size)
+				(seq, offset, record_date) = _ENTRY.unpack(fp.read(_ENTRY.size))
+			with open(prefix + ".seg", "rb") as fp:
+				fp.seek(offset)
+				self._size = offset + _FRAME.size + _FRAME.unpack(fp.read(_FRAME.size))[0]
+		self._data.truncate(self._size)
+
+
+	def _write(self, frames, entries):
+		try:
+			self._data.write(b"".join(frames))
+			self._data.flush()
+			self._index.write(b"".join(entries))
+			self._index.flush()
+			if cdls.config.DB_SEGMENT_FSYNC:
+				os.fsync(self._data.fileno())
+				os.fsync(self._index.fileno())
+		except OSError as e:
+			raise DatabaseError(e) from e
+
+		self._size += sum(len(frame) for frame in frames)
+
+
+def _file_name(source):
+	"""Returns a filesystem-safe version of a source identifier.
+
+	Anything but upper-case letters and digits is escaped as `_XX` per UTF-8
+	byte, so no two sources share a name and `_source_name` can reverse it.
+	"""
+	return "".join(c if c in _NAME_CHARACTERS else "".join("_{:02X}".format(b) for b in c.encode()) for c in source)
+
+
+def _source_name(file_name):
+	"""Returns the source identifier a `_file_name` was made from. """
+	return re.sub(rb"_([0-9A-F]{2})", lambda match: bytes([int(match.group(1), 16)]), file_name.encode()).decode()
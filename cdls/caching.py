@@ -0,0 +1,121 @@
+"""
+Bounded in-process caches for the CDLS.
+
+"""
+
+import collections
+import threading
+
+
+class LRUCache:
+	"""A thread-safe least-recently-used cache bounded by the total size of
+	its entries rather than their number.
+
+	Each `put` says how big its value is (in whatever unit `max_size` is
+	given in), and the least recently used entries are evicted until
+	everything fits.  `clear` bumps `generation`, so a value read from the
+	source of truth before a clear can be kept from being cached after it.
+
+	Args:
+	  max_size (int): The most the entries can add up to; 0 disables the
+	    cache.
+
+	Attributes:
+	  generation (int): How many times the cache has been cleared.
+
+	"""
+	def __init__(self, max_size):
+		self.generation = 0
+		self._max_size  = max_size
+		self._entries   = collections.OrderedDict()
+		self._size      = 0
+		self._lock      = threading.Lock()
+		self._hits      = 0
+		self._misses    = 0
+		self._evictions = 0
+
+
+	def clear(self):
+		"""Empties the cache. """
+		with self._lock:
+			self._entries.clear()
+			self._size = 0
+			self.generation += 1
+
+
+	def discard(self, keys):
+		"""Drops entries, if they're cached.
+
+		Args:
+		  keys (iterable): The keys to drop.
+
+		"""
+		with self._lock:
+			for key in keys:
+				entry = self._entries.pop(key, None)
+				if entry:
+					self._size -= entry[1]
+
+
+	def get(self, key):
+		"""Returns a cached value (None if it isn't cached), marking it as the
+		most recently used.
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self._misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self._hits += 1
+			return entry[0]
+
+
+	def put(self, key, value, size, generation=None):
+		"""Caches a value, evicting the least recently used entries to make
+		room.
+
+		Args:
+		  key (hashable)
+		  value (mixed)
+		  size (int): The value's size.
+		  generation (int, optional): `generation` as of when the value was
+		    read; it isn't cached if the cache has been cleared since.
+
+		"""
+		if size > self._max_size:
+			return
+
+		with self._lock:
+			if generation is not None and generation != self.generation:
+				return
+
+			previous = self._entries.pop(key, None)
+			if previous:
+				self._size -= previous[1]
+
+			self._entries[key] = (value, size)
+			self._size += size
+			while self._size > self._max_size:
+				(evicted_key, (evicted_value, evicted_size)) = self._entries.popitem(last=False)
+				self._size -= evicted_size
+				self._evictions += 1
+
+
+	def stats(self):
+		"""Returns the cache's counters.
+
+		Returns:
+		  dict: `hits`, `misses`, `evictions`, `entries`, `size` and
+		    `max_size`.
+
+		"""
+		with self._lock:
+			return {
+				"hits":      self._hits,
+				"misses":    self._misses,
+				"evictions": self._evictions,
+				"entries":   len(self._entries),
+				"size":      self._size,
+				"max_size":  self._max_size
+			}
@@ -0,0 +1,396 @@
+"""
+Columnar snapshots of the warehouse, for analytics scans.
+
+A snapshot is a directory holding one binary column file per field plus a
+`manifest.json` describing them.  Numeric columns are packed native-endian
+arrays (int64 or float64); text columns are dictionary encoded, as an int32
+array of codes into a JSON list of distinct values.  Every snapshot has
+`seq` and `record_date` (microseconds since the epoch) columns, followed by
+one for each requested field:
+
+    manifest.json
+    seq.col               int64
+    record_date.col       int64
+    <field>.col           int64, float64 or int32 codes
+    <field>.valid         uint8 (1 if the row has a value), numeric fields
+    <field>.dict.json     distinct values, text fields (code -1 is missing)
+
+The manifest is written last, so a snapshot without one is incomplete.
+`Snapshot` memory-maps the column files, so scans read straight out of the
+page cache without decoding any JSON.
+
+Attributes:
+  TYPES (dict): Array typecode and Python conversion for each field type.
+  _MANIFEST (string): The manifest's file name.
+  _EPOCH (datetime): What `record_date` values count from.
+
+"""
+
+import array
+import datetime
+import json
+import mmap
+import os
+import re
+import sys
+
+import cdls.db
+import cdls.serialization
+from cdls.errors import CDLSError
+
+TYPES = {
+	"integer": ("q", int),
+	"real":    ("d", float),
+	"text":    ("i", str)
+}
+
+_MANIFEST = "manifest.json"
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def write_snapshot(source, directory, fields=None, since=None, until=None):
+	"""Writes a source's warehouse rows out as a columnar snapshot.
+
+	Args:
+	  source (string): The datasource identifier.
+	  directory (string): Where to write the snapshot.
+	  fields (dict, optional): Fields (dotted paths) to their type (one of
+	    `TYPES`); defaults to the source's projections.  An integer field
+	    with fractional values is written as a real one.
+	  since (datetime, optional): Only rows with a RECORD_DATE at or after this.
+	  until (datetime, optional): Only rows with a RECORD_DATE before this.
+
+	Returns:
+	  int: The number of rows written.
+
+	Raises:
+	  CDLSError
+	  DatabaseError
+
+	"""
+	if fields is None:
+		fields = cdls.db.get_projections(source)
+	fields = sorted(fields.items())
+	for path, type_name in fields:
+		if type_name not in TYPES:
+			raise CDLSError("Field '{}' has unsupported type '{}'".format(path, type_name))
+
+	# Every column needs files of its own (allowing for case-insensitive
+	# filesystems)
+	file_names = {"seq": "seq", "record_date": "record_date"}
+	for path, type_name in fields:
+		key = _file_name(path).lower()
+		if key in file_names:
+			raise CDLSError("Field '{}' would be written to the same files as '{}'".format(path, file_names[key]))
+		file_names[key] = path
+
+	os.makedirs(directory, exist_ok=True)
+	if os.path.exists(os.path.join(directory, _MANIFEST)):
+		os.remove(os.path.join(directory, _MANIFEST))
+
+	columns = [_ColumnWriter(directory, "seq", "integer", nullable=False),
+	           _ColumnWriter(directory, "record_date", "timestamp", nullable=False)]
+	columns += [_ColumnWriter(directory, path, type_name) for path, type_name in fields]
+
+	rows = 0
+	try:
+		for export_range in cdls.db.export_ranges(source, since, until):
+			for batch in cdls.db.read_fields(export_range, [path for path, type_name in fields], since, until):
+				for row in batch:
+					columns[0].append(row[0])
+					columns[1].append(_to_timestamp(row[1]))
+					for column, value in zip(columns[2:], row[2:]):
+						column.append(value)
+				for column in columns:
+					column.flush()
+				rows += len(batch)
+	finally:
+		for column in columns:
+			column.close()
+
+	manifest = {
+		"source":     source.strip().upper(),
+		"rows":       rows,
+		"created_on": cdls.serialization.date_to_string(datetime.datetime.now()),
+		"byteorder":  sys.byteorder,
+		"columns":    [column.describe() for column in columns]
+	}
+
+	# Publish the manifest atomically, now the columns are complete
+	with open(os.path.join(directory, _MANIFEST + ".tmp"), "w") as fp:
+		json.dump(manifest, fp, indent=4)
+	os.replace(os.path.join(directory, _MANIFEST + ".tmp"), os.path.join(directory, _MANIFEST))
+
+	return rows
+
+
+class Snapshot:
+	"""Reads a columnar snapshot, memory-mapping its column files.
+
+	The memoryviews handed out point straight into the mapped files, so they
+	have to be released before the snapshot is closed.
+
+	Args:
+	  directory (string): Where the snapshot was written.
+
+	Attributes:
+	  source (string): The upper-cased datasource identifier.
+	  rows (int): The number of rows.
+	  columns (dict): Each column's manifest entry, keyed by name.
+
+	Raises:
+	  CDLSError
+
+	"""
+	def __init__(self, directory):
+		try:
+			with open(os.path.join(directory, _MANIFEST)) as fp:
+				manifest = json.load(fp)
+		except (OSError, ValueError) as e:
+			raise CDLSError("No complete snapshot in '{}': {}".format(directory, e)) from e
+
+		self.source        = manifest["source"]
+		self.rows          = manifest["rows"]
+		self.columns       = dict((column["name"], column) for column in manifest["columns"])
+		self._directory    = directory
+		self._swap         = manifest["byteorder"] != sys.byteorder
+		self._maps         = []
+		self._dictionaries = {}
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+	def close(self):
+		"""Unmaps the column files. """
+		for data in self._maps:
+			data.close()
+		self._maps = []
+
+
+	def column(self, name):
+		"""Returns a column's raw values (codes for text columns).
+
+		Args:
+		  name (string): The column (field path).
+
+		Returns:
+		  memoryview: Typed values, one per row.
+
+		Raises:
+		  CDLSError
+
+		"""
+		column = self._column(name)
+		if array.array(column["typecode"]).itemsize != column["itemsize"]:
+			raise CDLSError("Column '{}' was written with a different '{}' size".format(name, column["typecode"]))
+		return self._map(column["file"], column["typecode"])
+
+
+	def dictionary(self, name):
+		"""Returns a text column's distinct values, indexed by code.
+
+		Returns:
+		  list of string
+
+		Raises:
+		  CDLSError
+
+		"""
+		column = self._column(name)
+		if "dictionary" not in column:
+			raise CDLSError("Column '{}' isn't dictionary encoded".format(name))
+		if name not in self._dictionaries:
+			with open(os.path.join(self._directory, column["dictionary"])) as fp:
+				self._dictionaries[name] = json.load(fp)
+		return self._dictionaries[name]
+
+
+	def valid(self, name):
+		"""Returns which rows have a value in a numeric column.
+
+		Returns:
+		  memoryview: 1 for each row with a value and 0 otherwise, or None if
+		    every row has one.
+
+		Raises:
+		  CDLSError
+
+		"""
+		column = self._column(name)
+		return self._map(column["valid"], "B") if column.get("valid") else None
+
+
+	def values(self, name):
+		"""Yields a column's values decoded to Python objects (None where
+		missing).
+
+		Raises:
+		  CDLSError
+
+		"""
+		column = self._column(name)
+		data = self.column(name)
+		if "dictionary" in column:
+			dictionary = self.dictionary(name)
+			for code in data:
+				yield dictionary[code] if code >= 0 else None
+		elif column.get("valid"):
+			for value, valid in zip(data, self.valid(name)):
+				yield value if valid else None
+		else:
+			yield from data
+
+
+	def _column(self, name):
+		try:
+			return self.columns[name]
+		except KeyError:
+			raise CDLSError("Snapshot has no column '{}'".format(name))
+
+
+	def _map(self, file_name, typecode):
+		"""Maps a column file as a typed memoryview. """
+		path = os.path.join(self._directory, file_name)
+		if not os.path.getsize(path):
+			return memoryview(b"").cast(typecode)
+
+		with open(path, "rb") as fp:
+			data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+		# Snapshots from the other endianness need swapping (and copying)
+		if self._swap and array.array(typecode).itemsize > 1:
+			values = array.array(typecode, data)
+			data.close()
+			values.byteswap()
+			return memoryview(values)
+
+		self._maps.append(data)
+		return memoryview(data).cast(typecode)
+
+
+class _ColumnWriter:
+	"""Appends a single column's values to its files, a batch at a time.
+
+	Args:
+	  directory (string): Where the snapshot is being written.
+	  name (string): The column (field path).
+	  type_name (string): One of `TYPES`, or `timestamp`.
+	  nullable (bool, optional): Whether to track missing values.
+
+	"""
+	def __init__(self, directory, name, type_name, nullable=True):
+		self._directory  = directory
+		self._name       = name
+		self._type_name  = type_name
+		self._file_name  = _file_name(name)
+		(self._typecode, self._convert) = TYPES.get(type_name, ("q", int))
+		self._nullable   = nullable and type_name != "text"
+		self._values     = array.array(self._typecode)
+		self._valid      = array.array("B")
+		self._has_nulls  = False
+		self._dictionary = {} if type_name == "text" else None
+
+		self._data = open(os.path.join(directory, self._file_name + ".col"), "wb")
+		self._valid_fp = open(os.path.join(directory, self._file_name + ".valid"), "wb") if self._nullable else None
+
+
+	def append(self, value):
+		# Rather than truncate fractions, widen the column to hold them
+		if self._type_name == "integer" and isinstance(value, float) and not value.is_integer():
+			self._promote()
+
+		if value is not None:
+			try:
+				value = self._convert(value)
+			except (TypeError, ValueError, OverflowError):
+				value = None
+
+		if self._dictionary is not None:
+			if value is None:
+				self._values.append(-1)
+			else:
+				self._values.append(self._dictionary.setdefault(value, len(self._dictionary)))
+			return
+
+		if self._nullable:
+			self._valid.append(value is not None)
+			self._has_nulls = self._has_nulls or value is None
+
+		try:
+			self._values.append(0 if value is None else value)
+		except OverflowError:
+			# Integers too wide for int64 are treated as missing
+			self._values.append(0)
+			self._valid[-1] = 0
+			self._has_nulls = True
+
+
+	def close(self):
+		self._data.close()
+		if self._valid_fp:
+			self._valid_fp.close()
+			if not self._has_nulls:
+				os.remove(os.path.join(self._directory, self._file_name + ".valid"))
+
+		if self._dictionary is not None:
+			with open(os.path.join(self._directory, self._file_name + ".dict.json"), "w") as fp:
+				json.dump(list(self._dictionary), fp)
+
+
+	def describe(self):
+		"""Returns the column's manifest entry. """
+		entry = {
+			"name":     self._name,
+			"type":     self._type_name,
+			"file":     self._file_name + ".col",
+			"typecode": self._typecode,
+			"itemsize": self._values.itemsize
+		}
+		if self._nullable and self._has_nulls:
+			entry["valid"] = self._file_name + ".valid"
+		if self._dictionary is not None:
+			entry["dictionary"] = self._file_name + ".dict.json"
+		return entry
+
+
+	def _promote(self):
+		"""Turns an integer column into a real one, converting the values
+		written so far.
+		"""
+		self.flush()
+		self._data.close()
+
+		path = os.path.join(self._directory, self._file_name + ".col")
+		written = array.array(self._typecode)
+		with open(path, "rb") as fp:
+			written.frombytes(fp.read())
+
+		self._type_name = "real"
+		(self._typecode, self._convert) = TYPES["real"]
+		self._values = array.array(self._typecode, written)
+		self._data = open(path, "wb")
+
+
+	def flush(self):
+		"""Writes out the values appended since the last flush. """
+		self._values.tofile(self._data)
+		self._values = array.array(self._typecode)
+		if self._nullable:
+			self._valid.tofile(self._valid_fp)
+			self._valid = array.array("B")
+
+
+def _file_name(name):
+	"""Returns a filesystem-safe version of a column name. """
+	return re.sub(r"[^\w.]", "_", name)
+
+
+def _to_timestamp(record_date):
+	"""Converts a stored RECORD_DATE to microseconds since the epoch. """
+	return (datetime.datetime.fromisoformat(record_date) - _EPOCH) // datetime.timedelta(microseconds=1)
@@ -1,9 +1,59 @@
+DB_BACKEND="sqlite"
 DB_SQLITE_PATH="./cdls_sqlite.db"
+DB_BATCH_SIZE=500
+DB_FULLTEXT=True
+DB_RETENTION_DAYS=None
+DB_SHARD_COUNT=0
+DB_SEQ_BLOCK_SIZE=10000
+DB_SEGMENT_DIRECTORY="./segments"
+DB_SEGMENT_MAX_BYTES=67108864
+DB_SEGMENT_FSYNC=False
+DB_CACHE_MAX_BYTES=67108864
+
+LOAD_WORKERS=1
+LOAD_MEMORY_BUDGET_BYTES=134217728
+LOAD_TARGET_COMMIT_SECONDS=0.1
+LOAD_MIN_BATCH_SIZE=10
+LOAD_MAX_BATCH_SIZE=50000
+
+WATCH_SETTLE_SECONDS=1.0
+WATCH_POLL_INTERVAL=1.0
+WATCH_CONCURRENCY=4
+WATCH_INOTIFY=True
+
+HTTP_TIMEOUT=30.0
+HTTP_PAGE_SIZE=500
+HTTP_CONCURRENCY=4
+HTTP_CONNECTIONS_PER_HOST=4
+
+SQL_PAGE_SIZE=10000
+SQL_FETCH_SIZE=500
 
 LOGGING_FORMAT="{timestamp} {level:>5} - {message}"
 LOGGING_DIRECTORY="./logs"
 LOGGING_NOISY=False
+LOGGING_LEVEL="info"
+LOGGING_SOURCE_LEVELS={}
+LOGGING_CONTEXT=True
+LOGGING_ASYNC=True
+LOGGING_QUEUE_SIZE=10000
+LOGGING_OVERFLOW="block"
+LOGGING_OUTPUT="text"
+LOGGING_MAX_BYTES=67108864
+LOGGING_BACKUP_COUNT=10
+LOGGING_COMPRESS=True
+LOGGING_SAMPLE_FIRST=10
+LOGGING_SAMPLE_EVERY=1000
 
-LOADREPORT_FORMAT="::[{identifier} {passfail}] ({successes:>4d}/{processed:>4d}) in {elapsed:0.3f} seconds"
+LOADREPORT_FORMAT="::[{identifier} {passfail}] ({successes:>4d}/{processed:>4d}, {rejected} rejected) in {elapsed:0.3f} seconds, {rate:0.1f} rec/s, p50 {p50:0.3f}ms, p99 {p99:0.3f}ms, {bytes_read} bytes read, {bytes_written} bytes written, peak rss {peak_rss} KB, batch size {batch_size}, peak in flight {peak_in_flight}/{memory_budget} bytes ({phases})"
 
 PATH_SOURCECONFIG="./conf/sources.json"
+
+METRICS_TEXTFILE_PATH=None
+METRICS_INTERVAL=15
+
+TRACING_ENABLED=True
+TRACING_MAX_SPANS=100000
+
+SERIALIZE_WORKERS=0
+SERIALIZE_CHUNK_SIZE=250
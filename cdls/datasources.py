@@ -2,18 +2,59 @@
 Contains all of the supported DataSources for the CDLS
 
 Attributes:
+  PHASES (tuple): The phases a load operation's time is broken down into
   _REPORT_FORMAT (string): The format for the string representation of a LoadReport object
+  _IDENTIFIER (Pattern): A plain SQL column name
+  _KEY_TYPES (dict): SqlDataSource `key_type`s, each a pair of functions
+    converting a key to its watermark and back
 
 """
 
+import collections
+import concurrent.futures
 import datetime
+import decimal
+import http.client
+import importlib
+import json
+import operator
+import os
+import random
+import re
+import shutil
+import sys
+import threading
 import time
+import urllib.parse
+
+try:
+	import resource
+except ImportError:
+	resource = None
 
 import cdls.config
+import cdls.extractors
+import cdls.metrics
+import cdls.pooling
+import cdls.serialization
+import cdls.tracing
+import cdls.watching
 from cdls.errors import (DatabaseError, ExtractError, SourceConfigurationError, CDLSError)
 
+PHASES = ("discover", "read", "parse", "serialize", "write", "archive")
+
 _REPORT_FORMAT = cdls.config.LOADREPORT_FORMAT
 
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_KEY_TYPES = {
+	"integer":   (operator.index, int),
+	"real":      (float, float),
+	"text":      (str, str),
+	"decimal":   (lambda key: str(decimal.Decimal(key)), decimal.Decimal),
+	"timestamp": (lambda key: key.isoformat(), datetime.datetime.fromisoformat)
+}
+
 class BaseDataSource:
 	"""Abstract representation of a data source, this class provides some basic
 	services for subclasses
@@ -25,7 +66,21 @@ class BaseDataSource:
 	  _config (dict): The configuration node for this datasource
 	  _identifier (string): The unique name for this particular datasource
 	  _description (string): A friendly description of this datasource
-	  _time_started (float): The time the load operation began
+	  _batch_size (int): The number of records to buffer before writing
+	  _adaptive (bool): Whether `_batch_size` adapts to the observed record
+	    size and commit time (it's fixed when `batch_size` is configured)
+	  _target_commit (float): Seconds each batch write should take
+	  _record_bytes (float): Moving average of a record's serialized size
+	  _sample_bytes (int): The first record's serialized size, which stands
+	    in for `_record_bytes` until a batch has been written
+	  _serialize_workers (int): Serializer processes to use when writing a
+	    batch (None falls back to the global setting)
+	  _pending (list): Records waiting to be written to the warehouse
+	  _pending_bytes (int): Estimated size of the pending records
+	  _budget (MemoryBudget): Bytes held in memory by the load
+	  _log_sampler (LogSampler): Rate limiter for repetitive log messages
+	  _metric_* (Metric): Per-source metrics
+	  _time_started (int): The time the load operation began (perf_counter_ns)
 	  _report (LoadReport): A data model for holding load metrics
 	  _logger (mixed): Logging facade
 
@@ -38,13 +93,35 @@ class BaseDataSource:
 		self._identifier   = self._get_config_param("id", required=True)
 		self._description  = self._get_config_param("description", required=True)
 
+		# Write batching
+		self._adaptive          = self._get_config_param("batch_size") is None
+		self._batch_size        = int(self._get_config_param("batch_size", default=cdls.config.DB_BATCH_SIZE))
+		self._target_commit     = float(self._get_config_param("target_commit_seconds", default=cdls.config.LOAD_TARGET_COMMIT_SECONDS))
+		self._record_bytes      = None
+		self._sample_bytes      = None
+		self._serialize_workers = self._get_config_param("serialize_workers")
+		self._pending           = []
+		self._pending_bytes     = 0
+		self._budget            = MemoryBudget(int(self._get_config_param("memory_budget_bytes", default=cdls.config.LOAD_MEMORY_BUDGET_BYTES) or 0))
+
+		# Log sampling
+		self._log_sampler = LogSampler(
+			int(self._get_config_param("log_sample_first", default=cdls.config.LOGGING_SAMPLE_FIRST)),
+			int(self._get_config_param("log_sample_every", default=cdls.config.LOGGING_SAMPLE_EVERY)))
+
 		# Metrics keepers
-		self._time_started = float()
+		self._time_started = int()
 		self._report       = LoadReport(self)
 
 		self._db           = None
 		self._logger       = None
 
+		self._metric_processed = cdls.metrics.counter("cdls_records_processed_total", "Records processed by a datasource", ("source",)).labels(self._identifier)
+		self._metric_saved     = cdls.metrics.counter("cdls_records_saved_total", "Records handed to the warehouse by a datasource", ("source",)).labels(self._identifier)
+		self._metric_pending   = cdls.metrics.gauge("cdls_pending_records", "Records buffered for the next warehouse batch", ("source",)).labels(self._identifier)
+		self._metric_batch     = cdls.metrics.gauge("cdls_batch_size", "Records per warehouse batch", ("source",)).labels(self._identifier)
+		self._metric_in_flight = cdls.metrics.gauge("cdls_in_flight_bytes", "Bytes a load is holding in memory", ("source",)).labels(self._identifier)
+
 
 	def __str__(self):
 		return "{0}:{1}".format(self.get_type(), self._identifier)
@@ -79,6 +156,10 @@ class BaseDataSource:
 		"""
 		self._db = db
 
+		# Pass along any warehouse options from the source config
+		if hasattr(db, "configure_source"):
+			db.configure_source(self._identifier, self._config)
+
 
 	def register_logger(self, logger):
 		"""Registers the logger for this datasource.
@@ -104,12 +185,49 @@ class BaseDataSource:
 
 		report = self._report
 
-		report.time_elapsed = time.time() - self._time_started
+		self._flush()
+		self._log_suppressed_summary()
+
+		report.finish(time.perf_counter_ns() - self._time_started)
 		report.successful = successful
+		report.batch_size = self._batch_size
+		report.peak_in_flight = self._budget.peak
 
 		return report
 
 
+	def _adapt_batch_size(self, records, stats):
+		"""Resizes batches from how the last one went.
+
+		Aims for batches that take `_target_commit` seconds to serialize and
+		write, without the buffered records (estimated at their serialized
+		size) taking up more than half the memory budget, leaving the rest
+		for reading ahead.  Chasing the target, the size at most doubles or
+		halves each time.
+
+		Args:
+		  records (int): Records in the batch
+		  stats (dict): The batch's write stats (see `warehouse_many`)
+
+		"""
+		if stats.get("bytes_written") and records:
+			observed = stats["bytes_written"] / records
+			self._record_bytes = observed if self._record_bytes is None else 0.8 * self._record_bytes + 0.2 * observed
+
+		if not self._adaptive:
+			return
+
+		size = self._batch_size
+		elapsed = (stats.get("serialize_ns", 0) + stats.get("write_ns", 0)) / 1e9
+		if elapsed > 0 and records:
+			size = min(max(records * self._target_commit / elapsed, size / 2), size * 2)
+		if self._budget.limit and self._record_bytes:
+			size = min(size, self._budget.limit / 2 / self._record_bytes)
+
+		self._batch_size = int(min(max(size, cdls.config.LOAD_MIN_BATCH_SIZE), cdls.config.LOAD_MAX_BATCH_SIZE))
+		self._metric_batch.set(self._batch_size)
+
+
 	def _get_config_param(self, key, required=False, default=None):
 		"""Retrieves a specific configuration parameter
 
@@ -135,9 +253,18 @@ class BaseDataSource:
 			return value
 
 
+	def _increment_bytes_read(self, n):
+		"""Adds to the number of bytes read from the source. """
+		self._report.bytes_read += n
+
+
 	def _increment_number_processed(self):
-		"""Increments the total number of records which were processed (counts successes and failures). """
-		self._report.number_processed += 1
+		"""Increments the total number of records which were processed (counts
+		successes and failures).  The time since the previous record is recorded
+		as this record's latency.
+		"""
+		self._report.mark_record(time.perf_counter_ns())
+		self._metric_processed.inc()
 
 
 	def _increment_number_successes(self):
@@ -148,6 +275,9 @@ class BaseDataSource:
 	def _log(self, message, *args, **kwargs):
 		"""Facade for logging one-line messages.
 
+		Repetitive messages are sampled: only the first few occurrences of each
+		message template are logged, then every Kth (see LogSampler).
+
 		Args:
 		  message (string): The message to be logged.
 		  *args (list, optional): Any formatting components to be added to the message
@@ -155,12 +285,19 @@ class BaseDataSource:
 		    `level` allows to specify the logging level for this message.
 
 		Returns:
-		  string: The log entry
+		  string: The log entry, or None if it was suppressed
 
 		"""
 
 		level = kwargs.get("level", "info").strip().lower()
 
+		# Only messages that would be logged count towards sampling
+		is_enabled = getattr(self._logger, "is_enabled", None)
+		if is_enabled is not None and not is_enabled(level, self.get_identifier()):
+			return None
+		if not self._log_sampler.allow(level, message):
+			return None
+
 		# Resolve the log level directly to a logger function
 		logger_func = getattr(self._logger, level)
 		return logger_func(message, *args,
@@ -185,22 +322,138 @@ class BaseDataSource:
 		                    degree=1)
 	
 
+	def _log_suppressed_summary(self):
+		"""Logs one line for each message template the sampler suppressed, then
+		starts the sampler over for the next load.
+		"""
+		for (level, message), (seen, suppressed) in self._log_sampler.drain():
+			getattr(self._logger, level)("Suppressed {0} of {1} occurrences of \"{2}\"",
+			                             suppressed, seen, message,
+			                             tag=self.get_identifier())
+
+
+	def _phase(self, name):
+		"""Times a block of work against one of the load phases.
+
+		Args:
+		  name (string): One of PHASES
+
+		Returns:
+		  A context manager
+
+		"""
+		return _PhaseTimer(self._report, name)
+
+
 	def _save(self, data):
 		"""Saves a single record to the data warehouse as a JSON document.
 
 		Args:
 		  data (mixed): An object that can be JSON-serialized.
 
+		Records are buffered and written in batches of `_batch_size`; anything
+		left over is written when the report is finalized.  The batch is
+		written early if buffering another record would go over the memory
+		budget.  Until a batch has been written, records are estimated at the
+		first one's serialized size.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		if self._sample_bytes is None:
+			try:
+				self._sample_bytes = len(cdls.serialization.encode(data))
+			except (TypeError, ValueError, AttributeError):
+				self._sample_bytes = 0
+
+		size = int(self._record_bytes or self._sample_bytes)
+		if self._pending and self._budget.over(size):
+			self._flush()
+
+		self._pending.append((data, data.created_on))
+		self._pending_bytes += size
+		self._budget.add(size)
+		self._metric_saved.inc()
+		self._metric_pending.set(len(self._pending))
+		if len(self._pending) >= self._batch_size:
+			self._flush()
+
+
+	def _flush(self):
+		"""Writes all buffered records to the data warehouse.  Records which fail
+		are set aside in WAREHOUSE_REJECTS by the database and counted in the
+		report rather than failing the load.
+
 		Raises:
 		  DatabaseError
 
 		"""
-		self._db.warehouse(data, self.get_identifier(), data.created_on)
+		if not self._pending:
+			return
+
+		pending, self._pending = self._pending, []
+		self._metric_pending.set(0)
+		stats = {}
+		try:
+			with self._span("write_batch", records=len(pending), batch_size=self._batch_size):
+				errors = self._db.warehouse_many(pending, self.get_identifier(), self._serialize_workers, stats)
+		finally:
+			self._budget.release(self._pending_bytes)
+			self._pending_bytes = 0
+			self._metric_in_flight.set(self._budget.in_use)
+
+		report = self._report
+		report.phase_ns["serialize"] += stats.get("serialize_ns", 0)
+		report.phase_ns["write"] += stats.get("write_ns", 0)
+		report.bytes_written += stats.get("bytes_written", 0)
+		self._adapt_batch_size(len(pending), stats)
+		report.batch_size = self._batch_size
+
+		# Rejected records were already counted as successes when they were saved
+		if errors:
+			report.number_rejected += len(errors)
+			report.number_successes -= len(errors)
+			self._log("Rejected {0} of {1} records to WAREHOUSE_REJECTS: {2}",
+			          len(errors), len(pending), errors[0][1],
+			          level="warn")
+
+
+	def _discard_pending(self):
+		"""Drops any buffered records without writing them, releasing their
+		share of the memory budget.
+		"""
+		if not self._pending:
+			return
+
+		self._report.number_successes -= len(self._pending)
+		self._pending = []
+		self._budget.release(self._pending_bytes)
+		self._pending_bytes = 0
+		self._metric_pending.set(0)
+		self._metric_in_flight.set(self._budget.in_use)
+
+
+	def _span(self, name, **args):
+		"""Traces a block of work as a span tagged with this source.
+
+		Args:
+		  name (string): The span name
+		  **args (dict, optional): Annotations to attach to the span
+
+		Returns:
+		  A context manager
+
+		"""
+		return cdls.tracing.span(name, source=self._identifier, **args)
 
 
 	def _start_timer(self):
 		"""Begin keeping track of the processing time. """
-		self._time_started = time.time()
+		self._time_started = time.perf_counter_ns()
+		self._report.start(self._time_started)
+		self._report.memory_budget = self._budget.limit
+		self._budget.reset_peak()
 
 
 	def _update_latest_record_date(self, new_date):
@@ -225,56 +478,685 @@ class LocalFileDataSource(BaseDataSource):
 	data files, moving them to an archive folder upon successful completion of
 	all contained records.
 
+	Supported files are `.json` (a single document or a list of them) and
+	`.jsonl` (one document per line).  Each document is saved as a
+	QueuedRecord dated by its `created_on` field (ISO 8601), or by the file's
+	mtime if it doesn't have one.
+
+	Besides loading whatever's queued on `execute`, the queue can be watched
+	(see `watch`) so that files are ingested as soon as they land.
+
 	Args:
 	  config (dict): The configuration parameter node for this datasource
 
 	Attributes:
 	  _queue (string): The path to the queue folder.
 	  _archive (string): The path to the archive folder.
+	  _watch_settle (float): Seconds a file must go unchanged before it's
+	    picked up in watch mode.
+	  _watch_poll_interval (float): Seconds between checks when inotify isn't
+	    available.
+	  _watch_concurrency (int): The most files ingested at once in watch mode.
+	  _ingest_lock (Lock): Serializes saving records and updating the report.
 
 	"""
 	def __init__(self, config):
 		super().__init__(config)
 		self._queue = self._get_config_param("queue_path", True)
 		self._archive = self._get_config_param("archive_path", True)
+		self._watch_settle        = float(self._get_config_param("watch_settle_seconds", default=cdls.config.WATCH_SETTLE_SECONDS))
+		self._watch_poll_interval = float(self._get_config_param("watch_poll_interval", default=cdls.config.WATCH_POLL_INTERVAL))
+		self._watch_concurrency   = int(self._get_config_param("watch_concurrency", default=cdls.config.WATCH_CONCURRENCY))
+		self._ingest_lock         = threading.Lock()
+
+	def execute(self):
+		"""Executes the data load operation.
+
+		Returns:
+		  LoadReport: Contains the metrics for this load operation
+
+		Raises:
+		  DatabaseError
+
+		"""
+		self._start_timer()
+
+		with self._phase("discover"):
+			try:
+				paths = sorted(entry.path for entry in os.scandir(self._queue) if entry.is_file() and self._is_supported(entry.path))
+			except FileNotFoundError:
+				self._log("Queue folder '{0}' doesn't exist", self._queue, level="warn")
+				paths = []
+
+		successful = True
+		with self._span("extract", files=len(paths)):
+			for path in paths:
+				size = _file_size(path)
+				self._budget.add(size)
+				successful = self._ingest_file(path, size) and successful
+
+		return self._finalize_report(successful)
+
+	def watch(self, stop):
+		"""Ingests files as they land in the queue until `stop` is set.
+
+		Anything already queued is ingested first.  Up to `_watch_concurrency`
+		files are read and parsed at once (fewer if their sizes add up to more
+		than the memory budget), and each file's records are written as soon
+		as it's been parsed.  Files which fail are left in the queue
+		and retried if they change.
+
+		Args:
+		  stop (Event): Set to stop watching.
+
+		Returns:
+		  LoadReport: Covers everything ingested while watching, and is only
+		    successful if no file failed.
+
+		Raises:
+		  DatabaseError
+		  OSError
+
+		"""
+		self._start_timer()
+		os.makedirs(self._queue, exist_ok=True)
+
+		slots = threading.BoundedSemaphore(self._watch_concurrency)
+		with cdls.watching.Watcher(self._queue, self._watch_settle, self._watch_poll_interval, cdls.config.WATCH_INOTIFY) as watcher, \
+		     concurrent.futures.ThreadPoolExecutor(max_workers=self._watch_concurrency, thread_name_prefix="cdls-watch") as executor:
+			self._log("Watching '{0}' ({1})", self._queue, watcher.mode)
+
+			failures = []
+			def ingest(path, size):
+				try:
+					if not self._ingest_file(path, size):
+						watcher.forget(path)
+						failures.append(path)
+				except Exception as e:
+					watcher.forget(path)
+					failures.append(path)
+					with self._ingest_lock:
+						self._log("Failed to ingest '{0}': {1}", os.path.basename(path), e, level="error")
+				finally:
+					slots.release()
+
+			while not stop.is_set():
+				for path in watcher.wait(min(self._watch_poll_interval, 0.5)):
+					if not self._is_supported(path):
+						continue
+					# Wait for a free slot, and for room in the memory budget, rather
+					# than queueing up files
+					slots.acquire()
+					size = _file_size(path)
+					self._budget.acquire(size)
+					executor.submit(ingest, path, size)
+
+		if failures:
+			self._log("{0} files failed to ingest while watching", len(failures), level="warn")
+		return self._finalize_report(not failures)
+
+	def _ingest_file(self, path, held=0):
+		"""Reads, parses and saves a queued file's records, then archives it.
+
+		The records are written out before the file is archived, so a failed
+		write leaves the file in the queue.
+
+		Args:
+		  path (string): The file.
+		  held (int, optional): Bytes held in the memory budget for the file,
+		    released once it's been parsed so that its records can be
+		    buffered in their place.
+
+		Returns:
+		  bool: Whether the file was ingested.
+
+		Raises:
+		  DatabaseError
+
+		"""
+		name = os.path.basename(path)
+		try:
+			time_started = time.perf_counter_ns()
+			with open(path, "rb") as fp:
+				data = fp.read()
+				mtime = datetime.datetime.fromtimestamp(os.fstat(fp.fileno()).st_mtime)
+			time_read = time.perf_counter_ns()
+			documents = _parse_queued_file(name, data)
+			bytes_read, data = len(data), None
+			time_parsed = time.perf_counter_ns()
+		except (OSError, ValueError) as e:
+			with self._ingest_lock:
+				self._log("Couldn't read '{0}': {1}", name, e, level="error")
+			return False
+		finally:
+			self._budget.release(held)
+
+		with self._ingest_lock:
+			self._report.phase_ns["read"] += time_read - time_started
+			self._report.phase_ns["parse"] += time_parsed - time_read
+			self._increment_bytes_read(bytes_read)
+
+			with self._span("ingest_file", file=name, records=len(documents)):
+				try:
+					for document in documents:
+						record = QueuedRecord()
+						record.__dict__.update(document if isinstance(document, dict) else {"value": document})
+						record.created_on = _document_date(document, "created_on", mtime)
+
+						self._save(record)
+						self._increment_number_processed()
+						self._increment_number_successes()
+						self._update_latest_record_date(record.created_on)
+
+					self._flush()
+				finally:
+					# The file stays queued if it failed part way, so what's left of
+					# it mustn't be written out with the next file's records
+					self._discard_pending()
+
+			with self._phase("archive"):
+				os.makedirs(self._archive, exist_ok=True)
+				destination = os.path.join(self._archive, name)
+				if os.path.exists(destination):
+					destination += "." + datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+				shutil.move(path, destination)
+
+			self._log("Ingested {0} records from '{1}'", len(documents), name)
+		return True
+
+	def _is_supported(self, path):
+		return path.endswith((".json", ".jsonl"))
+
+
+class HttpDataSource(BaseDataSource):
+	"""Pulls documents from an HTTP API.
+
+	Responses are JSON (a top-level array of documents, or a single one) or
+	JSON Lines, and are streamed straight into the extractor as they arrive
+	rather than read whole.  Connections are kept alive and reused between
+	pages and loads, with at most `connections_per_host` requests in flight
+	to the host at once.
+
+	With a `page_param`, pages are numbered from `first_page` and up to
+	`concurrency` of them are fetched at once; paging stops at the first page
+	that comes back empty, or short of `page_size` when the page size is sent
+	in `page_size_param`.  Each page's documents are held until it's their
+	turn to be saved, so that records are saved in page order.  Without one,
+	the single response's documents are saved as they stream in.
+
+	With a `watermark_field`, loads are incremental: the highest value of that
+	field seen by the last successful load is sent in `watermark_param` and
+	the API is expected to only return documents past it.
+
+	Args:
+	  config (dict): The configuration parameter node for this datasource
+
+	Attributes:
+	  _url (string): The API endpoint.
+	  _format (string): `json` or `jsonl` (see `cdls.extractors`).
+	  _headers (dict): Extra request headers.
+	  _page_param (string): The query parameter that takes the page number.
+	  _first_page (int): The number of the first page.
+	  _page_size_param (string): The query parameter that takes the page size.
+	  _page_size (int): The page size to ask for.
+	  _concurrency (int): The most pages fetched at once.
+	  _watermark_field (string): The document field (a dotted path) that
+	    increases with each change.
+	  _watermark_param (string): The query parameter that takes the watermark.
+	  _date_field (string): The document field (a dotted path) holding its
+	    ISO 8601 record date; documents without one are dated now.
+	  _read_lock (Lock): Serializes adding up what the page fetches read.
+	  _pool (ConnectionPool): Kept-alive connections.
+
+	"""
+	def __init__(self, config):
+		super().__init__(config)
+		self._url             = self._get_config_param("url", True)
+		self._format          = self._get_config_param("format", default="json")
+		self._headers         = dict(self._get_config_param("headers", default={}))
+		self._page_param      = self._get_config_param("page_param")
+		self._first_page      = int(self._get_config_param("first_page", default=1))
+		self._page_size_param = self._get_config_param("page_size_param")
+		self._page_size       = int(self._get_config_param("page_size", default=cdls.config.HTTP_PAGE_SIZE))
+		self._concurrency     = int(self._get_config_param("concurrency", default=cdls.config.HTTP_CONCURRENCY))
+		self._watermark_field = self._get_config_param("watermark_field")
+		self._watermark_param = self._get_config_param("watermark_param", default="since")
+		self._date_field      = self._get_config_param("date_field", default="created_on")
+		self._read_lock       = threading.Lock()
+		self._pool            = cdls.pooling.ConnectionPool(
+			int(self._get_config_param("connections_per_host", default=cdls.config.HTTP_CONNECTIONS_PER_HOST)),
+			float(self._get_config_param("timeout", default=cdls.config.HTTP_TIMEOUT)))
+
+		if self._format not in cdls.extractors.EXTRACTORS:
+			raise SourceConfigurationError(
+				"Unknown format '{}'".format(self._format),
+				self._config)
 
 	def execute(self):
 		"""Executes the data load operation.
 
+		The watermark only moves forward once everything fetched has been
+		written, so a failed load is fetched again in full next time.
+
 		Returns:
 		  LoadReport: Contains the metrics for this load operation
 
 		Raises:
 		  DatabaseError
+
+		"""
+		self._start_timer()
+
+		watermark = None
+		if self._watermark_field and hasattr(self._db, "get_watermark"):
+			watermark = self._db.get_watermark(self._identifier)
+		latest = watermark
+
+		try:
+			with self._span("extract", url=self._url, watermark=watermark):
+				for documents in self._fetch_pages(watermark):
+					for document in documents:
+						record = HttpRecord()
+						record.__dict__.update(document if isinstance(document, dict) else {"value": document})
+						record.created_on = _document_date(document, self._date_field, datetime.datetime.now())
+
+						self._save(record)
+						self._increment_number_processed()
+						self._increment_number_successes()
+						self._update_latest_record_date(record.created_on)
+
+						if self._watermark_field:
+							latest = _later(latest, _document_field(document, self._watermark_field))
+		except ExtractError as e:
+			self._log("Failed to load from '{0}': {1}", self._url, e, level="error")
+			return self._finalize_report(False)
+
+		report = self._finalize_report(True)
+		if latest != watermark and hasattr(self._db, "set_watermark"):
+			try:
+				self._db.set_watermark(self._identifier, latest)
+			except DatabaseError as e:
+				self._log("Failed to move the watermark to {0}: {1}", latest, e, level="error")
+				report.successful = False
+			else:
+				self._log("Watermark is now {0}", latest)
+		return report
+
+	def _count_read(self, reader):
+		"""Adds a finished response's bytes and network time to the report. """
+		with self._read_lock:
+			self._increment_bytes_read(reader.count)
+			self._report.phase_ns["read"] += reader.elapsed_ns
+
+	def _fetch_pages(self, watermark):
+		"""Yields each page's documents, in page order.
+
+		Raises:
 		  ExtractError
 
 		"""
+		params = {}
+		if watermark is not None:
+			params[self._watermark_param] = watermark
+
+		if not self._page_param:
+			yield self._stream(self._page_url(params))
+			return
+
+		if self._page_size_param:
+			params[self._page_size_param] = self._page_size
+
+		def fetch(url):
+			held = []
+			documents = list(self._stream(url, held))
+			return (documents, sum(held))
+
+		pages = collections.deque()
+		number = self._first_page
+		page_bytes = 0
+		try:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="cdls-http") as executor:
+				try:
+					while True:
+						# Keep the next few pages in flight while this one is saved, as
+						# long as there's room for them in the memory budget
+						while len(pages) < self._concurrency and not (pages and self._budget.over(page_bytes)):
+							pages.append(executor.submit(fetch, self._page_url(dict(params, **{self._page_param: number}))))
+							number += 1
+
+						(documents, size) = pages.popleft().result()
+						page_bytes = max(page_bytes, size)
+						try:
+							if documents:
+								yield documents
+						finally:
+							self._budget.release(size)
+						if not documents or (self._page_size_param and len(documents) < self._page_size):
+							return
+				finally:
+					for page in pages:
+						page.cancel()
+		finally:
+			# Let go of pages fetched after paging stopped
+			for page in pages:
+				if not page.cancelled() and not page.exception():
+					self._budget.release(page.result()[1])
+
+	def _page_url(self, params):
+		"""Adds query parameters to the configured URL. """
+		parts = urllib.parse.urlsplit(self._url)
+		query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True) + sorted((key, str(value)) for key, value in params.items())
+		return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+	def _stream(self, url, held=None):
+		"""Yields a response's documents as they're read.
+
+		Args:
+		  url (string)
+		  held (list, optional): If given, the bytes read are held against the
+		    memory budget once the response is finished, and appended to this
+		    for the caller to release.
+
+		Raises:
+		  ExtractError
+
+		"""
+		with self._span("fetch", url=url):
+			with self._pool.request(url, self._headers) as response:
+				if response.status != 200:
+					raise ExtractError("GET {} returned {} {}".format(url, response.status, response.reason))
+
+				reader = _CountingReader(response)
+				try:
+					yield from cdls.extractors.extract(self._format, reader)
+				except (OSError, http.client.HTTPException) as e:
+					raise ExtractError("GET {} failed: {}".format(url, e)) from e
+
+		self._count_read(reader)
+		if held is not None:
+			self._budget.add(reader.count)
+			held.append(reader.count)
+
+
+class SqlDataSource(BaseDataSource):
+	"""Pulls rows from a query against another database, through any DB-API
+	driver (SQLite by default).
+
+	Rows are paged through by `key_column`, which has to increase
+	monotonically: each page asks for the rows past the last key seen
+	(`WHERE key > ? ORDER BY key LIMIT ?`), so a page costs the same however
+	far into the table it starts.  Each page is streamed with `fetchmany`
+	into batched warehouse writes, then its last key is committed as the
+	source's watermark, so a load that fails part way (and the next load)
+	picks up from the last committed page.  Rows from a page that was only
+	partly written are pulled again.
+
+	Args:
+	  config (dict): The configuration parameter node for this datasource
+
+	Attributes:
+	  _driver (module): The DB-API module.
+	  _database (string): The connection target (for SQLite, the file path).
+	  _connect_args (dict): Extra arguments for the driver's `connect`.
+	  _query (string): The query to pull rows from.
+	  _key_column (string): The monotonically increasing column to page by.
+	  _key_type (string): The key's type (one of `_KEY_TYPES`), which decides
+	    how it's kept as a watermark; `decimal` and `timestamp` keys are
+	    stored as strings and converted back when resuming.
+	  _date_column (string): The column holding the record date (a datetime
+	    or ISO 8601 string); rows without one are dated now.
+	  _page_size (int): Rows per page.
+	  _fetch_size (int): Rows per `fetchmany`.
+
+	"""
+	def __init__(self, config):
+		super().__init__(config)
+		self._database     = self._get_config_param("database", True)
+		self._connect_args = dict(self._get_config_param("connect_args", default={}))
+		self._query        = self._get_config_param("query", True)
+		self._key_column   = self._get_config_param("key_column", True)
+		self._key_type     = self._get_config_param("key_type", default="integer")
+		self._date_column  = self._get_config_param("date_column")
+		self._page_size    = int(self._get_config_param("page_size", default=cdls.config.SQL_PAGE_SIZE))
+		self._fetch_size   = int(self._get_config_param("fetch_size", default=cdls.config.SQL_FETCH_SIZE))
+
+		driver = self._get_config_param("driver", default="sqlite3")
+		try:
+			self._driver = importlib.import_module(driver)
+		except ImportError as e:
+			raise SourceConfigurationError("Can't import driver '{}': {}".format(driver, e), self._config) from e
+
+		if not _IDENTIFIER.match(self._key_column):
+			raise SourceConfigurationError(
+				"Invalid key_column '{}'".format(self._key_column),
+				self._config)
+
+		if self._key_type not in _KEY_TYPES:
+			raise SourceConfigurationError(
+				"Unsupported key_type '{}' (expected one of {})".format(self._key_type, ", ".join(sorted(_KEY_TYPES))),
+				self._config)
+
+	def execute(self):
+		"""Executes the data load operation.
+
+		Returns:
+		  LoadReport: Contains the metrics for this load operation
+
+		Raises:
+		  DatabaseError
+
+		"""
+		self._start_timer()
+
+		key = self._db.get_watermark(self._identifier) if hasattr(self._db, "get_watermark") else None
+		try:
+			key = None if key is None else _KEY_TYPES[self._key_type][1](key)
+		except (TypeError, ValueError, ArithmeticError) as e:
+			self._log("Watermark {0!r} isn't a valid {1} key: {2}", key, self._key_type, e, level="error")
+			return self._finalize_report(False)
+
+		try:
+			with self._phase("read"):
+				connection = self._driver.connect(self._database, **self._connect_args)
+		except self._driver.Error as e:
+			self._log("Couldn't connect to '{0}': {1}", self._database, e, level="error")
+			return self._finalize_report(False)
+
+		try:
+			with self._span("extract", database=self._database, resume_after=key):
+				while True:
+					(rows, key) = self._load_page(connection, key)
+					if rows < self._page_size:
+						break
+		except self._driver.Error as e:
+			self._log("Query failed after key {0}: {1}", key, e, level="error")
+			return self._finalize_report(False)
+		except (TypeError, ValueError, ArithmeticError) as e:
+			self._log("Key after {0} isn't a valid {1}: {2}", key, self._key_type, e, level="error")
+			return self._finalize_report(False)
+		finally:
+			connection.close()
+
+		return self._finalize_report(True)
+
+	def _load_page(self, connection, key):
+		"""Saves the page of rows after `key`, then commits its last key.
+
+		Returns:
+		  tuple: (rows loaded, the page's last key)
+
+		Raises:
+		  DatabaseError
+		  TypeError, ValueError, ArithmeticError: A key isn't of `_key_type`.
+
+		"""
+		(query, params) = self._page_query(key)
+		cursor = connection.cursor()
+		try:
+			with self._phase("read"):
+				cursor.execute(query, params)
+			columns = [column[0] for column in cursor.description]
+			key_index = columns.index(self._key_column)
+
+			count = 0
+			with self._span("load_page", after=key):
+				while True:
+					with self._phase("read"):
+						rows = cursor.fetchmany(self._fetch_size)
+					if not rows:
+						break
+
+					# Check the key converts before saving anything it covers
+					watermark = _KEY_TYPES[self._key_type][0](rows[-1][key_index])
+
+					for row in rows:
+						record = SqlRecord()
+						record.__dict__.update(zip(columns, row))
+						record.created_on = _document_date(record.__dict__, self._date_column, datetime.datetime.now()) if self._date_column else datetime.datetime.now()
+
+						self._save(record)
+						self._increment_number_processed()
+						self._increment_number_successes()
+						self._update_latest_record_date(record.created_on)
+
+					key = rows[-1][key_index]
+					count += len(rows)
+		finally:
+			cursor.close()
+
+		# The page is only committed once it's in the warehouse
+		if count:
+			self._flush()
+			if hasattr(self._db, "set_watermark"):
+				self._db.set_watermark(self._identifier, watermark)
+		return (count, key)
+
+	def _page_query(self, key):
+		"""Returns the query and parameters for the page after `key` (None for
+		the first page), in the driver's parameter style.
+		"""
+		style = getattr(self._driver, "paramstyle", "qmark")
+		names = ["after", "limit"] if key is not None else ["limit"]
+		markers = {
+			"qmark":    ["?" for name in names],
+			"numeric":  [":{}".format(n) for n, name in enumerate(names, 1)],
+			"named":    [":" + name for name in names],
+			"format":   ["%s" for name in names],
+			"pyformat": ["%({})s".format(name) for name in names]
+		}[style]
+
+		query = "SELECT * FROM ({}) AS cdls_source".format(self._query)
+		if key is not None:
+			query += " WHERE {} > {}".format(self._key_column, markers[0])
+		query += " ORDER BY {} LIMIT {}".format(self._key_column, markers[-1])
+
+		values = [key, self._page_size] if key is not None else [self._page_size]
+		if style in ("named", "pyformat"):
+			return (query, dict(zip(names, values)))
+		return (query, values)
+
+
+class SyntheticDataSource(BaseDataSource):
+	"""Generates configurable fake records, for benchmarking and testing the
+	rest of the load pipeline.
+
+	Args:
+	  config (dict): The configuration parameter node for this datasource
+
+	Attributes:
+	  _record_count (int): How many records each load generates.
+	  _payload_size (int): Characters in each record's payload.
+	  _field_count (int): Extra string fields on each record.
+	  _date_distribution (string): How record dates are spread; "now" stamps
+	    every record with the current time, "sequential" spaces them evenly
+	    across the span and "uniform" picks them at random within it.
+	  _date_span (timedelta): The span of time record dates fall in, ending now.
+	  _seed (int): Seed for the random date distribution.
+
+	"""
+	def __init__(self, config):
+		super().__init__(config)
+		self._record_count      = int(self._get_config_param("record_count", default=1000))
+		self._payload_size      = int(self._get_config_param("payload_size", default=256))
+		self._field_count       = int(self._get_config_param("field_count", default=8))
+		self._date_distribution = self._get_config_param("date_distribution", default="now")
+		self._date_span         = datetime.timedelta(days=float(self._get_config_param("date_span_days", default=30)))
+		self._seed              = self._get_config_param("seed", default=0)
+
+		if self._date_distribution not in ("now", "sequential", "uniform"):
+			raise SourceConfigurationError(
+				"Unknown date_distribution '{}'".format(self._date_distribution),
+				self._config)
+
+	def execute(self):
+		"""Generates and saves `record_count` records.
+
+		Returns:
+		  LoadReport: Contains the metrics for this load operation
 
-		class FakeData:
-			pass
+		Raises:
+		  DatabaseError
 
-		# Do some fake stuff for now
+		"""
 		self._start_timer()
-		self._logbanner("warn", "Nothing's actually happening here; we just block for a few seconds and return some fake metrics to show off how the thing works.")
-		
-		for i in range(2):
-			fake_data = FakeData()
-			fake_data.id = i
-			fake_data.title = "lorem ipsum"
-			fake_data.payload = "this is some fake data"
-			fake_data.created_on = datetime.datetime.now()
 
-			self._save(fake_data)
+		filler = ("lorem ipsum dolor sit amet " * (self._payload_size // 27 + 1))[:self._payload_size]
+		field_names = ["field_{:02d}".format(n) for n in range(self._field_count)]
+		dates = self._generate_dates()
 
-			self._log("Found fake record #{0:03d}", i)
-			self._increment_number_processed()
-			self._increment_number_successes()
+		with self._span("extract", records=self._record_count):
+			for i in range(self._record_count):
+				record = SyntheticRecord()
+				record.id = i
+				record.payload = filler
+				for name in field_names:
+					setattr(record, name, "{}-{}".format(name, i))
+				record.created_on = dates[i] if dates else datetime.datetime.now()
 
-		# Pretend something's take a while
-		time.sleep(0.125)
+				self._save(record)
+
+				self._log("Generated synthetic record #{0}", i, level="debug")
+				self._increment_number_processed()
+				self._increment_number_successes()
+				self._update_latest_record_date(record.created_on)
 
 		return self._finalize_report(True)
 
+	def _generate_dates(self):
+		"""Returns the record dates up front, or None for the "now" distribution. """
+		if self._date_distribution == "now":
+			return None
+
+		end = datetime.datetime.now()
+		start = end - self._date_span
+		if self._date_distribution == "sequential":
+			step = self._date_span / max(self._record_count, 1)
+			return [start + step * i for i in range(self._record_count)]
+
+		rng = random.Random(self._seed)
+		seconds = self._date_span.total_seconds()
+		return [start + datetime.timedelta(seconds=rng.uniform(0, seconds)) for i in range(self._record_count)]
+
+
+class SyntheticRecord:
+	"""A record generated by SyntheticDataSource. """
+	pass
+
+
+class QueuedRecord:
+	"""A record read from a LocalFileDataSource queue file. """
+	pass
+
+
+class HttpRecord:
+	"""A record pulled by HttpDataSource. """
+	pass
+
+
+class SqlRecord:
+	"""A row pulled by SqlDataSource. """
+	pass
+
 
 class LoadReport:
 	"""A data struct used to contain load metrics for a load operation.
@@ -287,28 +1169,404 @@ class LoadReport:
 	  latest_record (datetime): The date of the latest record.
 	  number_processed (int): The total number of records processed by this load operation.
 	  number_successes (int): The number of records successfully processed by this load operation.
+	  number_rejected (int): The number of records sent to WAREHOUSE_REJECTS.
 	  successful (bool): True if the operation was determined to be a success
 	  time_elapsed (float): The number of seconds this load operation took.
+	  time_elapsed_ns (int): The number of nanoseconds this load operation took.
+	  phase_ns (dict): Nanoseconds spent in each of PHASES.
+	  bytes_read (int): Bytes read from the source.
+	  bytes_written (int): Bytes of JSON written to the warehouse.
+	  peak_rss (int): Peak resident set size of the process in kilobytes, or
+	    -1 where that can't be measured.
+	  batch_size (int): Records per warehouse batch, as of the last batch.
+	  memory_budget (int): The most bytes the load may hold (0 for no limit).
+	  peak_in_flight (int): The most bytes the load held at once (records
+	    are estimated at their serialized size).
+	  latency (LatencyHistogram): Per-record latencies in nanoseconds.
 
 	"""
+	__slots__ = ("identifier", "latest_record", "number_processed",
+	             "number_successes", "number_rejected", "successful", "time_elapsed",
+	             "time_elapsed_ns", "phase_ns", "bytes_read", "bytes_written",
+	             "peak_rss", "batch_size", "memory_budget", "peak_in_flight",
+	             "latency", "_last_mark_ns")
+
 	def __init__(self, datasource):
 		self.identifier       = datasource.get_identifier()
 		self.latest_record    = datetime.datetime.min
 		self.number_processed = int()
 		self.number_successes = int()
+		self.number_rejected  = int()
 		self.successful       = False
 		self.time_elapsed     = float(-1)
+		self.time_elapsed_ns  = int(-1)
+		self.phase_ns         = dict.fromkeys(PHASES, 0)
+		self.bytes_read       = int()
+		self.bytes_written    = int()
+		self.peak_rss         = int(-1)
+		self.batch_size       = int()
+		self.memory_budget    = int()
+		self.peak_in_flight   = int()
+		self.latency          = LatencyHistogram()
+		self._last_mark_ns    = int()
 
 	def __str__(self):
-		values = {
+		values = self.as_dict()
+		values.update({
 			"passfail":   "OK" if self.successful else "FAIL",
-			"identifier": self.identifier,
 			"successes":  self.number_successes,
+			"rejected":   self.number_rejected,
 			"processed":  self.number_processed,
-			"elapsed":    self.time_elapsed
-		}
+			"elapsed":    self.time_elapsed,
+			"phases":     " ".join("{}={:0.3f}s".format(k, v / 1e9) for k, v in self.phase_ns.items())
+		})
 		return _REPORT_FORMAT.format(**values)
 
+	def as_dict(self):
+		"""Returns the report as a dict of plain values. """
+		return {
+			"identifier":       self.identifier,
+			"successful":       self.successful,
+			"latest_record":    self.latest_record.isoformat(),
+			"number_processed": self.number_processed,
+			"number_successes": self.number_successes,
+			"number_rejected":  self.number_rejected,
+			"time_elapsed":     self.time_elapsed,
+			"phase_seconds":    {k: v / 1e9 for k, v in self.phase_ns.items()},
+			"bytes_read":       self.bytes_read,
+			"bytes_written":    self.bytes_written,
+			"rate":             self.records_per_second(),
+			"p50":              self.latency.percentile(50) / 1e6,
+			"p99":              self.latency.percentile(99) / 1e6,
+			"peak_rss":         self.peak_rss,
+			"batch_size":       self.batch_size,
+			"memory_budget":    self.memory_budget,
+			"peak_in_flight":   self.peak_in_flight
+		}
+
+	def finish(self, elapsed_ns):
+		"""Stops the clock on this report.
+
+		Args:
+		  elapsed_ns (int): Nanoseconds the load operation took
+
+		"""
+		self.time_elapsed_ns = elapsed_ns
+		self.time_elapsed = elapsed_ns / 1e9
+		self.peak_rss = _get_peak_rss()
+
+	def mark_record(self, now_ns):
+		"""Counts a processed record, timing it against the previous one.
+
+		Args:
+		  now_ns (int): The current perf_counter_ns
+
+		"""
+		self.number_processed += 1
+		self.latency.add(now_ns - self._last_mark_ns)
+		self._last_mark_ns = now_ns
+
+	def records_per_second(self):
+		"""Returns the processing throughput (0 until the report is finished). """
+		if self.time_elapsed_ns <= 0:
+			return float(0)
+		return self.number_processed / (self.time_elapsed_ns / 1e9)
+
+	def start(self, now_ns):
+		"""Starts the clock for per-record latencies.
+
+		Args:
+		  now_ns (int): The current perf_counter_ns
+
+		"""
+		self._last_mark_ns = now_ns
+
+	def to_json(self):
+		"""Returns the report as a JSON document. """
+		return json.dumps(self.as_dict(), sort_keys=True)
+
+
+class LogSampler:
+	"""Rate limiter for repetitive log messages.
+
+	Counts occurrences of each (level, message template) pair, letting the
+	first `first` through and then only every `every`th.
+
+	Args:
+	  first (int): How many occurrences of a template to always log.
+	  every (int): After that, log one in this many (0 logs none).
+
+	Attributes:
+	  _counts (dict): (level, message) to [seen, suppressed]
+
+	"""
+	__slots__ = ("_first", "_every", "_counts")
+
+	def __init__(self, first, every):
+		self._first  = first
+		self._every  = every
+		self._counts = {}
+
+	def allow(self, level, message):
+		"""Counts an occurrence and returns True if it should be logged. """
+		try:
+			counts = self._counts[(level, message)]
+		except KeyError:
+			counts = self._counts[(level, message)] = [0, 0]
+
+		counts[0] += 1
+		seen = counts[0]
+		if seen <= self._first or (self._every and (seen - self._first) % self._every == 0):
+			return True
+
+		counts[1] += 1
+		return False
+
+	def drain(self):
+		"""Returns ((level, message), (seen, suppressed)) for every template
+		that had occurrences suppressed, and resets all counts.
+		"""
+		counts, self._counts = self._counts, {}
+		return [(key, tuple(value)) for key, value in counts.items() if value[1]]
+
+
+class MemoryBudget:
+	"""Keeps count of the bytes a load holds in memory against a limit.
+
+	Readers reading ahead `acquire` room first and wait while the load is
+	over the limit, which pauses them until earlier data has been written.
+	Data that's already been read is counted with `add`, which never waits.
+	Anything fits when nothing else is held, so a single oversized item
+	can't wait forever.
+
+	Args:
+	  limit (int): The most bytes to hold (0 for no limit).
+
+	Attributes:
+	  limit (int): The most bytes to hold.
+	  in_use (int): Bytes held right now.
+	  peak (int): The most bytes held at once.
+	  waits (int): How many times a reader had to wait.
+
+	"""
+	__slots__ = ("limit", "in_use", "peak", "waits", "_condition")
+
+	def __init__(self, limit):
+		self.limit      = limit
+		self.in_use     = int()
+		self.peak       = int()
+		self.waits      = int()
+		self._condition = threading.Condition()
+
+	def acquire(self, size):
+		"""Waits until `size` more bytes fit, then holds them. """
+		with self._condition:
+			if self.over(size):
+				self.waits += 1
+				while self.over(size):
+					self._condition.wait()
+			self._hold(size)
+
+	def add(self, size):
+		"""Holds `size` more bytes without waiting. """
+		with self._condition:
+			self._hold(size)
+
+	def over(self, size):
+		"""Returns whether holding `size` more bytes would go over the limit
+		(never when nothing is held).
+		"""
+		return bool(self.limit and self.in_use and self.in_use + size > self.limit)
+
+	def release(self, size):
+		with self._condition:
+			self.in_use -= size
+			self._condition.notify_all()
+
+	def reset_peak(self):
+		with self._condition:
+			self.peak = self.in_use
+
+	def _hold(self, size):
+		self.in_use += size
+		self.peak = max(self.peak, self.in_use)
+
+
+class LatencyHistogram:
+	"""A compact log-linear histogram of nanosecond durations.
+
+	Each power of two is split into 8 sub-buckets, so percentiles are accurate
+	to within 12.5% while only populated buckets take up any memory.
+
+	Attributes:
+	  count (int): The number of values recorded
+	  _buckets (dict): Bucket index to count
+
+	"""
+	__slots__ = ("count", "_buckets")
+
+	def __init__(self):
+		self.count    = int()
+		self._buckets = {}
+
+	def add(self, value):
+		"""Records a single duration in nanoseconds. """
+		value = max(int(value), 0)
+		if value < 8:
+			index = value
+		else:
+			exponent = value.bit_length() - 1
+			index = (exponent - 2) * 8 + ((value >> (exponent - 3)) & 7)
+
+		self._buckets[index] = self._buckets.get(index, 0) + 1
+		self.count += 1
+
+	def percentile(self, q):
+		"""Returns the upper bound of the bucket holding the q-th percentile
+		(0 if nothing has been recorded).
+		"""
+		if not self.count:
+			return 0
+
+		rank = max(1, -(-self.count * q // 100))
+		seen = 0
+		for index in sorted(self._buckets):
+			seen += self._buckets[index]
+			if seen >= rank:
+				return _bucket_upper_bound(index)
+
+		return _bucket_upper_bound(max(self._buckets))
+
+
+class _CountingReader:
+	"""Wraps a binary stream, counting the bytes read from it and the time
+	spent waiting on them.
+	"""
+	__slots__ = ("count", "elapsed_ns", "_fp")
+
+	def __init__(self, fp):
+		self.count      = 0
+		self.elapsed_ns = 0
+		self._fp        = fp
+
+	def __iter__(self):
+		while True:
+			line = self.readline()
+			if not line:
+				return
+			yield line
+
+	def read(self, size=-1):
+		time_started = time.perf_counter_ns()
+		data = self._fp.read(size)
+		self.elapsed_ns += time.perf_counter_ns() - time_started
+		self.count += len(data)
+		return data
+
+	def readline(self):
+		time_started = time.perf_counter_ns()
+		line = self._fp.readline()
+		self.elapsed_ns += time.perf_counter_ns() - time_started
+		self.count += len(line)
+		return line
+
+
+class _PhaseTimer:
+	"""Context manager which adds its elapsed time to a report phase. """
+	__slots__ = ("_report", "_name", "_time_started")
+
+	def __init__(self, report, name):
+		self._report = report
+		self._name = name
+
+	def __enter__(self):
+		self._time_started = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *exc_info):
+		self._report.phase_ns[self._name] += time.perf_counter_ns() - self._time_started
+
+
+def _bucket_upper_bound(index):
+	"""Returns the largest value which lands in a LatencyHistogram bucket. """
+	if index < 8:
+		return index
+	exponent = index // 8 + 2
+	return ((8 + index % 8 + 1) << (exponent - 3)) - 1
+
+
+def _later(watermark, value):
+	"""Returns whichever of two watermarks is later (None is earliest).
+
+	Raises:
+	  ExtractError
+
+	"""
+	if value is None or watermark is None:
+		return watermark if value is None else value
+	try:
+		return max(watermark, value)
+	except TypeError:
+		raise ExtractError("Can't compare watermarks {!r} and {!r}".format(watermark, value))
+
+
+def _file_size(path):
+	"""Returns a file's size, or 0 if it's gone. """
+	try:
+		return os.path.getsize(path)
+	except OSError:
+		return 0
+
+
+def _get_peak_rss():
+	"""Returns the peak resident set size of this process in kilobytes. """
+	if resource is None:
+		return -1
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# macOS reports ru_maxrss in bytes, Linux and the BSDs in kilobytes
+	if sys.platform == "darwin":
+		return peak // 1024
+	return peak
+
+
+def _parse_queued_file(name, data):
+	"""Parses a queued file's documents.
+
+	Raises:
+	  ValueError
+
+	"""
+	text = data.decode("utf-8")
+	if name.endswith(".jsonl"):
+		return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+	documents = json.loads(text)
+	return documents if isinstance(documents, list) else [documents]
+
+
+def _document_date(document, path, default):
+	"""Returns the date (a datetime or ISO 8601 string) at a document's field
+	(a dotted path), in local time, or `default` if it doesn't have one.
+	"""
+	value = _document_field(document, path)
+	if isinstance(value, datetime.datetime):
+		return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+	if isinstance(value, str):
+		try:
+			date = datetime.datetime.fromisoformat(value)
+		except ValueError:
+			return default
+		return date.astimezone().replace(tzinfo=None) if date.tzinfo else date
+	return default
+
+
+def _document_field(document, path):
+	"""Returns the value at a document's field (a dotted path), or None. """
+	for key in path.split("."):
+		document = document.get(key) if isinstance(document, dict) else None
+	return document
+
 
 def _string_to_date(datestring):
 	"""Converts a string to a datetime object.
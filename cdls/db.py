@@ -1,24 +1,98 @@
 """
-The database interface for the CDLS.
+The database interface for the CDLS, and its default SQLite storage backend
+(see `cdls.backends.BaseBackend` for the interface).
+
+The warehouse is partitioned by source and by month of RECORD_DATE.  Each
+partition is its own table, created the first time a record lands in it and
+listed in WAREHOUSE_PARTITIONS.  A `WAREHOUSE_SRC_<SOURCE>` view unions each
+source's partitions and the `WAREHOUSE` view unions those, so reads work as
+they would against a single table.  SEQ values come from CDLS_SEQUENCES and
+are unique across every partition, which keeps the change feed ordered.
+Each partition's full-text index (`<partition>_FTS`) and projection table
+(`<partition>_P`) are tables of their own too, so retention drops all three
+rather than deleting rows.
+
+Sources can also be sharded into their own database files (by name with a
+source's `shard` option, or by hash bucket with DB_SHARD_COUNT), each with
+its own writer connection and lock so that loads on different shards don't
+wait on each other.  Each shard has its own partition catalog and views.
+The main connection then acts as a read facade: it attaches every shard and
+a temporary `WAREHOUSE` view unions their `WAREHOUSE` views.  Shard writers
+reserve SEQ values a block at a time (DB_SEQ_BLOCK_SIZE), so across shards
+SEQ follows the order values were reserved in rather than commit order; the
+change feed only reads up to the point where every lower SEQ has been
+committed (see `_seq_horizon`).
 
 Attributes:
   _DBPATH (string): The file path to the sqlite database file.
   _DDL_CREATE_LOADSTATS,
   _DDL_DROP_LOADSTATS,
-  _DDL_CREATE_WAREHOUSE,
-  _DDL_DROP_WAREHOUSE (string): SQL DDL queries.
-  _conn (db): The sqlite3 database connection handle.
+  _DDL_CREATE_PARTITION,
+  _DDL_CREATE_PARTITION_INDEX,
+  _DDL_CREATE_PARTITIONS,
+  _DDL_DROP_PARTITIONS,
+  _DDL_CREATE_SEQUENCES,
+  _DDL_DROP_SEQUENCES,
+  _DDL_CREATE_REJECTS,
+  _DDL_DROP_REJECTS,
+  _DDL_CREATE_CURSORS,
+  _DDL_DROP_CURSORS,
+  _DDL_CREATE_WATERMARKS,
+  _DDL_DROP_WATERMARKS,
+  _DDL_CREATE_FULLTEXT,
+  _DDL_DROP_FULLTEXT (string): SQL DDL queries.
+  _PARTITION_SELECT,
+  _EMPTY_SELECT (string): Building blocks for the warehouse views.
+  _ROW_ERRORS (tuple): sqlite3 errors that are specific to a single row, as
+    opposed to the database as a whole.
+  _METRIC_* (Metric): Write-path metrics.
+  _conn (db): The sqlite3 database connection handle (the read facade).
+  _lock (RLock): Serializes writes through `_conn`.
+  _shards (dict): (connection, lock) writer pairs, keyed by shard.
+  _known_shards (set): Shards which exist on disk.
+  _attached (set): Shards attached to `_conn`.
+  _seq_blocks (dict): [next, end) ranges of SEQ values reserved by each shard
+    writer connection.
+  _fulltext (dict): Whether full-text indexing is available, per connection.
+  _partitions (set): Names of partitions (and their full-text indexes) known
+    to exist.
+  _projected (set): Sources whose projection tables are known to be up to
+    date.
+  _PROJECTION_TYPES (dict): SQLite column type and Python conversion for each
+    supported projection type.
+  _FILTER_OPERATORS (tuple): Comparisons `query_warehouse` accepts.
+  _sources (dict): Per-source warehouse options, keyed by upper-cased source
+    identifier (see `configure_source`).
+  Change (namedtuple): A single warehouse row as returned by the change feed.
+  SearchResult (namedtuple): A single full-text search hit.
+  Record (namedtuple): A warehouse row with its document decoded.
+  _cache (LRUCache): Recently read Records, keyed by GUID and sized by
+    their stored JSON.
+  ExportRange (namedtuple): A partition's rows with SEQ in (low, high], to
+    be exported together (None leaves that end open).
 """
 
+import collections
+import contextlib
 import datetime
+import glob
 import json
 import os
+import re
 import sqlite3
+import threading
+import time
 import uuid
+import zlib
 
+import cdls.backends
+import cdls.caching
 import cdls.config
+import cdls.metrics
+import cdls.serialization
+import cdls.tracing
 
-from cdls.errors import DatabaseError
+from cdls.errors import DatabaseError, SourceConfigurationError
 
 _DBPATH = cdls.config.DB_SQLITE_PATH
 
@@ -36,23 +110,147 @@ CREATE TABLE `CDLS_LOAD_STATS`
 
 _DDL_DROP_LOADSTATS = "DROP TABLE `CDLS_LOAD_STATS`"
 
-_DDL_CREATE_WAREHOUSE = """
-CREATE TABLE `WAREHOUSE`
+_DDL_CREATE_PARTITION = """
+CREATE TABLE `{name}`
 (
-	 `GUID`               TEXT(40)
+	 `SEQ`                INTEGER PRIMARY KEY
+	,`GUID`               TEXT(40)
 	,`SOURCE_IDENTIFIER`  TEXT(64)
 	,`RECORD_DATE`        TEXT(20)
 	,`JSON`               TEXT(16000)
 )
 """
-_DDL_DROP_WAREHOUSE = "DROP TABLE `WAREHOUSE`"
+_DDL_CREATE_PARTITION_INDEX = "CREATE UNIQUE INDEX `{name}_GUID` ON `{name}` (`GUID`)"
+
+_DDL_CREATE_PARTITIONS = """
+CREATE TABLE `WAREHOUSE_PARTITIONS`
+(
+	 `NAME`               TEXT(128) PRIMARY KEY
+	,`SOURCE_IDENTIFIER`  TEXT(64)
+	,`PERIOD`             TEXT(7)
+	,`RANGE_START`        TEXT(26)
+	,`RANGE_END`          TEXT(26)
+	,`CREATED_ON`         TEXT(24)
+)
+"""
+_DDL_DROP_PARTITIONS = "DROP TABLE `WAREHOUSE_PARTITIONS`"
+
+_DDL_CREATE_SEQUENCES = """
+CREATE TABLE `CDLS_SEQUENCES`
+(
+	 `NAME`               TEXT(64) PRIMARY KEY
+	,`VALUE`              INTEGER NOT NULL
+)
+"""
+_DDL_DROP_SEQUENCES = "DROP TABLE `CDLS_SEQUENCES`"
+
+_DDL_CREATE_REJECTS = """
+CREATE TABLE `WAREHOUSE_REJECTS`
+(
+	 `GUID`               TEXT(40)
+	,`SOURCE_IDENTIFIER`  TEXT(64)
+	,`RECORD_DATE`        TEXT(20)
+	,`REJECTED_ON`        TEXT(24)
+	,`ERROR_TYPE`         TEXT(64)
+	,`ERROR_MESSAGE`      TEXT(2000)
+	,`PAYLOAD_TEXT`       TEXT(16000)
+	,`PAYLOAD_REPR`       TEXT(16000)
+	,`REPLAY_COUNT`       INT DEFAULT 0
+)
+"""
+_DDL_DROP_REJECTS = "DROP TABLE `WAREHOUSE_REJECTS`"
+
+_DDL_CREATE_CURSORS = """
+CREATE TABLE `CDLS_CONSUMER_CURSORS`
+(
+	 `CONSUMER`           TEXT(64) PRIMARY KEY
+	,`POSITION`           INTEGER NOT NULL
+	,`UPDATED_ON`         TEXT(24)
+)
+"""
+_DDL_DROP_CURSORS = "DROP TABLE `CDLS_CONSUMER_CURSORS`"
+
+_DDL_CREATE_WATERMARKS = """
+CREATE TABLE `CDLS_WATERMARKS`
+(
+	 `SOURCE_IDENTIFIER`  TEXT(64) PRIMARY KEY
+	,`VALUE`              TEXT(2000) NOT NULL
+	,`UPDATED_ON`         TEXT(24)
+)
+"""
+_DDL_DROP_WATERMARKS = "DROP TABLE `CDLS_WATERMARKS`"
+
+_DDL_CREATE_FULLTEXT = """
+CREATE VIRTUAL TABLE IF NOT EXISTS `{name}` USING fts5
+(
+	 `BODY`
+	,`SOURCE_IDENTIFIER` UNINDEXED
+	,`GUID` UNINDEXED
+)
+"""
+_DDL_DROP_FULLTEXT = "DROP TABLE IF EXISTS `{name}`"
+
+_PARTITION_SELECT = "SELECT `SEQ`, `GUID`, `SOURCE_IDENTIFIER`, `RECORD_DATE`, `JSON` FROM {}"
+_EMPTY_SELECT = "SELECT CAST(NULL AS INTEGER) AS `SEQ`, NULL AS `GUID`, NULL AS `SOURCE_IDENTIFIER`, NULL AS `RECORD_DATE`, NULL AS `JSON` WHERE 0"
+
+_PROJECTION_TYPES = {
+	"text":    ("TEXT", str),
+	"integer": ("INTEGER", int),
+	"real":    ("REAL", float)
+}
+
+_FILTER_OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "in")
+
+_ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.DataError, OverflowError)
+
+_METRIC_INSERT_SECONDS = cdls.metrics.histogram("cdls_warehouse_insert_seconds", "Time taken to insert a batch into the warehouse", ("source",))
+_METRIC_BATCH_SIZE     = cdls.metrics.histogram("cdls_warehouse_batch_size", "Number of records per warehouse batch", ("source",),
+                                                buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+_METRIC_ROWS           = cdls.metrics.counter("cdls_warehouse_rows_total", "Rows inserted into the warehouse", ("source",))
+_METRIC_ERRORS         = cdls.metrics.counter("cdls_warehouse_serialization_errors_total", "Records which failed to serialize", ("source",))
+_METRIC_REJECTS        = cdls.metrics.counter("cdls_warehouse_rejects_total", "Records sent to WAREHOUSE_REJECTS", ("source",))
 
 _conn = None
+_lock = threading.RLock()
+_shards = {}
+_known_shards = set()
+_attached = set()
+_seq_blocks = {}
+_fulltext = {}
+_partitions = set()
+_projected = set()
+_sources = {}
+_cache = cdls.caching.LRUCache(cdls.config.DB_CACHE_MAX_BYTES)
+
+Change = collections.namedtuple("Change", ("position", "guid", "source", "record_date", "json"))
+SearchResult = collections.namedtuple("SearchResult", ("guid", "source", "rank", "snippet"))
+Record = collections.namedtuple("Record", ("position", "guid", "source", "record_date", "data"))
+ExportRange = collections.namedtuple("ExportRange", ("database", "partition", "low", "high"))
 
 
 def install():
-	"""Initializes the database. """
-	with _connect() as connection:
+	"""Initializes the database, deleting any shards. """
+	close()
+	for path in glob.glob(_shard_path("*")):
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+
+	_fulltext.clear()
+	_partitions.clear()
+	_projected.clear()
+	_cache.clear()
+
+	with _locked(_connect()) as connection:
+
+		# Drop the warehouse views, partitions and their full-text and
+		# projection tables; they're recreated as sources write.  Dropping a
+		# full-text index drops its shadow tables, which sort after it.
+		for kind, pattern in (("view", "WAREHOUSE"), ("view", "WAREHOUSE\\_SRC\\_%"), ("table", "WAREHOUSE"),
+		                      ("table", "WAREHOUSE\\_PART\\_%"), ("table", "WAREHOUSE\\_P\\_%")):
+			query = "SELECT name FROM sqlite_master WHERE type = ? AND name LIKE ? ESCAPE '\\' ORDER BY name"
+			for (name,) in connection.execute(query, (kind, pattern)).fetchall():
+				connection.execute("DROP {} IF EXISTS `{}`".format(kind.upper(), name))
 
 		# Initialize the Loadstats table
 		try:
@@ -62,106 +260,1615 @@ def install():
 
 		connection.execute(_DDL_CREATE_LOADSTATS)
 
-		# Initialize the Warehouse table
+		# Initialize the Warehouse partition catalog and (empty) view
 		try:
-			connection.execute(_DDL_DROP_WAREHOUSE)
+			connection.execute(_DDL_DROP_PARTITIONS)
 		except sqlite3.OperationalError:
 			pass
 
-		_execute_query(connection, _DDL_CREATE_WAREHOUSE)
+		_execute_query(connection, _DDL_CREATE_PARTITIONS)
+		_create_views(connection)
 
+		# Initialize the SEQ allocator
+		try:
+			connection.execute(_DDL_DROP_SEQUENCES)
+		except sqlite3.OperationalError:
+			pass
 
-def warehouse(data, source, record_date):
-	"""Lazy way of decomposing a data structure by simply saving it as a JSON
-	document with a bunch of metadata.
+		_execute_query(connection, _DDL_CREATE_SEQUENCES)
+		_execute_query(connection, "INSERT INTO cdls_sequences (name, value) VALUES ('WAREHOUSE', 0)")
+
+		# Initialize the full-text index, if sqlite was built with FTS5
+		# Drop the single full-text index older versions kept
+		connection.execute(_DDL_DROP_FULLTEXT.format(name="WAREHOUSE_FTS"))
+
+		# Initialize the Rejects table
+		try:
+			connection.execute(_DDL_DROP_REJECTS)
+		except sqlite3.OperationalError:
+			pass
+
+		_execute_query(connection, _DDL_CREATE_REJECTS)
+
+		# Initialize the change feed cursors
+		try:
+			connection.execute(_DDL_DROP_CURSORS)
+		except sqlite3.OperationalError:
+			pass
+
+		_execute_query(connection, _DDL_CREATE_CURSORS)
+
+		# Initialize the incremental load watermarks
+		try:
+			connection.execute(_DDL_DROP_WATERMARKS)
+		except sqlite3.OperationalError:
+			pass
+
+		_execute_query(connection, _DDL_CREATE_WATERMARKS)
+
+
+def apply_retention(source=None, now=None):
+	"""Drops every partition that has aged out of its source's retention
+	period (`retention_days`, see `configure_source`).
+
+	Whole partitions are dropped rather than deleting rows, so nothing needs
+	to be vacuumed afterwards.  A partition is only dropped once its entire
+	month is older than the retention period.
 
 	Args:
-	  data (mixed): Any object that can be serialized to JSON.
-	  source (string): The identifier for the datasource where the data came
-	    from.
-	  record_date (datetime): The object .
+	  source (string, optional): Only apply this source's retention policy.
+	  now (datetime, optional): The current time.
+
+	Returns:
+	  list of string: The names of the dropped partitions.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	now = now or datetime.datetime.now()
+	sources = [source.strip().upper()] if source else sorted(_sources)
+
+	dropped = []
+	for source in sources:
+		retention_days = _sources.get(source, {}).get("retention_days")
+		if not retention_days:
+			continue
+
+		cutoff = cdls.serialization.date_to_string(now - datetime.timedelta(days=retention_days))
+		query = "SELECT name FROM warehouse_partitions WHERE source_identifier = :source AND range_end <= :cutoff ORDER BY period"
+
+		connection, lock = _writer(source)
+		with lock, connection:
+			names = [row[0] for row in _execute_query(connection, query, {"source": source, "cutoff": cutoff})]
+			for name in names:
+				_drop_partition(connection, source, name)
+
+			if names:
+				_create_views(connection, source)
+				dropped.extend(names)
+
+	if dropped:
+		_cache.clear()
+
+	return dropped
+
+
+def cache_stats():
+	"""Returns the record cache's counters (see `get_many`).
+
+	Returns:
+	  dict: `hits`, `misses`, `evictions`, `entries`, `size` (bytes of stored
+	    JSON) and `max_size`.
+
+	"""
+	return _cache.stats()
+
+
+def close():
+	"""Closes the read facade and every shard writer. """
+	global _conn
+	with _lock:
+		for connection, lock in list(_shards.values()):
+			with lock:
+				connection.close()
+		_shards.clear()
+		_seq_blocks.clear()
+		_known_shards.clear()
+		_attached.clear()
+		_fulltext.clear()
+
+		if _conn:
+			_conn.close()
+			_conn = None
+
+
+def commit_cursor(consumer, position):
+	"""Durably records how far a consumer has read the change feed.
+
+	Args:
+	  consumer (string): The consumer's name.
+	  position (int): The position of the last change the consumer has
+	    finished with.
 
 	Raises:
 	  DatabaseError
 
 	"""
 	query = """
-INSERT INTO warehouse
-	( guid,  source_identifier,  record_date,  json)
+INSERT INTO cdls_consumer_cursors
+	( consumer,  position,  updated_on)
 VALUES
-	(:guid, :source_identifier, :record_date, :json)
+	(:consumer, :position, :updated_on)
+ON CONFLICT (consumer) DO UPDATE SET
+	position = excluded.position, updated_on = excluded.updated_on
 """
-	params = {}
+	params = {
+		"consumer":   consumer,
+		"position":   int(position),
+		"updated_on": cdls.serialization.date_to_string(datetime.datetime.now())
+	}
 
-	# Package the data first
-	data_type = type(data).__name__
-	packaged_data = {
-		"$class": data_type,
-		"$contents": data
+	with _locked(_connect()) as connection:
+		_execute_query(connection, query, params)
+
+
+def configure_source(source, config):
+	"""Registers a source's warehouse options from its configuration node.
+
+	Recognized options:
+	  `search_fields` (list of string): Record fields (dotted paths for nested
+	    values) to add to the full-text index.
+	  `projections` (dict): Record fields (dotted paths) to extract into typed,
+	    indexed columns at insert time, mapped to their type (`text`,
+	    `integer` or `real`).  Filters on these fields in `query_warehouse`
+	    are answered from the index instead of parsing every document.
+	  `retention_days` (int): How long to keep the source's records (see
+	    `apply_retention`).  Kept forever if unset.
+	  `shard` (string): Writes the source to its own named shard file instead
+	    of its hash bucket (or the main file).
+
+	Args:
+	  source (string): The datasource identifier.
+	  config (dict): The datasource's configuration node.
+
+	Raises:
+	  SourceConfigurationError
+
+	"""
+	projections = []
+	for path, type_name in sorted((config.get("projections") or {}).items()):
+		if type_name not in _PROJECTION_TYPES:
+			raise SourceConfigurationError("Projection '{}' has unsupported type '{}'".format(path, type_name), config)
+		projections.append((path, "P_" + re.sub(r"\W", "_", path).upper(), type_name))
+
+	retention_days = config.get("retention_days", cdls.config.DB_RETENTION_DAYS)
+
+	source = source.strip().upper()
+	_sources[source] = {
+		"search_fields":  tuple(config.get("search_fields") or ()),
+		"projections":    tuple(projections),
+		"retention_days": int(retention_days) if retention_days else None,
+		"shard":          config.get("shard")
 	}
+	_projected.discard(source)
 
-	# Serialize to JSON
-	json_string = None
-	try:
-		json_string = json.dumps(packaged_data, default=_tojson, sort_keys=True, indent=4)
-	except TypeError:
-		raise DatabaseError("JSON-serialization failed on data")
 
-	# Perform insert
-	params["json"] = json_string.strip()
-	params["guid"] = str(uuid.uuid1()).upper()
-	params["source_identifier"] = source.strip().upper()
-	params["record_date"] = _date_to_string(record_date)
+def export_ranges(source, since=None, until=None, rows=None):
+	"""Divides a source's partitions up into SEQ ranges for `read_range` to
+	export independently.
 
-	with _connect() as connection:
-		_execute_query(connection, query, params)
+	Args:
+	  source (string): The datasource identifier.
+	  since (datetime, optional): Only partitions overlapping a range starting
+	    at this.
+	  until (datetime, optional): Only partitions overlapping a range ending
+	    before this.
+	  rows (int, optional): The most rows per range; by default each range is
+	    a whole partition.
 
+	Returns:
+	  list of ExportRange: In SEQ order within each partition, oldest
+	    partition first.
 
-def _connect():
-	"""Returns a connection to the database. """
-	global _conn
-	if not _conn:
-		_conn = sqlite3.connect(_DBPATH)
-	return _conn
+	Raises:
+	  DatabaseError
 
+	"""
+	source = source.strip().upper()
+	schema = _schema(source)
+	database = _DBPATH if schema == "main" else _shard_path(schema[len("shard_"):])
 
-def _date_to_string(date):
-	"""Formats a datetime into a string. """
-	# timezones... le sigh
-	return date.strftime("%Y-%m-%d %H:%M:%S.%f")
+	ranges = []
+	with _locked(_connect()) as connection:
+		for name in _source_partitions(connection, source, since, until, schema):
+			if not rows:
+				ranges.append(ExportRange(database, name, None, None))
+				continue
 
+			# Step through the SEQ primary key to each range's last row
+			query = "SELECT seq FROM {} WHERE seq > :low ORDER BY seq LIMIT 1 OFFSET :offset".format(_qualify(schema, name))
+			low = 0
+			while True:
+				row = _execute_query(connection, query, {"low": low, "offset": int(rows) - 1}).fetchone()
+				if not row:
+					break
+				ranges.append(ExportRange(database, name, low, row[0]))
+				low = row[0]
 
-def _execute_query(connection, query, params=None):
-	"""Standard operation for executing a SQL query against the database.
+			if _execute_query(connection, query, {"low": low, "offset": 0}).fetchone():
+				ranges.append(ExportRange(database, name, low, None))
+
+	return ranges
+
+
+def get(guid):
+	"""Looks up a single warehouse record by GUID (see `get_many`).
+
+	Returns:
+	  Record: The record, or None if there's no such GUID.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	return get_many([guid]).get(guid)
+
+
+def get_cursor(consumer):
+	"""Returns a consumer's committed change feed position (0 if it has never
+	committed one).
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = "SELECT position FROM cdls_consumer_cursors WHERE consumer = :consumer"
+	with _locked(_connect()) as connection:
+		row = _execute_query(connection, query, {"consumer": consumer}).fetchone()
+	return row[0] if row else 0
+
+
+def get_many(guids):
+	"""Looks up warehouse records by GUID, with their documents decoded.
+
+	Records are served from an LRU cache (bounded by DB_CACHE_MAX_BYTES of
+	stored JSON) where possible and the rest are read in as few queries as
+	possible, then cached.  The decoded documents are shared with the cache,
+	so treat them as read-only.
 
 	Args:
-	  connection (db): The connection to the database.
-	  query (string): The SQL to be executed.
-	  params (dict, optional): Any SQL parameters to be bound.
+	  guids (iterable of string): The GUIDs to look up.
+
+	Returns:
+	  dict: Record by GUID, in the order asked for; GUIDs which aren't in the
+	    warehouse are left out.
 
 	Raises:
 	  DatabaseError
 
 	"""
-	query = query.strip()
-	try:
-		if params:
-			connection.execute(query, params)
+	guids = list(dict.fromkeys(guids))
+	found = {}
+	missing = []
+	for guid in guids:
+		record = _cache.get(guid)
+		if record is None:
+			missing.append(guid)
 		else:
-			connection.execute(query)
-	except sqlite3.OperationalError as e:
-		raise DatabaseError("sqlite3: {}".format(e), query, params) from e
+			found[guid] = record
+
+	generation = _cache.generation
+	with _locked(_connect()) as connection:
+		for n in range(0, len(missing), cdls.config.DB_BATCH_SIZE):
+			chunk = missing[n:n + cdls.config.DB_BATCH_SIZE]
+			query = "SELECT seq, guid, source_identifier, record_date, json FROM warehouse WHERE guid IN ({})".format(", ".join("?" * len(chunk)))
+			try:
+				rows = connection.execute(query, chunk).fetchall()
+			except sqlite3.Error as e:
+				raise DatabaseError("sqlite3: {}".format(e), query) from e
+
+			for seq, guid, source, record_date, document in rows:
+				found[guid] = Record(seq, guid, source, record_date, json.loads(document).get("$contents"))
+				_cache.put(guid, found[guid], len(document), generation)
+
+	return dict((guid, found[guid]) for guid in guids if guid in found)
+
+
+def get_projections(source):
+	"""Returns a source's configured projections (see `configure_source`).
+
+	Returns:
+	  dict: Field (dotted path) to type.
+
+	"""
+	return dict((path, type_name) for path, column, type_name in _sources.get(source.strip().upper(), {}).get("projections", ()))
+
+
+def get_watermark(source):
+	"""Returns the high-watermark a source's last incremental load reached
+	(see `set_watermark`).
+
+	Returns:
+	  mixed: The watermark, or None if the source has never set one.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = "SELECT value FROM cdls_watermarks WHERE source_identifier = :source"
+	with _locked(_connect()) as connection:
+		row = _execute_query(connection, query, {"source": source.strip().upper()}).fetchone()
+	return json.loads(row[0]) if row else None
+
 
+def query(source, filters=None, since=None, until=None, limit=None):
+	"""Finds a source's warehouse rows (see `query_warehouse`). """
+	return query_warehouse(source, filters, since, until, limit)
 
-def _tojson(o):
-	"""Rudimentary parse handler for JSON serialization.
+
+def query_warehouse(source, filters=None, since=None, until=None, limit=None):
+	"""Finds a source's warehouse rows by the values of fields in their
+	documents.
+
+	Filters on projected fields (see `configure_source`) are pushed down to
+	the projection table's indexes; any other field falls back to
+	`json_extract` on every candidate row.  Given a date range, only the
+	partitions overlapping it are read.
 
 	Args:
-	  o (mixed): The object to be serialized.
+	  source (string): The datasource identifier.
+	  filters (dict, optional): Field (dotted path) to value for equality, or
+	    to an (operator, value) pair where the operator is one of
+	    `_FILTER_OPERATORS` (`in` takes a list of values).
+	  since (datetime, optional): Only rows with a RECORD_DATE at or after this.
+	  until (datetime, optional): Only rows with a RECORD_DATE before this.
+	  limit (int, optional): The most rows to return.
+
+	Returns:
+	  list of Change: Matching rows in the order they were written.
+
+	Raises:
+	  DatabaseError
 
 	"""
-	if isinstance(o, datetime.datetime):
-		return _date_to_string(o)
-	else:
-		return o.__dict__
+	source = source.strip().upper()
+	projections = dict((path, column) for path, column, type_name in _sources.get(source, {}).get("projections", ()))
+
+	projected_conditions, projected_params = [], []
+	conditions, params = [], []
+	for path, value in sorted((filters or {}).items()):
+		operator, value = value if isinstance(value, tuple) else ("=", value)
+		if operator not in _FILTER_OPERATORS:
+			raise DatabaseError("Unsupported filter operator '{}'".format(operator))
+
+		if path in projections:
+			expression = "p.`{}`".format(projections[path])
+			target_conditions, target_params = projected_conditions, projected_params
+		else:
+			expression = "json_extract(w.json, ?)"
+			target_conditions, target_params = conditions, params
+			params.append(_json_path(path))
+
+		if operator == "in":
+			value = list(value)
+			target_conditions.append("{} IN ({})".format(expression, ", ".join("?" * len(value))))
+			target_params.extend(value)
+		else:
+			target_conditions.append("{} {} ?".format(expression, operator))
+			target_params.append(value)
+
+	if since:
+		conditions.append("w.record_date >= ?")
+		params.append(cdls.serialization.date_to_string(since))
+	if until:
+		conditions.append("w.record_date < ?")
+		params.append(cdls.serialization.date_to_string(until))
+
+	if projected_conditions:
+		writer, lock = _writer(source)
+		with lock, writer:
+			_ensure_projections(writer, source)
+
+	schema = _schema(source)
+	with _locked(_connect()) as connection:
+		names = _source_partitions(connection, source, since, until, schema)
+		if not names:
+			return []
+
+		# Read through the source's view unless the date range prunes
+		# partitions, or there are projected filters to push down to each
+		# partition's projection table
+		if since or until or projected_conditions:
+			selects = []
+			for name in names:
+				select = _PARTITION_SELECT.format(_qualify(schema, name))
+				if projected_conditions:
+					select += " WHERE `SEQ` IN (SELECT p.seq FROM {} p WHERE {})".format(_qualify(schema, _projection_table(name)), " AND ".join(projected_conditions))
+					params[0:0] = projected_params
+				selects.append(select)
+			relation = "({})".format(" UNION ALL ".join(selects))
+		else:
+			relation = _qualify(schema, _source_view(source))
+
+		query = "SELECT w.seq, w.guid, w.source_identifier, w.record_date, w.json FROM {} w".format(relation)
+		if conditions:
+			query += " WHERE " + " AND ".join(conditions)
+		query += " ORDER BY w.seq"
+		if limit:
+			query += " LIMIT ?"
+			params.append(int(limit))
+
+		try:
+			return [Change(*row) for row in connection.execute(query, params)]
+		except sqlite3.Error as e:
+			raise DatabaseError("sqlite3: {}".format(e), query) from e
+
+
+def read_changes(consumer, limit=1000, source=None):
+	"""Reads the warehouse rows added since a consumer's committed cursor.
+
+	Rows come back in the order they were written, keyed by the monotonically
+	increasing SEQ column, so each poll costs time in proportion to the new
+	rows rather than the size of the table.  Reading doesn't move the cursor;
+	call `commit_cursor` with the last position once the rows are processed.
+
+	With shards, rows are only returned up to the SEQ below which nothing is
+	left to be committed by this process's writers, so that the cursor never
+	moves past a row that's still to come.
+
+	Args:
+	  consumer (string): The consumer's name.
+	  limit (int, optional): The most rows to return.
+	  source (string, optional): Only return rows from this source.
+
+	Returns:
+	  list of Change
+
+	Raises:
+	  DatabaseError
+
+	"""
+	relation = "warehouse"
+	conditions = "seq > :position"
+	params = {"position": get_cursor(consumer), "limit": int(limit)}
+
+	horizon = _seq_horizon()
+	if horizon is not None:
+		conditions += " AND seq <= :horizon"
+		params["horizon"] = horizon
+
+	with _locked(_connect()) as connection:
+		if source:
+			source = source.strip().upper()
+			if not _source_partitions(connection, source, schema=_schema(source)):
+				return []
+			relation = _qualify(_schema(source), _source_view(source))
+
+		query = "SELECT seq, guid, source_identifier, record_date, json FROM {} WHERE {} ORDER BY seq LIMIT :limit".format(relation, conditions)
+		return [Change(*row) for row in _execute_query(connection, query, params)]
+
+
+def read_fields(export_range, paths, since=None, until=None, batch_size=None):
+	"""Streams the values of fields in an `export_ranges` range's documents,
+	a batch at a time (see `read_range`).
+
+	Args:
+	  export_range (ExportRange): The range to read.
+	  paths (list of string): The fields (dotted paths) to read.
+	  since (datetime, optional): Only rows with a RECORD_DATE at or after this.
+	  until (datetime, optional): Only rows with a RECORD_DATE before this.
+	  batch_size (int, optional): Rows per batch (defaults to DB_BATCH_SIZE).
+
+	Yields:
+	  list of tuple: (seq, record_date, value...) per row, where missing
+	    fields are None and objects and arrays are JSON text.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	(conditions, params) = _range_conditions(export_range, since, until)
+	for n, path in enumerate(paths):
+		params["path{}".format(n)] = _json_path(path)
+
+	query = "SELECT seq, record_date{} FROM `{}`".format("".join(", json_extract(json, :path{})".format(n) for n in range(len(paths))), export_range.partition)
+	if conditions:
+		query += " WHERE " + " AND ".join(conditions)
+	query += " ORDER BY seq"
+
+	yield from _stream(export_range.database, query, params, batch_size)
+
+
+def read_range(export_range, since=None, until=None, batch_size=None):
+	"""Streams the rows in an `export_ranges` range, a batch at a time.
+
+	Each call reads through a connection of its own, so ranges can be read
+	in parallel.  Rows are fetched from an open cursor as they're consumed,
+	which keeps memory use flat however big the range is, but note that on
+	the main file (which isn't in WAL mode) the cursor holds a read lock that
+	stalls writers until it's exhausted.
+
+	Args:
+	  export_range (ExportRange): The range to read.
+	  since (datetime, optional): Only rows with a RECORD_DATE at or after this.
+	  until (datetime, optional): Only rows with a RECORD_DATE before this.
+	  batch_size (int, optional): Rows per batch (defaults to DB_BATCH_SIZE).
+
+	Yields:
+	  list of Change: Rows in the order they were written.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	(conditions, params) = _range_conditions(export_range, since, until)
+	query = _PARTITION_SELECT.format("`{}`".format(export_range.partition))
+	if conditions:
+		query += " WHERE " + " AND ".join(conditions)
+	query += " ORDER BY seq"
+
+	for batch in _stream(export_range.database, query, params, batch_size):
+		yield [Change(*row) for row in batch]
+
+
+def replay_rejects(source=None, limit=None):
+	"""Re-drives rejected records through the warehouse, e.g. once whatever
+	rejected them has been fixed.
+
+	Records are replayed from the JSON document they were rejected with.
+	Those which make it in are removed from WAREHOUSE_REJECTS; those which
+	fail again (or have no payload) stay there with their error and
+	REPLAY_COUNT updated.
+
+	Args:
+	  source (string, optional): Only replay rejects from this source.
+	  limit (int, optional): The most rejects to replay.
+
+	Returns:
+	  tuple: (number replayed, number still failing)
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = "SELECT rowid, source_identifier, record_date, payload_text FROM warehouse_rejects"
+	params = {}
+	if source:
+		query += " WHERE source_identifier = :source"
+		params["source"] = source.strip().upper()
+	query += " ORDER BY rowid"
+	if limit:
+		query += " LIMIT :limit"
+		params["limit"] = int(limit)
+
+	with _locked(_connect()) as connection:
+		rejects = _execute_query(connection, query, params).fetchall()
+
+	# Group by source so each one is a single batch
+	batches = {}
+	unreplayable = []
+	for rowid, source_identifier, record_date, payload_text in rejects:
+		if payload_text is None:
+			unreplayable.append((rowid, "DatabaseError", "Payload can't be replayed: it couldn't be serialized"))
+			continue
+
+		try:
+			record = (_unpackage(json.loads(payload_text)), datetime.datetime.strptime(record_date, "%Y-%m-%d %H:%M:%S.%f"))
+		except Exception as e:
+			unreplayable.append((rowid, type(e).__name__, "Payload can't be replayed: {}".format(e)))
+			continue
+		batches.setdefault(source_identifier, []).append((rowid, record))
+
+	replayed = []
+	failed = list(unreplayable)
+	for source_identifier, batch in batches.items():
+		errors = dict(warehouse_many([record for rowid, record in batch], source_identifier, reject=False))
+		for index, (rowid, record) in enumerate(batch):
+			if index in errors:
+				failed.append((rowid, errors[index].error_type, str(errors[index])))
+			else:
+				replayed.append((rowid,))
+
+	with _locked(_connect()) as connection:
+		_execute_many(connection, "DELETE FROM warehouse_rejects WHERE rowid = ?", replayed)
+		_execute_many(connection, """
+UPDATE warehouse_rejects
+SET replay_count = replay_count + 1, error_type = ?, error_message = ?
+WHERE rowid = ?
+""", [(error_type, message, rowid) for rowid, error_type, message in failed])
+
+	return (len(replayed), len(failed))
+
+
+def search_warehouse(query, source=None, limit=20):
+	"""Searches the full-text index.
+
+	Args:
+	  query (string): An FTS5 query (e.g., `lorem AND ipsum`, `"exact phrase"`)
+	  source (string, optional): Only search records from this source.
+	  limit (int, optional): The most results to return.
+
+	Returns:
+	  list of SearchResult: Best matches first.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	select = """
+SELECT guid, source_identifier, bm25(`{1}`) AS rank, snippet(`{1}`, 0, '[', ']', '...', 12)
+FROM {0}
+WHERE `{1}` MATCH :query
+"""
+	params = {"query": query, "limit": int(limit)}
+	if source:
+		source = source.strip().upper()
+
+	with _locked(_connect()) as connection:
+		# Each partition has its own index, so search them all and merge
+		schemas = [_schema(source)] if source else ["main"] + sorted("shard_" + key for key in _attached)
+		selects = []
+		for schema in schemas:
+			if not _is_attached(schema):
+				continue
+
+			names = [row[0] for row in connection.execute(
+				"SELECT name FROM {} WHERE type = 'table' AND name LIKE 'WAREHOUSE\\_PART\\_%\\_FTS' ESCAPE '\\' ORDER BY name".format(_qualify(schema, "sqlite_master")))]
+			if source:
+				names = sorted(set(names) & set(_fulltext_table(name) for name in _source_partitions(connection, source, schema=schema)))
+			selects.extend(select.format(_qualify(schema, name), name) for name in names)
+
+		if not selects:
+			return []
+
+		sql = "SELECT * FROM ({}) ORDER BY rank LIMIT :limit".format(" UNION ALL ".join(selects))
+		return [SearchResult(*row) for row in _execute_query(connection, sql, params)]
+
+
+def set_watermark(source, value):
+	"""Durably records how far a source's incremental loads have got, for the
+	next load to pick up from.
+
+	Args:
+	  source (string): The datasource identifier.
+	  value (mixed): Anything that can be serialized to JSON (e.g. the latest
+	    timestamp or key seen; see `cdls.backends.encode_watermark`).
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = """
+INSERT INTO cdls_watermarks
+	( source_identifier,  value,  updated_on)
+VALUES
+	(:source,            :value, :updated_on)
+ON CONFLICT (source_identifier) DO UPDATE SET
+	value = excluded.value, updated_on = excluded.updated_on
+"""
+	params = {
+		"source":     source.strip().upper(),
+		"value":      cdls.backends.encode_watermark(source, value),
+		"updated_on": cdls.serialization.date_to_string(datetime.datetime.now())
+	}
+
+	with _locked(_connect()) as connection:
+		_execute_query(connection, query, params)
+
+
+def stats():
+	"""Summarizes what's in the warehouse.
+
+	Returns:
+	  dict: `backend`, `records`, `rejects`, `bytes` (on disk, shards
+	    included), per-source `records` and `partitions` under `sources` and
+	    the record cache's counters under `cache`.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	summary = {"backend": "sqlite", "records": 0, "rejects": 0, "bytes": 0, "sources": {}, "cache": _cache.stats()}
+	with _locked(_connect()) as connection:
+		for schema in ["main"] + sorted("shard_" + key for key in _attached):
+			query = "SELECT source_identifier, COUNT(*) FROM {} GROUP BY source_identifier".format(_qualify(schema, "warehouse_partitions"))
+			for source, partitions in _execute_query(connection, query).fetchall():
+				records = _execute_query(connection, "SELECT COUNT(*) FROM {}".format(_qualify(schema, _source_view(source)))).fetchone()[0]
+				summary["sources"][source] = {"records": records, "partitions": partitions}
+				summary["records"] += records
+
+		summary["rejects"] = _execute_query(connection, "SELECT COUNT(*) FROM warehouse_rejects").fetchone()[0]
+
+	for path in [_DBPATH] + glob.glob(_shard_path("*")):
+		summary["bytes"] += os.path.getsize(path)
+
+	return summary
+
+
+def warehouse(data, source, record_date):
+	"""Lazy way of decomposing a data structure by simply saving it as a JSON
+	document with a bunch of metadata.
+
+	Args:
+	  data (mixed): Any object that can be serialized to JSON.
+	  source (string): The identifier for the datasource where the data came
+	    from.
+	  record_date (datetime): The object .
+
+	Raises:
+	  DatabaseError
+
+	"""
+	errors = warehouse_many([(data, record_date)], source, workers=0, reject=False)
+	if errors:
+		raise errors[0][1]
+
+
+def warehouse_many(records, source, workers=None, stats=None, reject=True):
+	"""Saves a batch of records in a single transaction.
+
+	Serialization happens first (optionally in worker processes).  Records
+	which fail to serialize or insert are isolated and reported back (and
+	saved to WAREHOUSE_REJECTS, unless told not to) while the rest of the
+	batch is committed.  Each record goes to the partition for its source and
+	the month of its record date, which is created if need be.
+
+	Args:
+	  records (list of tuple): (data, record_date) pairs.
+	  source (string): The identifier for the datasource where the data came
+	    from.
+	  workers (int, optional): Overrides the configured number of serializer
+	    processes.
+	  stats (dict, optional): If given, `serialize_ns`, `write_ns` and
+	    `bytes_written` are accumulated into it.
+	  reject (bool, optional): Whether to save failed records to
+	    WAREHOUSE_REJECTS.  Defaults to True.
+
+	Returns:
+	  list of tuple: (index, DatabaseError) for every record that failed.  Each
+	    error's `error_type` names the original exception.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = """
+INSERT INTO `{}`
+	( seq,  guid,  source_identifier,  record_date,  json)
+VALUES
+	(?, ?, ?, ?, ?)
+"""
+	time_started = time.perf_counter_ns()
+	with cdls.tracing.span("serialize", source=source, records=len(records)):
+		encoded = cdls.serialization.encode_batch(records, source, workers)
+
+	pending = []
+	errors = []
+	for index, (params, error) in enumerate(encoded):
+		if error:
+			errors.append((index, DatabaseError(error[1], error_type=error[0])))
+		else:
+			pending.append((index, params))
+
+	time_serialized = time.perf_counter_ns()
+
+	inserted = []
+	connection, lock = _writer(source)
+	with cdls.tracing.span("insert", source=source, rows=len(pending)), lock, connection:
+		# sqlite3 only opens a transaction before DML, so begin one explicitly
+		# for the partition DDL to be rolled back with everything else
+		if not connection.in_transaction:
+			_execute_query(connection, "BEGIN")
+
+		try:
+			# Number the rows, then split them up by partition
+			partitions = {}
+			if pending:
+				seq = _allocate_seq(connection, len(pending))
+				for offset, (index, params) in enumerate(pending):
+					partitions.setdefault(params[2][:7], []).append((index, (seq + offset,) + params))
+
+			for period, group in sorted(partitions.items()):
+				name = _ensure_partition(connection, group[0][1][2], period)
+				rows = [row for index, row in group]
+				indexes = [index for index, row in group]
+				failed = _insert_isolated(connection, query.format(name), rows, indexes)
+				errors.extend(failed)
+
+				failed = set(index for index, error in failed)
+				inserted.extend((index, row) for index, row in group if index not in failed)
+
+			options = _sources.get(source.strip().upper(), {})
+			if options.get("search_fields") and _has_fulltext(connection):
+				_index_fulltext(connection, records, inserted, options["search_fields"])
+
+			if options.get("projections"):
+				_project(connection, records, inserted, source)
+
+			if errors and reject:
+				with _main_transaction(connection) as main:
+					_reject(main, records, errors, source)
+		except Exception:
+			# Any partitions, full-text indexes and projection tables created
+			# here went with the transaction
+			_partitions.clear()
+			_projected.clear()
+			raise
+
+	# Nothing stale can be served for what was just written
+	if inserted:
+		_cache.discard(row[1] for index, row in inserted)
+
+	time_written = time.perf_counter_ns()
+	_METRIC_INSERT_SECONDS.labels(source).observe((time_written - time_serialized) / 1e9)
+	_METRIC_BATCH_SIZE.labels(source).observe(len(encoded))
+	_METRIC_ROWS.labels(source).inc(len(inserted))
+	if errors:
+		_METRIC_ERRORS.labels(source).inc(len(errors))
+		if reject:
+			_METRIC_REJECTS.labels(source).inc(len(errors))
+
+	if stats is not None:
+		stats["serialize_ns"] = stats.get("serialize_ns", 0) + time_serialized - time_started
+		stats["write_ns"] = stats.get("write_ns", 0) + time_written - time_serialized
+		stats["bytes_written"] = stats.get("bytes_written", 0) + sum(len(row[4]) for index, row in inserted)
+
+	return sorted(errors, key=lambda error: error[0])
+
+
+def _allocate_seq(connection, count):
+	"""Reserves a block of SEQ values.
+
+	On the main connection they're taken straight from CDLS_SEQUENCES, in the
+	caller's transaction.  Shard writers instead reserve DB_SEQ_BLOCK_SIZE
+	values at a time and hand them out from there, so they only write to the
+	main database (and wait on its lock) once a block runs out.  The caller
+	must hold the shard's lock.
+
+	Args:
+	  connection (db): The connection to the database.
+	  count (int): The number of values to reserve.
+
+	Returns:
+	  int: The first reserved value.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	if connection is _conn:
+		return _reserve_seq(connection, count)
+
+	block = _seq_blocks.get(connection)
+	if not block or block[1] - block[0] < count:
+		size = max(count, cdls.config.DB_SEQ_BLOCK_SIZE)
+		with _locked(_connect()) as main:
+			start = _reserve_seq(main, size)
+		block = _seq_blocks[connection] = [start, start + size]
+
+	start = block[0]
+	block[0] += count
+	return start
+
+
+def _attach_shards(connection):
+	"""Attaches any new shards to the read facade and rebuilds its
+	WAREHOUSE view over every shard's.
+
+	Args:
+	  connection (db): The read facade.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	for key in sorted(_known_shards - _attached):
+		_execute_query(connection, "ATTACH DATABASE :path AS `shard_{}`".format(key), {"path": _shard_path(key)})
+		_attached.add(key)
+
+	selects = []
+	for schema in ["main"] + sorted("shard_" + key for key in _attached):
+		# Skip anything which hasn't been installed yet
+		if connection.execute("SELECT 1 FROM {} WHERE type = 'view' AND name = 'WAREHOUSE'".format(_qualify(schema, "sqlite_master"))).fetchone():
+			selects.append(_PARTITION_SELECT.format(_qualify(schema, "WAREHOUSE")))
+
+	_execute_query(connection, "DROP VIEW IF EXISTS temp.`WAREHOUSE`")
+	_execute_query(connection, "CREATE TEMP VIEW `WAREHOUSE` AS " + (" UNION ALL ".join(selects) or _EMPTY_SELECT))
+
+
+def _connect():
+	"""Returns a connection to the database.
+
+	When there are shards, they're attached to it the first time they're seen
+	(outside of a transaction).
+	"""
+	global _conn
+	with _lock:
+		if not _conn:
+			_conn = sqlite3.connect(_DBPATH, check_same_thread=False)
+			_attached.clear()
+			_known_shards.update(_shard_key_from_path(path) for path in glob.glob(_shard_path("*")))
+
+		if _known_shards - _attached and not _conn.in_transaction:
+			_attach_shards(_conn)
+	return _conn
+
+
+def _create_views(connection, source=None):
+	"""Rebuilds the views over the partitions after they change.
+
+	Args:
+	  connection (db): The connection to the database.
+	  source (string, optional): The upper-cased datasource identifier whose
+	    partitions changed.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	if source:
+		view = _source_view(source)
+		_execute_query(connection, "DROP VIEW IF EXISTS `{}`".format(view))
+
+		names = _source_partitions(connection, source)
+		if names:
+			_execute_query(connection, "CREATE VIEW `{}` AS {}".format(view, " UNION ALL ".join(_PARTITION_SELECT.format("`{}`".format(name)) for name in names)))
+
+	sources = [row[0] for row in _execute_query(connection, "SELECT DISTINCT source_identifier FROM warehouse_partitions ORDER BY source_identifier")]
+	if sources:
+		select = " UNION ALL ".join(_PARTITION_SELECT.format("`{}`".format(_source_view(source))) for source in sources)
+	else:
+		select = _EMPTY_SELECT
+
+	_execute_query(connection, "DROP VIEW IF EXISTS `WAREHOUSE`")
+	_execute_query(connection, "CREATE VIEW `WAREHOUSE` AS " + select)
+
+
+def _drop_partition(connection, source, name):
+	"""Drops a partition, along with its full-text index and projection
+	table.
+
+	Args:
+	  connection (db): The connection to the database.
+	  source (string): The upper-cased datasource identifier.
+	  name (string): The partition.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	_execute_query(connection, _DDL_DROP_FULLTEXT.format(name=_fulltext_table(name)))
+	_execute_query(connection, "DROP TABLE IF EXISTS `{}`".format(_projection_table(name)))
+	_execute_query(connection, "DROP TABLE `{}`".format(name))
+	_execute_query(connection, "DELETE FROM warehouse_partitions WHERE name = :name", {"name": name})
+	_partitions.discard(name)
+	_partitions.discard(_fulltext_table(name))
+
+
+def _ensure_partition(connection, source, period):
+	"""Returns the partition for a source and month, creating it if need be.
+
+	Args:
+	  connection (db): The connection to the database.
+	  source (string): The upper-cased datasource identifier.
+	  period (string): The month, as `YYYY-MM`.
+
+	Returns:
+	  string: The partition's table name.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	name = _partition_name(source, period)
+	if name in _partitions:
+		return name
+
+	if not connection.execute("SELECT 1 FROM warehouse_partitions WHERE name = ?", (name,)).fetchone():
+		year, month = int(period[:4]), int(period[5:7])
+		range_start = datetime.datetime(year, month, 1)
+		range_end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+		_execute_query(connection, _DDL_CREATE_PARTITION.format(name=name))
+		_execute_query(connection, _DDL_CREATE_PARTITION_INDEX.format(name=name))
+		_execute_query(connection, """
+INSERT INTO warehouse_partitions
+	( name,  source_identifier,  period,  range_start,  range_end,  created_on)
+VALUES
+	(:name, :source, :period, :range_start, :range_end, :created_on)
+""", {
+			"name":        name,
+			"source":      source,
+			"period":      period,
+			"range_start": cdls.serialization.date_to_string(range_start),
+			"range_end":   cdls.serialization.date_to_string(range_end),
+			"created_on":  cdls.serialization.date_to_string(datetime.datetime.now())
+		})
+		_create_views(connection, source)
+
+		# The new partition needs a projection table of its own
+		_projected.discard(source)
+
+	_partitions.add(name)
+	return name
+
+
+def _execute_many(connection, query, rows):
+	"""Executes a single SQL statement against a sequence of parameter rows.
+
+	Args:
+	  connection (db): The connection to the database.
+	  query (string): The SQL to be executed.
+	  rows (list of tuple): The SQL parameters for each execution.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = query.strip()
+	try:
+		connection.executemany(query, rows)
+	except sqlite3.OperationalError as e:
+		raise DatabaseError("sqlite3: {}".format(e), query) from e
+
+
+def _ensure_projections(connection, source):
+	"""Creates or extends the projection table of each of a source's
+	partitions to match its configured projections.
+
+	Newly added columns are backfilled from the documents already in the
+	partition, so projections can be declared on an existing source.
+
+	Args:
+	  connection (db): The connection to the database.
+	  source (string): The upper-cased datasource identifier.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	if source in _projected:
+		return
+
+	projections = _sources[source]["projections"]
+	for name in _source_partitions(connection, source):
+		table = _projection_table(name)
+		existing = [row[1] for row in connection.execute("PRAGMA table_info(`{}`)".format(table))]
+		if not existing:
+			_execute_query(connection, "CREATE TABLE `{}` (`SEQ` INTEGER PRIMARY KEY, `GUID` TEXT(40))".format(table))
+
+		added = [(path, column, type_name) for path, column, type_name in projections if column not in existing]
+		if not added:
+			continue
+
+		for path, column, type_name in added:
+			_execute_query(connection, "ALTER TABLE `{0}` ADD COLUMN `{1}` {2}".format(table, column, _PROJECTION_TYPES[type_name][0]))
+			_execute_query(connection, "CREATE INDEX `{0}_{1}` ON `{0}` (`{1}`)".format(table, column))
+
+		_execute_query(connection, "INSERT OR IGNORE INTO `{}` (seq, guid) SELECT seq, guid FROM `{}`".format(table, name))
+		assignments = ", ".join("`{0}` = CAST(json_extract(w.json, '{1}') AS {2})".format(column, _json_path(path).replace("'", "''"), _PROJECTION_TYPES[type_name][0])
+		                        for path, column, type_name in added)
+		_execute_query(connection, "UPDATE `{0}` SET {1} FROM `{2}` w WHERE w.seq = `{0}`.seq".format(table, assignments, name))
+
+	_projected.add(source)
+
+
+def _extract_field(data, path):
+	"""Returns the value at a dotted path within a record (None if missing). """
+	for key in path.split("."):
+		if isinstance(data, dict):
+			data = data.get(key)
+		else:
+			data = getattr(data, key, None)
+		if data is None:
+			return None
+	return data
+
+
+def _fulltext_table(partition):
+	"""Returns the name of a partition's full-text index. """
+	return partition + "_FTS"
+
+
+def _has_fulltext(connection):
+	"""Checks (once per connection) whether full-text indexing is enabled and
+	sqlite was built with FTS5.
+	"""
+	if connection not in _fulltext:
+		row = connection.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()
+		_fulltext[connection] = bool(cdls.config.DB_FULLTEXT and row[0])
+	return _fulltext[connection]
+
+
+def _index_fulltext(connection, records, inserted, search_fields):
+	"""Adds a batch's search fields to their partitions' full-text indexes,
+	in the batch's transaction.
+
+	Args:
+	  connection (db): The connection to the database.
+	  records (list of tuple): The batch's (data, record_date) pairs.
+	  inserted (list of tuple): (batch index, warehouse row) for each row that
+	    was inserted.
+	  search_fields (tuple of string): The fields to index.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = """
+INSERT INTO `{}`
+	( rowid,  body,  source_identifier,  guid)
+VALUES
+	(?, ?, ?, ?)
+"""
+	entries = {}
+	for index, row in inserted:
+		data = records[index][0]
+		values = (_extract_field(data, path) for path in search_fields)
+		body = "\n".join(str(value) for value in values if value is not None)
+		if body:
+			table = _fulltext_table(_partition_name(row[2], row[3][:7]))
+			entries.setdefault(table, []).append((row[0], body, row[2], row[1]))
+
+	for table, rows in sorted(entries.items()):
+		if table not in _partitions:
+			_execute_query(connection, _DDL_CREATE_FULLTEXT.format(name=table))
+			_partitions.add(table)
+		_execute_many(connection, query.format(table), rows)
+
+
+def _is_attached(schema):
+	"""Checks whether a schema is available on the read facade. """
+	return schema == "main" or schema[len("shard_"):] in _attached
+
+
+def _json_path(path):
+	"""Converts a dotted field path into a JSON path into a warehoused
+	document.
+	"""
+	return "$.\"$contents\"" + "".join(".\"{}\"".format(key.replace('"', '\\"')) for key in path.split("."))
+
+
+def _project(connection, records, inserted, source):
+	"""Adds a batch's projected fields to their partitions' projection
+	tables, in the batch's transaction.
+
+	Values which can't be converted to the projection's type are stored as
+	NULL rather than failing the record.
+
+	Args:
+	  connection (db): The connection to the database.
+	  records (list of tuple): The batch's (data, record_date) pairs.
+	  inserted (list of tuple): (batch index, warehouse row) for each row that
+	    was inserted.
+	  source (string): The datasource identifier.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	source = source.strip().upper()
+	_ensure_projections(connection, source)
+
+	projections = _sources[source]["projections"]
+	query = """
+INSERT OR REPLACE INTO `{{}}` (seq, guid, {0})
+VALUES (?, ?, {1})
+""".format(", ".join("`{}`".format(column) for path, column, type_name in projections),
+	           ", ".join("?" * len(projections)))
+
+	entries = {}
+	for index, row in inserted:
+		data = records[index][0]
+		values = [row[0], row[1]]
+		for path, column, type_name in projections:
+			value = _extract_field(data, path)
+			try:
+				values.append(None if value is None else _PROJECTION_TYPES[type_name][1](value))
+			except (TypeError, ValueError):
+				values.append(None)
+		entries.setdefault(_projection_table(_partition_name(source, row[3][:7])), []).append(tuple(values))
+
+	for table, rows in sorted(entries.items()):
+		_execute_many(connection, query.format(table), rows)
+
+
+def _partition_name(source, period):
+	"""Returns the name of a source's partition for a month (`YYYY-MM`). """
+	return "WAREHOUSE_PART_{}_{}".format(re.sub(r"\W", "_", source), period.replace("-", ""))
+
+
+def _projection_table(partition):
+	"""Returns the name of a partition's projection table. """
+	return partition + "_P"
+
+
+def _source_partitions(connection, source, since=None, until=None, schema="main"):
+	"""Lists a source's partitions, optionally only those overlapping a date
+	range.
+
+	Args:
+	  connection (db): The connection to the database.
+	  source (string): The upper-cased datasource identifier.
+	  since (datetime, optional): The start of the range.
+	  until (datetime, optional): The end of the range.
+	  schema (string, optional): The schema holding the source's partitions.
+
+	Returns:
+	  list of string: Partition names, oldest first.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	if not _is_attached(schema):
+		return []
+
+	query = "SELECT name FROM {} WHERE source_identifier = :source".format(_qualify(schema, "warehouse_partitions"))
+	params = {"source": source}
+	if since:
+		query += " AND range_end > :since"
+		params["since"] = cdls.serialization.date_to_string(since)
+	if until:
+		query += " AND range_start < :until"
+		params["until"] = cdls.serialization.date_to_string(until)
+	query += " ORDER BY period"
+
+	return [row[0] for row in _execute_query(connection, query, params)]
+
+
+def _source_view(source):
+	"""Returns the name of the view over a source's partitions. """
+	return "WAREHOUSE_SRC_" + re.sub(r"\W", "_", source)
+
+
+def _main_transaction(connection):
+	"""Returns a context manager for writing to the main database alongside
+	`connection`.
+
+	Writes join the caller's transaction when `connection` is the main
+	connection; otherwise (on a shard) they get a short transaction of their
+	own.
+	"""
+	main = _connect()
+	if connection is main:
+		return contextlib.nullcontext(main)
+	return _locked(main)
+
+
+@contextlib.contextmanager
+def _locked(connection):
+	"""Runs a transaction on the main connection under its lock. """
+	with _lock, connection:
+		yield connection
+
+
+def _open_shard(key):
+	"""Opens (creating if need be) a shard's writer connection.
+
+	Args:
+	  key (string): The shard.
+
+	Returns:
+	  tuple: (connection, lock)
+
+	Raises:
+	  DatabaseError
+
+	"""
+	with _lock:
+		if key in _shards:
+			return _shards[key]
+
+		connection = sqlite3.connect(_shard_path(key), check_same_thread=False)
+		_execute_query(connection, "PRAGMA journal_mode = WAL")
+		if not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'WAREHOUSE_PARTITIONS'").fetchone():
+			with connection:
+				_execute_query(connection, _DDL_CREATE_PARTITIONS)
+				_create_views(connection)
+
+		_shards[key] = (connection, threading.Lock())
+		_known_shards.add(key)
+		return _shards[key]
+
+
+def _qualify(schema, name):
+	"""Returns a schema-qualified, quoted object name. """
+	return "`{}`.`{}`".format(schema, name)
+
+
+def _range_conditions(export_range, since, until):
+	"""Returns the WHERE conditions and parameters selecting an export range's
+	rows, optionally only within a date range.
+	"""
+	conditions, params = [], {}
+	if export_range.low is not None:
+		conditions.append("seq > :low")
+		params["low"] = export_range.low
+	if export_range.high is not None:
+		conditions.append("seq <= :high")
+		params["high"] = export_range.high
+	if since:
+		conditions.append("record_date >= :since")
+		params["since"] = cdls.serialization.date_to_string(since)
+	if until:
+		conditions.append("record_date < :until")
+		params["until"] = cdls.serialization.date_to_string(until)
+	return (conditions, params)
+
+
+def _reserve_seq(connection, count):
+	"""Bumps the SEQ counter in CDLS_SEQUENCES on the main connection.
+
+	Args:
+	  connection (db): The main connection, in a transaction.
+	  count (int): The number of values to reserve.
+
+	Returns:
+	  int: The first reserved value.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = "UPDATE cdls_sequences SET value = value + :count WHERE name = 'WAREHOUSE' RETURNING value"
+	rows = _execute_query(connection, query, {"count": count}).fetchall()
+	if not rows:
+		raise DatabaseError("The SEQ allocator is missing; has the database been installed?")
+	return rows[0][0] - count + 1
+
+
+def _schema(source):
+	"""Returns the schema holding a source's data on the read facade. """
+	key = _shard_key(source)
+	return "main" if key is None else "shard_" + key
+
+
+def _seq_horizon():
+	"""Returns the SEQ at or below which every row this process will write has
+	been committed, or None when there are no shard writers.
+
+	Shard writers hand out SEQ values from blocks reserved ahead of time, so
+	one shard can commit values above those another has yet to use.  The SEQ
+	counter is read first; then any block which could still hand out values
+	at or below it is retired, under its shard's lock so that no batch is in
+	flight.  The shard reserves a fresh block for its next batch.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	with _lock:
+		shards = list(_shards.values())
+	if not shards:
+		return None
+
+	with _locked(_connect()) as connection:
+		rows = _execute_query(connection, "SELECT value FROM cdls_sequences WHERE name = 'WAREHOUSE'").fetchall()
+	horizon = rows[0][0] if rows else 0
+
+	for connection, lock in shards:
+		with lock:
+			block = _seq_blocks.get(connection)
+			if block and block[0] <= horizon:
+				block[0] = block[1]
+	return horizon
+
+
+def _shard_key(source):
+	"""Returns the shard a source writes to (None for the main file). """
+	shard = _sources.get(source.strip().upper(), {}).get("shard")
+	if shard:
+		return re.sub(r"\W", "_", str(shard)).lower()
+	if cdls.config.DB_SHARD_COUNT:
+		return str(zlib.crc32(source.strip().upper().encode()) % cdls.config.DB_SHARD_COUNT)
+	return None
+
+
+def _shard_key_from_path(path):
+	"""Returns the shard a shard file belongs to. """
+	prefix = os.path.basename(os.path.splitext(_DBPATH)[0]) + ".shard-"
+	return os.path.basename(path)[len(prefix):-len(".db")]
+
+
+def _shard_path(key):
+	"""Returns the path of a shard's database file. """
+	return "{}.shard-{}.db".format(os.path.splitext(_DBPATH)[0], key)
+
+
+def _unpackage(document):
+	"""Rebuilds a record from its warehoused JSON document (see
+	`cdls.serialization.encode`).
+
+	Objects come back as stand-ins of the same class name holding the same
+	attributes, so they serialize to the same document again.
+
+	Args:
+	  document (dict): The decoded document.
+
+	Returns:
+	  mixed
+
+	"""
+	(name, contents) = (document["$class"], document["$contents"])
+	if not isinstance(contents, dict) or name == "dict":
+		return contents
+
+	record = type(name, (), {})()
+	record.__dict__.update(contents)
+	return record
+
+
+def _writer(source):
+	"""Returns the (connection, lock) that a source's records are written
+	through.
+	"""
+	key = _shard_key(source)
+	if key is None:
+		return (_connect(), _lock)
+	return _shards.get(key) or _open_shard(key)
+
+
+def _stream(database, query, params, batch_size=None):
+	"""Runs a query on a connection of its own, yielding its rows a batch at a
+	time as they're fetched.
+
+	Args:
+	  database (string): The path of the database file to read.
+	  query (string): The SQL to be executed.
+	  params (dict): Any SQL parameters to be bound.
+	  batch_size (int, optional): Rows per batch (defaults to DB_BATCH_SIZE).
+
+	Yields:
+	  list of tuple
+
+	Raises:
+	  DatabaseError
+
+	"""
+	try:
+		connection = sqlite3.connect(database, check_same_thread=False)
+	except sqlite3.Error as e:
+		raise DatabaseError("sqlite3: {}".format(e)) from e
+
+	try:
+		cursor = _execute_query(connection, query, params)
+		while True:
+			try:
+				rows = cursor.fetchmany(batch_size or cdls.config.DB_BATCH_SIZE)
+			except sqlite3.Error as e:
+				raise DatabaseError("sqlite3: {}".format(e), query, params) from e
+			if not rows:
+				break
+			yield rows
+	finally:
+		connection.close()
+
+
+def _insert_isolated(connection, query, rows, indexes):
+	"""Inserts a batch of rows, isolating any that fail on their own.
+
+	The whole batch is tried at once under a savepoint; if a row-specific
+	error comes up, the savepoint is rolled back and the rows are inserted one
+	at a time instead.
+
+	Args:
+	  connection (db): The connection to the database.
+	  query (string): The INSERT statement.
+	  rows (list of tuple): The SQL parameters for each row.
+	  indexes (list of int): The batch index of each row.
+
+	Returns:
+	  list of tuple: (index, DatabaseError) for each row which failed.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = query.strip()
+	connection.execute("SAVEPOINT warehouse_batch")
+	try:
+		connection.executemany(query, rows)
+		connection.execute("RELEASE warehouse_batch")
+		return []
+	except _ROW_ERRORS:
+		connection.execute("ROLLBACK TO warehouse_batch")
+		connection.execute("RELEASE warehouse_batch")
+	except sqlite3.OperationalError as e:
+		raise DatabaseError("sqlite3: {}".format(e), query) from e
+
+	errors = []
+	for index, row in zip(indexes, rows):
+		try:
+			connection.execute(query, row)
+		except _ROW_ERRORS as e:
+			errors.append((index, DatabaseError("sqlite3: {}".format(e), query, error_type=type(e).__name__)))
+		except sqlite3.OperationalError as e:
+			raise DatabaseError("sqlite3: {}".format(e), query) from e
+	return errors
+
+
+def _reject(connection, records, errors, source):
+	"""Saves failed records to WAREHOUSE_REJECTS.
+
+	Each record is kept as the JSON document it would have been warehoused
+	as, so it can be replayed later.  Records which fail to serialize are
+	kept as a salvaged document (see `cdls.serialization.encode_salvaged`)
+	so they can still be replayed, with their `repr` in PAYLOAD_REPR for
+	whoever's debugging.  Only those whose state can't be read at all have no
+	payload to replay.
+
+	Args:
+	  connection (db): The connection to the database.
+	  records (list of tuple): The batch's (data, record_date) pairs.
+	  errors (list of tuple): (index, DatabaseError) for each failed record.
+	  source (string): The datasource identifier.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = """
+INSERT INTO warehouse_rejects
+	( guid,  source_identifier,  record_date,  rejected_on,  error_type,  error_message,  payload_text,  payload_repr)
+VALUES
+	(?, ?, ?, ?, ?, ?, ?, ?)
+"""
+	rejected_on = cdls.serialization.date_to_string(datetime.datetime.now())
+	rows = []
+	for index, error in errors:
+		data, record_date = records[index]
+
+		payload_repr = None
+		try:
+			payload_text = cdls.serialization.encode(data)
+		except Exception:
+			try:
+				payload_text = cdls.serialization.encode_salvaged(data)
+			except Exception:
+				payload_text = None
+
+			try:
+				payload_repr = repr(data)
+			except Exception as e:
+				payload_repr = "<repr failed: {}>".format(e)
+
+		try:
+			record_date = cdls.serialization.date_to_string(record_date)
+		except Exception:
+			record_date = None
+
+		rows.append((str(uuid.uuid1()).upper(),
+		             source.strip().upper(),
+		             record_date,
+		             rejected_on,
+		             error.error_type,
+		             str(error),
+		             payload_text,
+		             payload_repr))
+
+	_execute_many(connection, query, rows)
+
+
+def _execute_query(connection, query, params=None):
+	"""Standard operation for executing a SQL query against the database.
+
+	Args:
+	  connection (db): The connection to the database.
+	  query (string): The SQL to be executed.
+	  params (dict, optional): Any SQL parameters to be bound.
+
+	Raises:
+	  DatabaseError
+
+	"""
+	query = query.strip()
+	try:
+		if params:
+			return connection.execute(query, params)
+		else:
+			return connection.execute(query)
+	except sqlite3.OperationalError as e:
+		raise DatabaseError("sqlite3: {}".format(e), query, params) from e
 
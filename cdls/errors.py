@@ -27,11 +27,24 @@ class CDLSError(Exception):
 
 
 class DatabaseError(CDLSError):
-	"""Represents a failure to connect to or query the local database. """
-	def __init__(self, original_exception, query=None, params=None):
+	"""Represents a failure to connect to or query the local database.
+
+	Args:
+	  original_exception (mixed): The underlying exception or message
+	  query (string, optional): The SQL that failed
+	  params (dict, optional): The parameters bound to the SQL
+	  error_type (string, optional): The name of the underlying error type;
+	    defaults to the type of `original_exception`
+
+	"""
+	def __init__(self, original_exception, query=None, params=None, error_type=None):
 		super().__init__(str(original_exception))
 		self._query = query
 
+		if error_type is None:
+			error_type = type(original_exception).__name__ if isinstance(original_exception, Exception) else type(self).__name__
+		self.error_type = error_type
+
 		assert isinstance(params, dict) or params is None
 		self._params = params
 
@@ -48,6 +61,11 @@ class DatabaseError(CDLSError):
 			return output
 
 
+class ConfigurationError(CDLSError):
+	"""Represents an invalid setting in `cdls.config`. """
+	pass
+
+
 class ExtractError(CDLSError):
 	"""Represents a failure to set up or perform an extraction. """
 	pass
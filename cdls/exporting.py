@@ -0,0 +1,131 @@
+"""
+Bulk export of the warehouse to JSONL or CSV files (or to a columnar
+snapshot, see `cdls.columnar`).
+
+Rows are streamed out of the warehouse a batch at a time (see
+`cdls.db.read_range`) and written straight out, so an export runs in
+constant memory however many rows it covers.  Split into part files, each
+part is a partition or a SEQ range within one and the parts are written in
+parallel.
+
+Attributes:
+  FORMATS (tuple): The supported output formats.
+  _CSV_HEADER (list): The columns of a CSV export.
+  _GZIP_LEVEL (int): The compression level of gzipped exports.
+  _INDENTATION (Pattern): Line breaks and indentation in the stored JSON.
+  ExportResult (namedtuple): What an export wrote.
+
+"""
+
+import collections
+import concurrent.futures
+import csv
+import gzip
+import json
+import os
+import re
+
+import cdls.columnar
+import cdls.db
+from cdls.errors import CDLSError
+
+FORMATS = ("jsonl", "csv", "columnar")
+
+_CSV_HEADER = ["seq", "guid", "source", "record_date", "document"]
+_GZIP_LEVEL = 6
+_INDENTATION = re.compile(r"\n\s*")
+
+ExportResult = collections.namedtuple("ExportResult", ("rows", "files"))
+
+
+def export(source, path, format="jsonl", since=None, until=None, compress=False, part_rows=None, workers=1, fields=None):
+	"""Exports a source's warehouse rows.
+
+	Args:
+	  source (string): The datasource identifier.
+	  path (string): The file to write or, with `part_rows` or a columnar
+	    snapshot, the directory to write into.
+	  format (string, optional): One of `FORMATS`.
+	  since (datetime, optional): Only rows with a RECORD_DATE at or after this.
+	  until (datetime, optional): Only rows with a RECORD_DATE before this.
+	  compress (bool, optional): Whether to gzip the output.
+	  part_rows (int, optional): The most rows per part file.
+	  workers (int, optional): How many part files to write at once.
+	  fields (dict, optional): For a columnar snapshot, fields (dotted paths)
+	    to their type; defaults to the source's projections.
+
+	Returns:
+	  ExportResult: The number of rows and the files written.
+
+	Raises:
+	  CDLSError
+	  DatabaseError
+
+	"""
+	if format not in FORMATS:
+		raise CDLSError("Unsupported export format '{}'".format(format))
+
+	if format == "columnar":
+		if compress or part_rows:
+			raise CDLSError("Columnar snapshots can't be compressed or split into parts")
+		rows = cdls.columnar.write_snapshot(source, path, fields, since, until)
+		return ExportResult(rows, [path])
+
+	if not part_rows:
+		ranges = cdls.db.export_ranges(source, since, until)
+		rows = _write(path, ranges, format, compress, since, until)
+		return ExportResult(rows, [path])
+
+	ranges = cdls.db.export_ranges(source, since, until, part_rows)
+	os.makedirs(path, exist_ok=True)
+	extension = format + (".gz" if compress else "")
+	files = [os.path.join(path, "{}-{:05d}.{}".format(re.sub(r"\W", "_", source.strip().upper()), n, extension)) for n in range(len(ranges))]
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers or 1), thread_name_prefix="cdls-export") as executor:
+		futures = [executor.submit(_write, part, [export_range], format, compress, since, until) for part, export_range in zip(files, ranges)]
+		rows = sum(future.result() for future in futures)
+
+	return ExportResult(rows, files)
+
+
+def _open(path, compress):
+	"""Opens an export file for writing. """
+	if compress:
+		return gzip.open(path, "wt", compresslevel=_GZIP_LEVEL, encoding="utf-8", newline="")
+	return open(path, "w", encoding="utf-8", newline="")
+
+
+def _write(path, ranges, format, compress, since, until):
+	"""Writes the rows in a list of ranges out to a single file.
+
+	Returns:
+	  int: The number of rows written.
+
+	"""
+	rows = 0
+	with _open(path, compress) as fp:
+		if format == "csv":
+			writer = csv.writer(fp)
+			writer.writerow(_CSV_HEADER)
+
+		for export_range in ranges:
+			for batch in cdls.db.read_range(export_range, since, until):
+				if format == "csv":
+					writer.writerows((change.position, change.guid, change.source, change.record_date, _INDENTATION.sub("", change.json)) for change in batch)
+				else:
+					fp.writelines(_to_jsonl(change) for change in batch)
+				rows += len(batch)
+
+	return rows
+
+
+def _to_jsonl(change):
+	"""Formats a warehouse row as a line of JSON, splicing the stored document
+	in as-is rather than parsing it.
+	"""
+	return '{{"seq": {}, "guid": {}, "source": {}, "record_date": {}, "document": {}}}\n'.format(
+		change.position,
+		json.dumps(change.guid),
+		json.dumps(change.source),
+		json.dumps(change.record_date),
+		_INDENTATION.sub("", change.json))
@@ -1,3 +1,174 @@
-from cdls.errors import (ExtractError, CDLSError)
+"""
+Extractors turn a stream of bytes from a datasource into documents.
 
-raise CDLSException("Not yet implemented")
+Each extractor reads from a binary file-like object (an open file, an HTTP
+response, ...) a chunk or a line at a time and yields documents as soon as
+they've been parsed, so a response body never has to be held in memory as a
+whole.
+
+Attributes:
+  EXTRACTORS (dict): Format names to extractors.
+  _CHUNK_SIZE (int): Bytes read at a time by `json_documents`.
+  _WHITESPACE (Pattern): JSON whitespace.
+
+"""
+
+import codecs
+import json
+import re
+
+from cdls.errors import ExtractError
+
+_CHUNK_SIZE = 65536
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def extract(format, fp):
+	"""Streams documents out of a file-like object.
+
+	Args:
+	  format (string): One of `EXTRACTORS`.
+	  fp (file): A binary file-like object.
+
+	Returns:
+	  generator: The documents.
+
+	Raises:
+	  ExtractError
+
+	"""
+	try:
+		extractor = EXTRACTORS[format]
+	except KeyError:
+		raise ExtractError("Unsupported format '{}'".format(format))
+	return extractor(fp)
+
+
+def json_documents(fp, chunk_size=_CHUNK_SIZE):
+	"""Yields the elements of a top-level JSON array one at a time, or a
+	single document if the top level isn't an array.
+
+	Raises:
+	  ExtractError
+
+	"""
+	decoder = json.JSONDecoder()
+	reader = _ChunkReader(fp, chunk_size)
+
+	position = reader.skip_whitespace(0)
+	if reader.eof_at(position):
+		return
+
+	if reader.buffer[position] != "[":
+		while not reader.eof:
+			reader.fill()
+		try:
+			(document, end) = decoder.raw_decode(reader.buffer, position)
+		except ValueError as e:
+			raise ExtractError("Invalid JSON: {}".format(e)) from e
+		if not reader.eof_at(reader.skip_whitespace(end)):
+			raise ExtractError("Invalid JSON: extra data after the document")
+		yield document
+		return
+
+	position = reader.skip_whitespace(position + 1)
+	first = True
+	while True:
+		if reader.eof_at(position):
+			raise ExtractError("Invalid JSON: unterminated array")
+		if reader.buffer[position] == "]":
+			return
+
+		if not first:
+			if reader.buffer[position] != ",":
+				raise ExtractError("Invalid JSON: expected ',' at offset {}".format(reader.offset + position))
+			position = reader.skip_whitespace(position + 1)
+		first = False
+
+		# Only trust a value once something follows it, otherwise a number
+		# split across chunks would be cut short
+		while True:
+			try:
+				(document, end) = decoder.raw_decode(reader.buffer, position)
+			except ValueError as e:
+				if reader.eof:
+					raise ExtractError("Invalid JSON: {}".format(e)) from e
+				reader.fill()
+				continue
+			if end < len(reader.buffer) or reader.eof:
+				break
+			reader.fill()
+
+		yield document
+		position = reader.skip_whitespace(reader.compact(end))
+
+
+def json_lines(fp):
+	"""Yields one document per non-blank line.
+
+	Raises:
+	  ExtractError
+
+	"""
+	for number, line in enumerate(fp, 1):
+		if not line.strip():
+			continue
+		try:
+			yield json.loads(line)
+		except ValueError as e:
+			raise ExtractError("Invalid JSON on line {}: {}".format(number, e)) from e
+
+
+class _ChunkReader:
+	"""Decodes a binary stream into a text buffer a chunk at a time, dropping
+	whatever has already been parsed.
+
+	Attributes:
+	  buffer (string): Decoded text not yet discarded.
+	  offset (int): Where `buffer` starts in the decoded stream.
+	  eof (bool): Whether the stream has been read to the end.
+
+	"""
+	def __init__(self, fp, chunk_size):
+		self.buffer      = ""
+		self.offset      = 0
+		self.eof         = False
+		self._fp         = fp
+		self._chunk_size = chunk_size
+		self._decoder    = codecs.getincrementaldecoder("utf-8")()
+
+	def compact(self, position):
+		"""Discards the buffer up to `position`, returning its new index. """
+		self.buffer = self.buffer[position:]
+		self.offset += position
+		return 0
+
+	def eof_at(self, position):
+		"""Returns whether `position` is past the end of the stream, reading
+		more if needed to tell.
+		"""
+		while position >= len(self.buffer) and not self.eof:
+			self.fill()
+		return position >= len(self.buffer)
+
+	def fill(self):
+		chunk = self._fp.read(self._chunk_size)
+		if not chunk:
+			self.eof = True
+		try:
+			self.buffer += self._decoder.decode(chunk, final=self.eof)
+		except UnicodeDecodeError as e:
+			raise ExtractError("Invalid UTF-8: {}".format(e)) from e
+
+	def skip_whitespace(self, position):
+		while True:
+			position = _WHITESPACE.match(self.buffer, position).end()
+			if position < len(self.buffer) or self.eof:
+				return position
+			self.fill()
+
+
+EXTRACTORS = {
+	"json":  json_documents,
+	"jsonl": json_lines
+}
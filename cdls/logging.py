@@ -5,24 +5,57 @@ Attributes:
   _DEFAULT_BANNER_WIDTH (int): Banner will be this number of characters wide.
   _DEFAULT_STACK_DEPTH (int): Controls how deep to look into the stack for the
     name of the invoking function.
+  _LEVELS (dict): Severity of each logging level; anything below the
+    configured minimum is discarded.
   _TEMPLATE (string): The template for each normal log entry.
   _OUTFILE  (string): The file being written to.
+  _SINK_BATCH_SIZE (int): The most records the background writer will take
+    off the queue at once.
+  _sink (_Sink): The background writer, started on first use.
+  _rotation_lock (Lock): Serializes rotation and pruning of log segments.
+  _compressing (set): Segments still being compressed, which pruning leaves
+    alone.
 
 """
 
+import atexit
 import datetime
-import inspect
+import glob
+import gzip
+import json
+import os
 import os.path
+import queue
+import shutil
+import sys
+import threading
 import traceback
 
 import cdls.config
+import cdls.metrics
+from cdls.errors import ConfigurationError
 
 _DEFAULT_BANNER_WIDTH = 80
 _DEFAULT_STACK_DEPTH = 3
+_LEVELS = {"debug": 10, "info": 20, "warn": 30, "error": 40}
 _TEMPLATE = cdls.config.LOGGING_FORMAT
 _OUTFILE  = os.path.join(cdls.config.LOGGING_DIRECTORY,
 	                     "{:%Y-%m}.log".format(datetime.date.today()))
 
+_SINK_BATCH_SIZE = 512
+
+_sink = None
+_sink_lock = threading.Lock()
+_rotation_lock = threading.Lock()
+_compressing = set()
+
+_METRIC_RECORDS = cdls.metrics.counter("cdls_log_records_total", "Log records emitted", ("level",))
+_METRIC_RECORDS_BY_LEVEL = {level: _METRIC_RECORDS.labels(level) for level in _LEVELS}
+cdls.metrics.gauge("cdls_log_queue_depth", "Log records waiting for the background writer").set_function(
+	lambda: _sink._queue.qsize() if _sink else 0)
+cdls.metrics.gauge("cdls_log_records_dropped", "Log records discarded by the overflow policy").set_function(
+	lambda: _sink.dropped if _sink else 0)
+
 
 def banner(level, message, *args, **kwargs):
 	"""
@@ -40,6 +73,9 @@ def banner(level, message, *args, **kwargs):
 
 	"""
 
+	if not is_enabled(level, kwargs.get("tag")):
+		return
+
 	width = kwargs.get("width", _DEFAULT_BANNER_WIDTH)
 
 	hr = "*" * width
@@ -71,6 +107,24 @@ def banner(level, message, *args, **kwargs):
 	_log_entry(level, hr, **kwargs)
 
 
+def debug(message, *args, **kwargs):
+	"""Logs a DEBUG-level message.
+
+	Args:
+	  message (string): The message to be logged
+	  *args (dict, optional): Any items to include in the formatting
+	  **kwargs (dict, optional): Any context flags (refer to _log_entry for
+	    more flag info).
+
+	Returns:
+	  string: The line that was logged, or None if DEBUG is disabled
+
+	"""
+	if _LEVELS["debug"] < _minimum_level(kwargs.get("tag")):
+		return None
+	return _log_entry("debug", message, *args, **kwargs)
+
+
 def info(message, *args, **kwargs):
 	"""Logs an INFO-level message.
 
@@ -81,9 +135,11 @@ def info(message, *args, **kwargs):
 	    more flag info).
 	
 	Returns:
-	  string: The line that was logged
+	  string: The line that was logged, or None if INFO is disabled
 
 	"""
+	if _LEVELS["info"] < _minimum_level(kwargs.get("tag")):
+		return None
 	return _log_entry("info", message, *args, **kwargs)
 
 
@@ -97,9 +153,11 @@ def error(message, *args, **kwargs):
 	    more flag info).
 
 	Returns:
-	  string: The line that was logged
+	  string: The line that was logged, or None if ERROR is disabled
 
 	"""
+	if _LEVELS["error"] < _minimum_level(kwargs.get("tag")):
+		return None
 	return _log_entry("error", message, *args, **kwargs)
 
 
@@ -113,9 +171,11 @@ def warn(message, *args, **kwargs):
 	    more flag info).
 
 	Returns:
-	  string: The line that was logged
+	  string: The line that was logged, or None if WARN is disabled
 
 	"""
+	if _LEVELS["warn"] < _minimum_level(kwargs.get("tag")):
+		return None
 	return _log_entry("warn", message, *args, **kwargs)
 
 
@@ -145,7 +205,8 @@ Stack Trace:
 """
 
 	exception_type = type(exception).__name__
-	timestamp      = _generate_timestamp()
+	now            = datetime.datetime.now()
+	timestamp      = _generate_timestamp(now)
 	message        = str(exception)
 	stack_trace    = traceback.format_exc()
 
@@ -160,30 +221,327 @@ Stack Trace:
 	# Assemble the formatted exception log
 	output = template.format(timestamp, exception_type, message, stack_trace).strip()
 
-	# Write to log file
-	_append_to_logfile(output)
+	record = None
+	if cdls.config.LOGGING_OUTPUT == "json":
+		record = _make_record(now, "error", None, None, message)
+		record["exception"] = exception_type
+		record["traceback"] = stack_trace
+
+	# Write to log file, directly accessing LOGGING_NOISY setting because it
+	# may change at runtime
+	_emit(output, echo=cdls.config.LOGGING_NOISY, record=record)
+
+	output = _log_entry("error", str(exception))
 
-	# Directly access LOGGING_NOISY setting because it may change at runtime
-	if cdls.config.LOGGING_NOISY:
-		print(output)
+	# Make sure the evidence hits the disk in case we're about to go down
+	flush()
 
-	return _log_entry("error", str(exception))
+	return output
+
+
+def is_enabled(level, tag=None):
+	"""Checks whether a message at the given level would be logged.
+
+	LOGGING_LEVEL sets the global minimum, which LOGGING_SOURCE_LEVELS can
+	override per tag (i.e., per datasource identifier).  Both are read on
+	every call because they may change at runtime.
+
+	Args:
+	  level (string): The logging level
+	  tag (string, optional): The tag the message would be logged under
+
+	Returns:
+	  bool
+
+	"""
+	return _LEVELS.get(level.strip().lower(), _LEVELS["error"]) >= _minimum_level(tag)
+
+
+def check_config():
+	"""Checks the logging levels in `cdls.config`, so that a misspelled one
+	fails up front rather than on the first log call.
+
+	Raises:
+	  ConfigurationError
+
+	"""
+	_severity(cdls.config.LOGGING_LEVEL, "LOGGING_LEVEL")
+	for tag, level in cdls.config.LOGGING_SOURCE_LEVELS.items():
+		_severity(level, "LOGGING_SOURCE_LEVELS[{!r}]".format(tag))
+
+
+def flush():
+	"""Blocks until every queued log record has been written. """
+	if _sink:
+		_sink.flush()
+
+
+class _Sink:
+	"""Writes log records from a background thread, in batches, to a
+	persistently open log file and (optionally) STDOUT.
+
+	Args:
+	  maxsize (int): The most records that can be waiting in the queue.
+	  overflow (string): What to do with a new record when the queue is full;
+	    "block" waits for room, "drop_newest" discards the new record and
+	    "drop_oldest" discards the record at the head of the queue.
+
+	Attributes:
+	  dropped (int): The number of records discarded so far.
+	  _reported (int): The number of discarded records already reported.
+	  _closing (bool): Set once `close` has been called; records put after
+	    that are dropped, so none can evict the stop sentinel.
+	  _lock (Lock): Makes checking `_closing` and queueing atomic.
+
+	"""
+	def __init__(self, maxsize, overflow):
+		self.dropped   = 0
+		self._reported = 0
+		self._closing  = False
+		self._lock     = threading.Lock()
+		self._overflow = overflow
+		self._queue    = queue.Queue(maxsize)
+		self._fp       = None
+		self._path     = None
+		self._thread   = threading.Thread(target=self._run, name="cdls-log-sink", daemon=True)
+		self._thread.start()
+
+
+	def close(self):
+		"""Writes out anything still queued and stops the writer. """
+		with self._lock:
+			self._closing = True
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+
+	def flush(self):
+		"""Blocks until everything queued before this call has been written. """
+		if self._thread.is_alive():
+			marker = threading.Event()
+			self._queue.put(marker)
+			marker.wait()
+
+
+	def put(self, line, echo, record=None):
+		"""Queues a record according to the overflow policy.
+
+		Args:
+		  line (string): The formatted log record
+		  echo (bool): Whether the record should also go to STDOUT
+		  record (dict, optional): Structured form of the record for JSON output
+
+		"""
+		item = (line, echo, record)
+		if self._overflow not in ("drop_newest", "drop_oldest"):
+			if self._closing:
+				self.dropped += 1
+			else:
+				self._queue.put(item)
+			return
+
+		with self._lock:
+			if self._closing:
+				self.dropped += 1
+				return
+
+			while True:
+				try:
+					self._queue.put_nowait(item)
+					return
+				except queue.Full:
+					if self._overflow == "drop_newest":
+						self.dropped += 1
+						return
+
+				try:
+					evicted = self._queue.get_nowait()
+					if isinstance(evicted, threading.Event):
+						evicted.set()
+					else:
+						self.dropped += 1
+				except queue.Empty:
+					pass
+
+
+	def _run(self):
+		"""Writer loop; drains the queue in batches until told to stop. """
+		running = True
+		while running:
+			batch = [self._queue.get()]
+			try:
+				while len(batch) < _SINK_BATCH_SIZE:
+					batch.append(self._queue.get_nowait())
+			except queue.Empty:
+				pass
+
+			running = None not in batch
+			markers = [item for item in batch if isinstance(item, threading.Event)]
+			records = [item for item in batch if isinstance(item, tuple)]
+
+			try:
+				self._write(records)
+			except Exception as e:
+				sys.stderr.write("cdls.logging: failed to write log records: {}\n".format(e))
+
+			for marker in markers:
+				marker.set()
+
+		if self._fp:
+			self._fp.close()
+
+
+	def _write(self, records):
+		"""Writes a batch of records to the log file and STDOUT. """
+		if self.dropped > self._reported:
+			now = datetime.datetime.now()
+			line = "{} log records were dropped".format(self.dropped - self._reported)
+			records.append((_TEMPLATE.format(timestamp=_generate_timestamp(now), level="WARN", message=line),
+			                True,
+			                _make_record(now, "warn", None, None, line)))
+			self._reported = self.dropped
+
+		if not records:
+			return
+
+		# Follow the log file if it gets moved
+		if self._path != _OUTFILE:
+			if self._fp:
+				self._fp.close()
+			self._fp = open(_OUTFILE, "a")
+			self._path = _OUTFILE
+
+		self._fp.write("".join(_format_for_file(line, record) + "\n" for line, echo, record in records))
+		self._fp.flush()
+
+		# Start a new segment once this one is full
+		max_bytes = cdls.config.LOGGING_MAX_BYTES
+		if max_bytes and self._fp.tell() >= max_bytes:
+			self._fp.close()
+			_rotate(self._path)
+			self._fp = open(self._path, "a")
+
+		echoed = "".join(line + "\n" for line, echo, record in records if echo)
+		if echoed:
+			sys.stdout.write(echoed)
+			sys.stdout.flush()
 
 
 def _append_to_logfile(message):
 	"""Adds a new log line to the log file."""
 	with open(_OUTFILE, "a") as fp:
 		fp.write(message + "\n")
+		size = fp.tell()
 
+	max_bytes = cdls.config.LOGGING_MAX_BYTES
+	if max_bytes and size >= max_bytes:
+		_rotate(_OUTFILE)
+
+
+def _close_sink():
+	"""Stops the background writer (registered to run at exit). """
+	global _sink
+	if _sink:
+		_sink.close()
+		_sink = None
+
+
+def _compress_segment(path):
+	"""Gzips a rotated log segment, then prunes old segments. """
+	try:
+		with open(path, "rb") as fp_in, gzip.open(path + ".gz.tmp", "wb") as fp_out:
+			shutil.copyfileobj(fp_in, fp_out)
+		os.replace(path + ".gz.tmp", path + ".gz")
+		os.remove(path)
+	except OSError as e:
+		sys.stderr.write("cdls.logging: failed to compress '{}': {}\n".format(path, e))
+	finally:
+		with _rotation_lock:
+			_compressing.discard(path)
 
-def _generate_timestamp():
+	_prune_segments(path.rsplit(".", 1)[0])
+
+
+def _emit(output, echo=True, record=None):
+	"""Sends a formatted log record to the log file and, optionally, STDOUT.
+
+	Goes through the background writer when LOGGING_ASYNC is on, otherwise
+	writes synchronously.
+
+	Args:
+	  output (string): The formatted log record
+	  echo (bool, optional): Whether to also print the record.
+	  record (dict, optional): Structured form of the record, written instead
+	    of `output` when LOGGING_OUTPUT is "json".
+
+	"""
+	if cdls.config.LOGGING_ASYNC:
+		_get_sink().put(output, echo, record)
+	else:
+		if echo:
+			print(output)
+		_append_to_logfile(_format_for_file(output, record))
+
+
+def _format_for_file(line, record):
+	"""Returns the line to write to the log file for a record. """
+	if record is None:
+		return line
+	return json.dumps(record, sort_keys=True)
+
+
+def _generate_timestamp(now=None):
 	"""Returns a formatted timestamp string."""
-	return datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f")
+	return (now or datetime.datetime.now()).strftime("%m/%d %H:%M:%S,%f")
+
+
+def _minimum_level(tag):
+	"""Returns the severity below which messages for a tag are discarded.
+
+	Raises:
+	  ConfigurationError
+
+	"""
+	if tag and tag in cdls.config.LOGGING_SOURCE_LEVELS:
+		return _severity(cdls.config.LOGGING_SOURCE_LEVELS[tag], "LOGGING_SOURCE_LEVELS[{!r}]".format(tag))
+	return _severity(cdls.config.LOGGING_LEVEL, "LOGGING_LEVEL")
+
+
+def _severity(level, setting):
+	"""Returns the severity of a configured logging level.
+
+	Args:
+	  level (string): The configured level
+	  setting (string): The setting it came from, for the error message
+
+	Raises:
+	  ConfigurationError
+
+	"""
+	try:
+		return _LEVELS[level.lower()]
+	except (KeyError, AttributeError):
+		raise ConfigurationError("{0} must be one of {1}, not {2!r}".format(setting, ", ".join(_LEVELS), level)) from None
+
+
+def _get_sink():
+	"""Returns the background writer, starting it if needed. """
+	global _sink
+	if not _sink:
+		with _sink_lock:
+			if not _sink:
+				_sink = _Sink(cdls.config.LOGGING_QUEUE_SIZE, cdls.config.LOGGING_OVERFLOW)
+				atexit.register(_close_sink)
+	return _sink
 
 
 def _get_invoking_method_name(depth):
 	"""Gets the name of the invoking method.
 
+	Walks straight to the requested frame rather than building the whole
+	stack (and its source context) the way inspect.stack() would.
+
 	Args:
 	  depth (int): The depth in the call stack to peek
 
@@ -191,7 +549,21 @@ def _get_invoking_method_name(depth):
 	  string
 
 	"""
-	return inspect.stack()[depth][3]
+	try:
+		return sys._getframe(depth).f_code.co_name
+	except ValueError:
+		return "?"
+
+
+def _make_record(now, level, tag, context, message):
+	"""Returns the structured (JSON-lines) form of a log record. """
+	return {
+		"timestamp": now.isoformat(),
+		"level":     level.strip().upper(),
+		"tag":       tag,
+		"context":   context,
+		"message":   message
+	}
 
 
 def _log_entry(level, message, *args, **kwargs):
@@ -218,26 +590,93 @@ def _log_entry(level, message, *args, **kwargs):
 
 	"""
 
-	# Tag the message with the context name
-	stack_depth = _DEFAULT_STACK_DEPTH
-	stack_depth += kwargs.get("degree", 0)
-	context = kwargs.get("context", _get_invoking_method_name(stack_depth))
+	# Tag the message with the context name (LOGGING_CONTEXT may change at runtime)
+	if "context" in kwargs:
+		context = kwargs["context"]
+	elif cdls.config.LOGGING_CONTEXT:
+		context = _get_invoking_method_name(_DEFAULT_STACK_DEPTH + kwargs.get("degree", 0))
+	else:
+		context = None
 
 	# Add any other pertinent tags to the context
 	tag = kwargs.get("tag")
-	if tag:
-		context = "{}.{}".format(tag, context)
+	if tag and context:
+		prefix = "{}.{}".format(tag, context)
+	else:
+		prefix = tag or context
 
 	# Construct the complete message
-	message = "[{0}:] {1}".format(context, message.strip().format(*args))
+	message = message.strip().format(*args)
+	now = datetime.datetime.now()
 
 	# Format the entire line
-	output = _TEMPLATE.format(timestamp = _generate_timestamp(),
+	output = _TEMPLATE.format(timestamp = _generate_timestamp(now),
 		                          level = level.strip().upper(),
-		                        message = message).strip()
+		                        message = "[{0}:] {1}".format(prefix, message) if prefix else message).strip()
+
+	record = None
+	if cdls.config.LOGGING_OUTPUT == "json":
+		record = _make_record(now, level, tag, context, message)
 
 	# Emit to STDOUT and file
-	print(output)
-	_append_to_logfile(output)
+	_emit(output, record=record)
+
+	try:
+		_METRIC_RECORDS_BY_LEVEL[level].inc()
+	except KeyError:
+		_METRIC_RECORDS.labels(level).inc()
 
 	return output
+
+
+def _prune_segments(path):
+	"""Deletes the oldest rotated segments of a log file beyond
+	LOGGING_BACKUP_COUNT.
+	"""
+	with _rotation_lock:
+		segments = sorted(set(segment[:-3] if segment.endswith(".gz") else segment
+		                      for segment in glob.glob(glob.escape(path) + ".*")
+		                      if not segment.endswith(".tmp")))
+
+		for segment in segments[:max(len(segments) - cdls.config.LOGGING_BACKUP_COUNT, 0)]:
+			if segment in _compressing:
+				continue
+			for name in (segment, segment + ".gz"):
+				try:
+					os.remove(name)
+				except FileNotFoundError:
+					pass
+
+
+def _rotate(path):
+	"""Moves a full log file aside as a timestamped segment, compressing it in
+	the background if LOGGING_COMPRESS is on.
+
+	Does nothing if the file has already been rotated by another thread since
+	it was found to be full.
+
+	Args:
+	  path (string): The log file to rotate
+
+	"""
+	with _rotation_lock:
+		try:
+			if os.path.getsize(path) < cdls.config.LOGGING_MAX_BYTES:
+				return
+		except FileNotFoundError:
+			return
+
+		segment = "{}.{:%Y%m%d%H%M%S%f}".format(path, datetime.datetime.now())
+		os.replace(path, segment)
+		if cdls.config.LOGGING_COMPRESS:
+			_compressing.add(segment)
+
+	if not cdls.config.LOGGING_COMPRESS:
+		_prune_segments(path)
+		return
+
+	try:
+		threading.Thread(target=_compress_segment, args=(segment,), name="cdls-log-gzip").start()
+	except RuntimeError:
+		# Can't start threads while the interpreter is shutting down
+		_compress_segment(segment)
@@ -0,0 +1,334 @@
+"""
+Metrics registry for the CDLS.
+
+Counters, gauges and fixed-bucket histograms are registered by name and
+periodically written to a Prometheus text-format file (for node_exporter's
+textfile collector to pick up).
+
+Updates are plain attribute arithmetic with no locking, so callers on a hot
+path should hold on to the labelled child returned by `labels()` rather than
+looking it up every time.
+
+Attributes:
+  DEFAULT_BUCKETS (tuple): Histogram bucket upper bounds, in seconds.
+  _registry (dict): Every registered metric, keyed by name.
+  _exporter (_Exporter): The background textfile writer, if started.
+
+"""
+
+import atexit
+import bisect
+import math
+import os
+import sys
+import threading
+
+import cdls.config
+from cdls.errors import CDLSError
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_exporter = None
+
+
+def counter(name, description, labelnames=()):
+	"""Returns the counter with the given name, registering it if needed.
+
+	Args:
+	  name (string): The metric name
+	  description (string): Help text
+	  labelnames (tuple of string, optional): The metric's label names
+
+	Returns:
+	  Counter
+
+	"""
+	return _register(Counter, name, description, labelnames)
+
+
+def gauge(name, description, labelnames=()):
+	"""Returns the gauge with the given name, registering it if needed. """
+	return _register(Gauge, name, description, labelnames)
+
+
+def histogram(name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+	"""Returns the histogram with the given name, registering it if needed. """
+	return _register(Histogram, name, description, labelnames, buckets)
+
+
+def render():
+	"""Returns every registered metric in the Prometheus text format. """
+	with _registry_lock:
+		metrics = sorted(_registry.items())
+
+	lines = []
+	for name, metric in metrics:
+		lines.append("# HELP {} {}".format(name, metric.description))
+		lines.append("# TYPE {} {}".format(name, metric.kind))
+		lines.extend(metric.samples())
+	return "\n".join(lines) + "\n"
+
+
+def start_exporter(path, interval):
+	"""Starts periodically writing the metrics textfile.
+
+	Args:
+	  path (string): The file to write
+	  interval (float): Seconds between writes
+
+	"""
+	global _exporter
+	if not _exporter:
+		_exporter = _Exporter(path, interval)
+		atexit.register(stop_exporter)
+
+
+def stop_exporter():
+	"""Writes the metrics textfile one last time and stops the exporter. """
+	global _exporter
+	if _exporter:
+		_exporter.stop()
+		_exporter = None
+
+
+def write_textfile(path):
+	"""Atomically writes every registered metric to a file.
+
+	The metrics are written to a temporary file alongside `path` and renamed
+	into place, so readers never see a partial file.
+
+	Args:
+	  path (string): The file to write
+
+	"""
+	directory = os.path.dirname(path) or "."
+	os.makedirs(directory, exist_ok=True)
+
+	temp_path = "{}.{}.tmp".format(path, os.getpid())
+	with open(temp_path, "w") as fp:
+		fp.write(render())
+	os.replace(temp_path, path)
+
+
+class _Metric:
+	"""Base class for a named metric with zero or more labels.
+
+	Args:
+	  name (string): The metric name
+	  description (string): Help text
+	  labelnames (tuple of string): The metric's label names
+
+	Attributes:
+	  _children (dict): Child metrics keyed by label values
+
+	"""
+	kind = "untyped"
+
+	def __init__(self, name, description, labelnames):
+		self.name        = name
+		self.description = description
+		self.labelnames  = tuple(labelnames)
+		self._children   = {}
+		self._lock       = threading.Lock()
+
+	def labels(self, *values):
+		"""Returns the child metric for a set of label values. """
+		values = tuple(str(value) for value in values)
+		try:
+			return self._children[values]
+		except KeyError:
+			assert len(values) == len(self.labelnames), "Expected labels {}".format(self.labelnames)
+			with self._lock:
+				return self._children.setdefault(values, self._new_child())
+
+	def samples(self):
+		"""Returns the sample lines for every child. """
+		with self._lock:
+			children = sorted(self._children.items())
+
+		lines = []
+		for values, child in children:
+			lines.extend(child.samples(self.name, _format_labels(self.labelnames, values)))
+		return lines
+
+	def _new_child(self):
+		raise CDLSError("Not yet implemented")
+
+
+class Counter(_Metric):
+	"""A monotonically increasing count. """
+	kind = "counter"
+
+	def inc(self, n=1):
+		"""Increments the unlabelled counter. """
+		self.labels().inc(n)
+
+	def _new_child(self):
+		return _CounterChild()
+
+
+class Gauge(_Metric):
+	"""A value that can go up and down. """
+	kind = "gauge"
+
+	def set(self, value):
+		"""Sets the unlabelled gauge. """
+		self.labels().set(value)
+
+	def set_function(self, func):
+		"""Reads the unlabelled gauge from `func` whenever it's rendered. """
+		self.labels().func = func
+
+	def _new_child(self):
+		return _GaugeChild()
+
+
+class Histogram(_Metric):
+	"""Counts observations into fixed buckets.
+
+	Args:
+	  buckets (tuple of float): Bucket upper bounds, ascending.
+
+	"""
+	kind = "histogram"
+
+	def __init__(self, name, description, labelnames, buckets=DEFAULT_BUCKETS):
+		super().__init__(name, description, labelnames)
+		# The +Inf bucket is always there
+		self.buckets = tuple(sorted(bound for bound in buckets if bound != math.inf))
+
+	def observe(self, value):
+		"""Observes a value on the unlabelled histogram. """
+		self.labels().observe(value)
+
+	def _new_child(self):
+		return _HistogramChild(self.buckets)
+
+
+class _CounterChild:
+	__slots__ = ("value",)
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def samples(self, name, labels):
+		return ["{}{} {}".format(name, labels, _format_value(self.value))]
+
+
+class _GaugeChild:
+	__slots__ = ("value", "func")
+
+	def __init__(self):
+		self.value = 0
+		self.func = None
+
+	def dec(self, n=1):
+		self.value -= n
+
+	def inc(self, n=1):
+		self.value += n
+
+	def set(self, value):
+		self.value = value
+
+	def samples(self, name, labels):
+		value = self.func() if self.func else self.value
+		return ["{}{} {}".format(name, labels, _format_value(value))]
+
+
+class _HistogramChild:
+	__slots__ = ("buckets", "counts", "count", "sum")
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts  = [0] * (len(buckets) + 1)
+		self.count   = 0
+		self.sum     = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def samples(self, name, labels):
+		lines = []
+		cumulative = 0
+		bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+		for bound, count in zip(bounds, self.counts):
+			cumulative += count
+			le = 'le="{}"'.format(bound)
+			bucket_labels = "{" + (labels[1:-1] + "," if labels else "") + le + "}"
+			lines.append("{}_bucket{} {}".format(name, bucket_labels, cumulative))
+		lines.append("{}_sum{} {}".format(name, labels, _format_value(self.sum)))
+		lines.append("{}_count{} {}".format(name, labels, self.count))
+		return lines
+
+
+class _Exporter:
+	"""Background thread which rewrites the metrics textfile on an interval.
+
+	Args:
+	  path (string): The file to write
+	  interval (float): Seconds between writes
+
+	"""
+	def __init__(self, path, interval):
+		self._path     = path
+		self._interval = interval
+		self._stopped  = threading.Event()
+		self._thread   = threading.Thread(target=self._run, name="cdls-metrics", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+		self._write()
+
+	def _run(self):
+		while not self._stopped.wait(self._interval):
+			self._write()
+
+	def _write(self):
+		try:
+			write_textfile(self._path)
+		except Exception as e:
+			sys.stderr.write("cdls.metrics: failed to write '{}': {}\n".format(self._path, e))
+
+
+def _format_labels(labelnames, values):
+	"""Formats label pairs as {name="value",...} (empty if there are none). """
+	if not labelnames:
+		return ""
+	pairs = []
+	for name, value in zip(labelnames, values):
+		value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+		pairs.append('{}="{}"'.format(name, value))
+	return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+	"""Formats a sample value. """
+	if isinstance(value, float):
+		if math.isinf(value):
+			return "+Inf" if value > 0 else "-Inf"
+		if math.isnan(value):
+			return "NaN"
+		return repr(value)
+	return str(value)
+
+
+def _register(cls, name, description, labelnames, *args):
+	"""Returns an existing metric by name, or registers a new one. """
+	with _registry_lock:
+		try:
+			metric = _registry[name]
+		except KeyError:
+			metric = _registry[name] = cls(name, description, labelnames, *args)
+
+	assert isinstance(metric, cls), "Metric {} is already registered as a {}".format(name, metric.kind)
+	return metric
@@ -0,0 +1,133 @@
+"""
+Keep-alive HTTP connection pooling for the CDLS.
+
+Connections are kept open between requests and handed back out to the next
+request for the same host, so paginated pulls don't pay for a TCP (and TLS)
+handshake per page.  Each host also has a cap on the requests in flight to
+it at once; requests over the cap wait for a connection to come free.
+
+"""
+
+import contextlib
+import http.client
+import threading
+import urllib.parse
+
+from cdls.errors import ExtractError
+
+# Errors which mean a pooled connection was closed by the server while idle
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+
+class ConnectionPool:
+	"""A thread-safe pool of keep-alive HTTP connections, per host.
+
+	Args:
+	  max_per_host (int): The most requests in flight to a host at once (and
+	    so the most connections kept open to it).
+	  timeout (float): Socket timeout in seconds.
+
+	"""
+	def __init__(self, max_per_host, timeout):
+		self._max_per_host = max_per_host
+		self._timeout      = timeout
+		self._hosts        = {}
+		self._lock         = threading.Lock()
+		self._opened       = 0
+		self._reused       = 0
+
+
+	def close(self):
+		"""Closes every idle connection. """
+		with self._lock:
+			for slots, idle in self._hosts.values():
+				while idle:
+					idle.pop().close()
+
+
+	@contextlib.contextmanager
+	def request(self, url, headers=None):
+		"""Sends a GET request over a pooled connection.
+
+		The connection goes back into the pool once the response has been read
+		to the end; a response that's abandoned part way closes its connection.
+
+		Args:
+		  url (string): An `http` or `https` URL.
+		  headers (dict, optional): Request headers.
+
+		Returns:
+		  A context manager yielding the HTTPResponse.
+
+		Raises:
+		  ExtractError
+
+		"""
+		parts = urllib.parse.urlsplit(url)
+		if parts.scheme not in ("http", "https") or not parts.hostname:
+			raise ExtractError("Unsupported URL '{}'".format(url))
+
+		key = (parts.scheme, parts.hostname, parts.port)
+		target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+		with self._lock:
+			if key not in self._hosts:
+				self._hosts[key] = (threading.BoundedSemaphore(self._max_per_host), [])
+			(slots, idle) = self._hosts[key]
+
+		with slots:
+			while True:
+				with self._lock:
+					reused = bool(idle)
+					if reused:
+						connection = idle.pop()
+						self._reused += 1
+					else:
+						self._opened += 1
+				if not reused:
+					connection = self._connect(key)
+
+				try:
+					connection.request("GET", target, headers=headers or {})
+					response = connection.getresponse()
+					break
+				except _STALE_ERRORS as e:
+					connection.close()
+					if not reused:
+						raise ExtractError("GET {} failed: {}".format(url, e)) from e
+				except (OSError, http.client.HTTPException) as e:
+					connection.close()
+					raise ExtractError("GET {} failed: {}".format(url, e)) from e
+
+			try:
+				yield response
+			except BaseException:
+				connection.close()
+				raise
+
+			if response.isclosed() and not response.will_close:
+				with self._lock:
+					idle.append(connection)
+			else:
+				connection.close()
+
+
+	def stats(self):
+		"""Returns the pool's counters.
+
+		Returns:
+		  dict: `opened` and `reused` connections, and `idle` ones right now.
+
+		"""
+		with self._lock:
+			return {
+				"opened": self._opened,
+				"reused": self._reused,
+				"idle":   sum(len(idle) for slots, idle in self._hosts.values())
+			}
+
+
+	def _connect(self, key):
+		(scheme, host, port) = key
+		if scheme == "https":
+			return http.client.HTTPSConnection(host, port, timeout=self._timeout)
+		return http.client.HTTPConnection(host, port, timeout=self._timeout)
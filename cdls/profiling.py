@@ -0,0 +1,185 @@
+"""
+Sampling profiler for CDLS load operations.
+
+While a datasource executes, a background thread periodically captures the
+executing thread's stack.  The samples are written out per source as a sorted
+stats file and as a collapsed-stack file (one `frame;frame;frame count` line
+per unique stack) that flame graph tools can read directly.
+
+Attributes:
+  _label_cache (dict): Frame labels keyed by code object.
+
+"""
+
+import collections
+import contextlib
+import datetime
+import os.path
+import sys
+import threading
+
+_label_cache = {}
+
+
+class Profiler:
+	"""Profiles blocks of work, one report per source.
+
+	Args:
+	  output_dir (string): Where to write the profile files.
+	  interval (float): Seconds between stack samples.
+	  top (int, optional): How many hotspots to include in summaries.
+
+	Attributes:
+	  results (dict): ProfileResult per source identifier, most recent run.
+
+	"""
+	def __init__(self, output_dir, interval, top=10):
+		self.results     = {}
+		self._output_dir = output_dir
+		self._interval   = interval
+		self._top        = top
+
+
+	@contextlib.contextmanager
+	def profile(self, identifier):
+		"""Samples the calling thread for the duration of the block, then writes
+		the profile files for `identifier`.
+
+		Args:
+		  identifier (string): The source being profiled
+
+		"""
+		sampler = _Sampler(threading.get_ident(), self._interval)
+		sampler.start()
+		try:
+			yield
+		finally:
+			sampler.stop()
+			result = ProfileResult(identifier, sampler.samples, self._interval)
+			result.write(self._output_dir)
+			self.results[identifier] = result
+
+
+	def summary(self, identifier):
+		"""Returns the top hotspots for a source as a printable string. """
+		try:
+			return self.results[identifier].format_hotspots(self._top)
+		except KeyError:
+			return "No profile for '{}'".format(identifier)
+
+
+class ProfileResult:
+	"""The collected samples for a single profiled run.
+
+	Args:
+	  identifier (string): The source that was profiled
+	  samples (Counter): Sample counts keyed by stack (tuple of frame labels,
+	    outermost first)
+	  interval (float): Seconds between samples
+
+	Attributes:
+	  paths (tuple): The (stats, collapsed) files, once written.
+
+	"""
+	def __init__(self, identifier, samples, interval):
+		self.identifier = identifier
+		self.samples    = samples
+		self.interval   = interval
+		self.paths      = None
+
+
+	def format_hotspots(self, top):
+		"""Formats the functions with the most self-time samples. """
+		total = sum(self.samples.values())
+		lines = ["Top hotspots for '{}' ({} samples every {:0.1f}ms):".format(self.identifier, total, self.interval * 1000)]
+		for label, own, cumulative in self.stats()[:top]:
+			lines.append("  {:>6.1%} self {:>6.1%} total  {}".format(own / total, cumulative / total, label))
+		return "\n".join(lines)
+
+
+	def stats(self):
+		"""Returns (label, self samples, cumulative samples) per function,
+		sorted by self samples.
+		"""
+		own = collections.Counter()
+		cumulative = collections.Counter()
+		for stack, count in self.samples.items():
+			own[stack[-1]] += count
+			for label in set(stack):
+				cumulative[label] += count
+
+		return sorted(((label, own[label], cumulative[label]) for label in cumulative),
+		              key=lambda row: (-row[1], -row[2], row[0]))
+
+
+	def write(self, output_dir):
+		"""Writes the stats and collapsed-stack files.
+
+		Args:
+		  output_dir (string): The directory to write into
+
+		Returns:
+		  tuple: (stats path, collapsed path)
+
+		"""
+		os.makedirs(output_dir, exist_ok=True)
+		prefix = os.path.join(output_dir, "{}-{:%Y%m%d-%H%M%S}".format(self.identifier, datetime.datetime.now()))
+		total = sum(self.samples.values()) or 1
+
+		with open(prefix + ".stats.txt", "w") as fp:
+			fp.write("{:>8} {:>8} {:>8} {:>8}  {}\n".format("self", "self%", "total", "total%", "function"))
+			for label, own, cumulative in self.stats():
+				fp.write("{:>8d} {:>8.2%} {:>8d} {:>8.2%}  {}\n".format(own, own / total, cumulative, cumulative / total, label))
+
+		with open(prefix + ".collapsed.txt", "w") as fp:
+			for stack, count in sorted(self.samples.items()):
+				fp.write("{} {}\n".format(";".join(stack), count))
+
+		self.paths = (prefix + ".stats.txt", prefix + ".collapsed.txt")
+		return self.paths
+
+
+class _Sampler:
+	"""Background thread which samples another thread's stack.
+
+	Args:
+	  thread_id (int): The thread to sample
+	  interval (float): Seconds between samples
+
+	"""
+	def __init__(self, thread_id, interval):
+		self.samples    = collections.Counter()
+		self._thread_id = thread_id
+		self._interval  = interval
+		self._stopped   = threading.Event()
+		self._thread    = threading.Thread(target=self._run, name="cdls-profiler", daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+	def _run(self):
+		while not self._stopped.wait(self._interval):
+			frame = sys._current_frames().get(self._thread_id)
+			if frame is None:
+				continue
+
+			stack = []
+			while frame is not None:
+				stack.append(_label(frame.f_code))
+				frame = frame.f_back
+			stack.reverse()
+			self.samples[tuple(stack)] += 1
+
+
+def _label(code):
+	"""Returns a `file:function` label for a code object. """
+	try:
+		return _label_cache[code]
+	except KeyError:
+		name = getattr(code, "co_qualname", code.co_name)
+		label = _label_cache[code] = "{}:{}".format(os.path.basename(code.co_filename), name)
+		return label
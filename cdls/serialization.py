@@ -0,0 +1,226 @@
+"""
+JSON serialization stage for the CDLS.
+
+Records are packaged and encoded into ready-to-insert parameter tuples of the
+form (guid, source_identifier, record_date, json).  Large batches can be
+encoded in a pool of worker processes so that `json.dumps` isn't pinned to a
+single core by the GIL.
+
+Attributes:
+  _WORKERS (int): Number of worker processes to encode with.  0 encodes
+    in-process; None uses every available core.
+  _CHUNK_SIZE (int): Number of records handed to a worker at a time.
+  _executors (dict): The lazily-created worker pools, keyed by their number
+    of workers.
+  _executors_lock (Lock): Guards `_executors`.
+
+"""
+
+import atexit
+import concurrent.futures
+import datetime
+import json
+import os
+import threading
+import uuid
+
+import cdls.config
+
+_WORKERS = cdls.config.SERIALIZE_WORKERS
+_CHUNK_SIZE = cdls.config.SERIALIZE_CHUNK_SIZE
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def date_to_string(date):
+	"""Formats a datetime into a string. """
+	# timezones... le sigh
+	return date.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def encode(data):
+	"""Packages a single object and serializes it to a JSON document.
+
+	Args:
+	  data (mixed): Any object that can be serialized to JSON.
+
+	Returns:
+	  string
+
+	Raises:
+	  TypeError
+	  ValueError
+
+	"""
+	packaged_data = {
+		"$class": type(data).__name__,
+		"$contents": data
+	}
+
+	return json.dumps(packaged_data, default=_tojson, sort_keys=True, indent=4).strip()
+
+
+def encode_salvaged(data):
+	"""Packages and serializes an object like `encode`, except that values
+	JSON can't represent are kept as their string form (and sets as lists)
+	rather than failing, so that as much of a rejected record as possible
+	can be replayed.
+
+	Args:
+	  data (mixed): The object to serialize.
+
+	Returns:
+	  string
+
+	Raises:
+	  TypeError: The object's state can't be read at all.
+	  ValueError
+
+	"""
+	packaged_data = {
+		"$class": type(data).__name__,
+		"$contents": data
+	}
+
+	return json.dumps(packaged_data, default=_salvage, sort_keys=True, indent=4).strip()
+
+
+def encode_batch(records, source, workers=None):
+	"""Encodes a batch of records into insert parameter tuples.
+
+	Each number of workers gets a pool of its own, which is kept for later
+	batches.  If a worker dies, the rest of the batch is encoded in-process
+	and the next batch starts a new pool.
+
+	Args:
+	  records (list of tuple): (data, record_date) pairs.
+	  source (string): The identifier for the datasource where the data came
+	    from.
+	  workers (int, optional): Overrides the configured number of worker
+	    processes.
+
+	Returns:
+	  list of tuple: One (params, error) pair per record in the original order.
+	    `params` is None when the record failed, in which case `error` holds
+	    the (exception type name, message).
+
+	"""
+	records = list(records)
+	workers = _WORKERS if workers is None else workers
+
+	# Small batches aren't worth the trip to another process
+	if workers == 0 or len(records) <= _CHUNK_SIZE:
+		return _encode_chunk(records, source)
+
+	chunks = [records[i:i + _CHUNK_SIZE] for i in range(0, len(records), _CHUNK_SIZE)]
+	executor = _get_executor(workers)
+	try:
+		futures = [executor.submit(_encode_chunk, chunk, source) for chunk in chunks]
+	except concurrent.futures.process.BrokenProcessPool:
+		# A worker died since the last batch; start over with a new pool next
+		# time and encode this one here
+		_discard_executor(workers, executor)
+		return _encode_chunk(records, source)
+
+	results = []
+	for chunk, future in zip(chunks, futures):
+		try:
+			results.extend(future.result())
+		except concurrent.futures.process.BrokenProcessPool:
+			_discard_executor(workers, executor)
+			results.extend(_encode_chunk(chunk, source))
+		except Exception:
+			# Usually a record that can't be pickled (e.g., a locally-defined
+			# class), so just encode this chunk here instead
+			results.extend(_encode_chunk(chunk, source))
+
+	return results
+
+
+def shutdown():
+	"""Stops every worker pool that was started. """
+	with _executors_lock:
+		executors = list(_executors.values())
+		_executors.clear()
+	for executor in executors:
+		executor.shutdown(wait=True)
+
+
+def _encode_chunk(records, source):
+	"""Encodes a list of records in the current process.
+
+	Args:
+	  records (list of tuple): (data, record_date) pairs.
+	  source (string): The datasource identifier.
+
+	Returns:
+	  list of tuple: (params, error) pairs (see `encode_batch`)
+
+	"""
+	source = source.strip().upper()
+	results = []
+	for data, record_date in records:
+		try:
+			params = (str(uuid.uuid1()).upper(),
+			          source,
+			          date_to_string(record_date),
+			          encode(data))
+			results.append((params, None))
+		except (TypeError, ValueError, AttributeError) as e:
+			results.append((None, (type(e).__name__, "JSON-serialization failed on data: {}".format(e))))
+	return results
+
+
+def _discard_executor(workers, executor):
+	"""Shuts down a broken worker pool so that the next batch starts a new
+	one.
+	"""
+	with _executors_lock:
+		if _executors.get(workers) is executor:
+			del _executors[workers]
+	executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_executor(workers):
+	"""Returns the worker pool for a number of workers, starting it if
+	needed.
+	"""
+	with _executors_lock:
+		if workers not in _executors:
+			if not _executors:
+				atexit.register(shutdown)
+			_executors[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+		return _executors[workers]
+
+
+def _salvage(o):
+	"""Fallback parse handler for `encode_salvaged`.
+
+	Args:
+	  o (mixed): The object to be serialized.
+
+	"""
+	try:
+		return _tojson(o)
+	except AttributeError:
+		pass
+
+	if isinstance(o, (set, frozenset)):
+		return list(o)
+	if type(o).__str__ is object.__str__:
+		raise TypeError("Object of type {} has no attributes or string form to salvage".format(type(o).__name__))
+	return str(o)
+
+
+def _tojson(o):
+	"""Rudimentary parse handler for JSON serialization.
+
+	Args:
+	  o (mixed): The object to be serialized.
+
+	"""
+	if isinstance(o, datetime.datetime):
+		return date_to_string(o)
+	else:
+		return o.__dict__
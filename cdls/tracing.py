@@ -0,0 +1,108 @@
+"""
+Lightweight tracing for the CDLS.
+
+Spans are timed with the monotonic clock and buffered in memory; nothing is
+written until `export()` dumps them as Chrome trace-event JSON, which can be
+opened in chrome://tracing or Perfetto.  Nesting falls out of the timestamps
+of spans on the same thread.
+
+Attributes:
+  _spans (deque): Finished spans as (name, start_ns, end_ns, thread id, args)
+  _origin_ns (int): Timestamps are exported relative to this.
+
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import cdls.config
+
+_spans = collections.deque(maxlen=cdls.config.TRACING_MAX_SPANS)
+_origin_ns = time.perf_counter_ns()
+
+
+def span(name, **args):
+	"""Times a block of work as a span.
+
+	Args:
+	  name (string): The span name
+	  **args (dict, optional): Annotations to attach to the span
+
+	Returns:
+	  A context manager
+
+	"""
+	if not cdls.config.TRACING_ENABLED:
+		return _NOOP
+	return _Span(name, args)
+
+
+def clear():
+	"""Discards every buffered span. """
+	_spans.clear()
+
+
+def export(path):
+	"""Writes the buffered spans as Chrome trace-event JSON.
+
+	Args:
+	  path (string): The file to write
+
+	"""
+	pid = os.getpid()
+	thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+	events = []
+	for tid in sorted(set(span[3] for span in _spans)):
+		events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+		               "args": {"name": thread_names.get(tid, str(tid))}})
+
+	for name, start_ns, end_ns, tid, args in list(_spans):
+		events.append({
+			"name": name,
+			"cat":  "cdls",
+			"ph":   "X",
+			"ts":   (start_ns - _origin_ns) / 1000,
+			"dur":  (end_ns - start_ns) / 1000,
+			"pid":  pid,
+			"tid":  tid,
+			"args": args
+		})
+
+	with open(path, "w") as fp:
+		json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+
+
+class _Span:
+	"""An in-flight span; buffered when the block exits. """
+	__slots__ = ("_name", "_args", "_start_ns")
+
+	def __init__(self, name, args):
+		self._name = name
+		self._args = args
+
+	def __enter__(self):
+		self._start_ns = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if exc_type is not None:
+			self._args["error"] = exc_type.__name__
+		_spans.append((self._name, self._start_ns, time.perf_counter_ns(), threading.get_ident(), self._args))
+
+
+class _NoopSpan:
+	"""Stands in for a span when tracing is off. """
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		pass
+
+
+_NOOP = _NoopSpan()
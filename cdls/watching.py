@@ -0,0 +1,243 @@
+"""
+Watches a directory for new files, for event-driven ingestion.
+
+Files are only handed out once they've settled: their size and mtime have
+to stay the same for a quiet period, so a file that's still being written
+is never picked up.  Names starting with "." or ending in `.tmp`, `.part`
+or `.partial` are ignored, which suits writers that write under a temporary
+name and rename once they're done.
+
+New files are discovered through inotify (called through ctypes) where the
+platform has it; elsewhere the directory is polled, but only rescanned when
+its mtime changes.  Either way, files still settling are checked with a
+single `stat` each.
+
+Attributes:
+  _IGNORED_SUFFIXES (tuple): File name endings of files being written.
+  _IN_* (int): inotify flags.
+  _EVENT (Struct): The fixed part of an inotify event.
+  _libc (CDLL): The C library, if it has inotify (else None).
+
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+_IGNORED_SUFFIXES = (".tmp", ".part", ".partial")
+
+_IN_MODIFY      = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_NONBLOCK    = 0x00000800
+_IN_CLOEXEC     = 0x00080000
+_IN_GONE        = _IN_MOVED_FROM | _IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	_libc.inotify_init1
+	_libc.inotify_add_watch
+except (OSError, AttributeError):
+	_libc = None
+
+
+class Watcher:
+	"""Reports files in a directory once they've settled.
+
+	Args:
+	  path (string): The directory to watch.
+	  settle (float): Seconds a file's size and mtime must stay the same.
+	  poll_interval (float): Seconds between checks when polling.
+	  use_inotify (bool, optional): Whether to use inotify if it's available.
+
+	Attributes:
+	  mode (string): `inotify` or `polling`.
+
+	Raises:
+	  OSError
+
+	"""
+	def __init__(self, path, settle, poll_interval, use_inotify=True):
+		self.mode           = "polling"
+		self._path          = path
+		self._settle        = settle
+		self._poll_interval = poll_interval
+		self._fd            = None
+		self._scanned_mtime = None
+		self._candidates    = {}
+		self._seen          = {}
+		self._forgotten     = {}
+
+		if use_inotify and _libc:
+			fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+			if fd >= 0:
+				mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_GONE
+				if _libc.inotify_add_watch(fd, os.fsencode(path), mask) >= 0:
+					self._fd = fd
+					self.mode = "inotify"
+				else:
+					os.close(fd)
+
+		# Anything already waiting counts as new
+		self._scan()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+
+	def forget(self, path):
+		"""Lets a file that was handed out be reported again once it changes
+		(e.g. when ingesting it failed and it was left in place).
+		"""
+		signature = self._seen.pop(path, None)
+		if signature:
+			self._forgotten[path] = signature
+
+
+	def wait(self, timeout):
+		"""Waits for files to settle.
+
+		Args:
+		  timeout (float): The most seconds to wait.
+
+		Returns:
+		  list of string: Paths of newly settled files, oldest first (empty if
+		    none settled in time).
+
+		"""
+		deadline = time.monotonic() + timeout
+		while True:
+			settled = self._check()
+			now = time.monotonic()
+			if settled or now >= deadline:
+				return settled
+
+			# Sleep until the next file could settle, or something happens
+			delay = deadline - now
+			if self._candidates:
+				delay = min(delay, max(min(changed for signature, changed in self._candidates.values()) + self._settle - now, 0.01))
+
+			if self._fd is not None:
+				if select.select([self._fd], [], [], delay)[0]:
+					self._read_events()
+			else:
+				time.sleep(min(delay, self._poll_interval))
+				self._scan_if_changed()
+
+
+	def _check(self):
+		"""Re-stats the files still settling, returning those that have. """
+		for path, signature in list(self._forgotten.items()):
+			if _signature(path) != signature:
+				del self._forgotten[path]
+				self._consider(path)
+
+		now = time.monotonic()
+		settled = []
+		for path, (signature, changed) in list(self._candidates.items()):
+			current = _signature(path)
+			if current is None:
+				del self._candidates[path]
+			elif current != signature:
+				self._candidates[path] = (current, now)
+			elif now - changed >= self._settle:
+				del self._candidates[path]
+				self._seen[path] = current
+				settled.append((current[1], path))
+
+		return [path for mtime, path in sorted(settled)]
+
+
+	def _consider(self, path):
+		"""Starts (or restarts) the settling clock on a file. """
+		if _ignored(path):
+			return
+		signature = _signature(path)
+		if signature is None or self._seen.get(path) == signature:
+			return
+		self._seen.pop(path, None)
+		self._forgotten.pop(path, None)
+		if self._candidates.get(path, (None,))[0] != signature:
+			self._candidates[path] = (signature, time.monotonic())
+
+
+	def _read_events(self):
+		try:
+			data = os.read(self._fd, 65536)
+		except BlockingIOError:
+			return
+
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = _EVENT.unpack_from(data, offset)
+			name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+			offset += _EVENT.size + length
+
+			if mask & _IN_Q_OVERFLOW:
+				self._scan()
+			elif name:
+				path = os.path.join(self._path, os.fsdecode(name))
+				if mask & _IN_GONE:
+					self._seen.pop(path, None)
+					self._forgotten.pop(path, None)
+					self._candidates.pop(path, None)
+				else:
+					self._consider(path)
+
+
+	def _scan(self):
+		"""Lists the directory, picking up new files and forgetting those that
+		are gone.
+		"""
+		try:
+			self._scanned_mtime = os.stat(self._path).st_mtime_ns
+			names = set(entry.path for entry in os.scandir(self._path) if entry.is_file())
+		except FileNotFoundError:
+			names = set()
+
+		self._seen = dict((path, signature) for path, signature in self._seen.items() if path in names)
+		for path in sorted(names):
+			self._consider(path)
+
+
+	def _scan_if_changed(self):
+		try:
+			mtime = os.stat(self._path).st_mtime_ns
+		except FileNotFoundError:
+			mtime = None
+		if mtime != self._scanned_mtime:
+			self._scan()
+
+
+def _ignored(path):
+	name = os.path.basename(path)
+	return name.startswith(".") or name.endswith(_IGNORED_SUFFIXES)
+
+
+def _signature(path):
+	"""Returns a file's (size, mtime), or None if it's gone. """
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return (stat.st_size, stat.st_mtime_ns)
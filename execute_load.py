@@ -1,9 +1,14 @@
 import cdls
+import cdls.profiling
+import cdls.tracing
+import datetime
 import optparse
+import sys
 
 from cdls.errors import CDLSError
 
 parser = None
+profiler = None
 
 def func_doc(func):
 	output = []
@@ -16,7 +21,11 @@ def func_doc(func):
 
 
 def main():
-	global parser
+	global parser, profiler
+
+	# Subcommands get their own options
+	if sys.argv[1:2] == ["export"]:
+		return export(sys.argv[2:])
 
 	# Initialize options parser
 	parser = optparse.OptionParser()
@@ -24,6 +33,14 @@ def main():
 	parser.add_option("-a", "--all", action="store_true", help=func_doc(cdls.perform_all_loads))
 	parser.add_option("-n", "--noisy", action="store_true", help="Outputs more verbose logging info")
 	parser.add_option("-i", "--install-db", action="store_true", help="Installs the database schema")
+	parser.add_option("-r", "--replay-rejects", action="store_true", help="Re-drives rejected records for the given sources (or all sources)")
+	parser.add_option("-w", "--workers", metavar="N", type="int", help="Loads up to N sources at once")
+	parser.add_option("--watch", action="store_true", help="Ingests new files as they land for the given sources (or all watchable sources) until interrupted")
+	parser.add_option("-j", "--json-report", metavar="FILE", help="Writes the load reports to FILE as JSON")
+	parser.add_option("-t", "--trace", metavar="FILE", help="Writes a Chrome trace of the run to FILE")
+	parser.add_option("-p", "--profile", action="store_true", help="Profiles each load, writing stats and collapsed stacks per source")
+	parser.add_option("--profile-dir", metavar="DIR", default="./profiles", help="Where to write profiles [default: %default]")
+	parser.add_option("--profile-interval", metavar="MS", type="float", default=5.0, help="Milliseconds between profile samples [default: %default]")
 	(options, args) = parser.parse_args(
 
 		# DEBUG DEBUG DEBUG DEBUG DEBUG DEBUG DEBUG DEBUG DEBUG DEBUG
@@ -45,7 +62,7 @@ def main():
 	# exit()
 
 	# Perform actions based on the user's CLI options
-	if args or options.list or options.all or options.install_db:
+	if args or options.list or options.all or options.install_db or options.replay_rejects or options.watch:
 
 		# Adjust log noisiness as required
 		if options.noisy:
@@ -54,26 +71,82 @@ def main():
 		# Bring the whole CDLS up
 		initialize()
 
+		if options.profile:
+			profiler = cdls.profiling.Profiler(options.profile_dir, options.profile_interval / 1000)
+
 		# Choose to rebuild the schema
 		if options.install_db:
 			install()
 
 		# Load one or multiple sources
-		if options.list and not options.all and not args:
+		reports = []
+		if options.replay_rejects and not options.list and not options.all:
+			replay_rejects(args)
+		elif options.watch and not options.list and not options.all:
+			reports.extend(watch_sources(args))
+		elif options.list and not options.all and not args:
 			list_all_sources()
 		elif args and not options.list and not options.all:
 			for identifier in args:
-				load_source(identifier)
+				reports.append(load_source(identifier))
 		elif options.all and not options.list and not args:
-			load_all_sources()
+			reports.extend(load_all_sources(options.workers))
 		else:
 			# Only valid combinations are listed above
 			return handle_error_invalid_combination()
 
+		if options.json_report:
+			write_json_report(options.json_report, reports)
+
+		if options.trace:
+			cdls.tracing.export(options.trace)
+
 	else:
 		return handle_error_no_arguments()
 
 
+def export(argv):
+	global parser
+
+	parser = optparse.OptionParser(usage="%prog export [options] SOURCE")
+	parser.add_option("-o", "--output", metavar="PATH", help="Writes to PATH (a directory when splitting into parts)")
+	parser.add_option("-f", "--format", type="choice", choices=cdls.exporting.FORMATS, default="jsonl", help="jsonl, csv or columnar [default: %default]")
+	parser.add_option("-z", "--gzip", action="store_true", help="Gzips the output")
+	parser.add_option("--since", metavar="DATE", help="Only records dated on or after DATE (YYYY-MM-DD[ HH:MM:SS])")
+	parser.add_option("--until", metavar="DATE", help="Only records dated before DATE (YYYY-MM-DD[ HH:MM:SS])")
+	parser.add_option("--part-rows", metavar="N", type="int", help="Splits the output into part files of up to N rows")
+	parser.add_option("-w", "--workers", metavar="N", type="int", default=1, help="Writes up to N part files at once [default: %default]")
+	parser.add_option("--field", metavar="PATH:TYPE", action="append", help="Adds a field to a columnar snapshot (defaults to the source's projections)")
+	parser.add_option("-n", "--noisy", action="store_true", help="Outputs more verbose logging info")
+	(options, args) = parser.parse_args(argv)
+
+	if len(args) != 1 or not options.output:
+		return handle_error_invalid_combination()
+
+	try:
+		since = options.since and datetime.datetime.fromisoformat(options.since)
+		until = options.until and datetime.datetime.fromisoformat(options.until)
+	except ValueError as e:
+		print("Error: Invalid date: {0}".format(e))
+		exit(1)
+
+	fields = None
+	if options.field:
+		fields = dict(field.rsplit(":", 1) if ":" in field else (field, "text") for field in options.field)
+
+	if options.noisy:
+		cdls.config.LOGGING_NOISY = True
+
+	initialize()
+
+	try:
+		result = cdls.export_source(args[0], options.output, options.format, since, until, options.gzip, options.part_rows, options.workers, fields)
+	except cdls.errors.CDLSError as e:
+		return handle_error_fatal(e)
+
+	print("Exported {0} rows to {1} files".format(result.rows, len(result.files)))
+
+
 def initialize():
 	try:
 		cdls.initialize()
@@ -93,7 +166,7 @@ def handle_error_invalid_combination():
 
 def install():
 	print("Rebuilding database schema...")
-	cdls.db.install()
+	cdls.install()
 
 
 def handle_error_initialization_failed(exception):
@@ -130,17 +203,37 @@ All Registered Sources:
 
 def load_source(identifier):
 	try:
-		cdls.perform_load(identifier)
+		return cdls.perform_load(identifier, profiler)
+	except cdls.errors.CDLSError as e:
+		return handle_error_fatal(e)
+
+
+def load_all_sources(workers=None):
+	try:
+		return cdls.perform_all_loads(profiler=profiler, workers=workers)
+	except cdls.errors.CDLSError as e:
+		return handle_error_fatal(e)
+
+
+def watch_sources(identifiers):
+	try:
+		return cdls.watch_sources(identifiers)
 	except cdls.errors.CDLSError as e:
 		return handle_error_fatal(e)
 
 
-def load_all_sources():
+def replay_rejects(identifiers):
 	try:
-		cdls.perform_all_loads()
+		for identifier in identifiers or [None]:
+			cdls.replay_rejects(identifier)
 	except cdls.errors.CDLSError as e:
 		return handle_error_fatal(e)
 
 
+def write_json_report(path, reports):
+	with open(path, "w") as fp:
+		fp.write("[\n" + ",\n".join(report.to_json() for report in reports) + "\n]\n")
+
+
 if "__main__" == __name__:
 	main()
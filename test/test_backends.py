@@ -0,0 +1,160 @@
+import unittest
+import datetime
+import decimal
+import os
+import tempfile
+
+import cdls.backends
+import cdls.backends.memory
+import cdls.backends.segment
+import cdls.db
+import cdls.errors
+
+class Unserializable:
+	__slots__ = ("id",)
+
+class BackendContract:
+	"""Tests every storage backend has to pass. """
+
+	def warehouse(self):
+		self.assertEqual(self.backend.warehouse_many([
+			({"status": "open", "total": 10, "customer": {"id": 1}}, datetime.datetime(2015, 1, 1)),
+			({"status": "shipped", "total": 25, "customer": {"id": 2}}, datetime.datetime(2015, 2, 1)),
+			(Unserializable(), datetime.datetime(2015, 2, 1)),
+			({"status": "open", "total": 5, "customer": {"id": 2}}, datetime.datetime(2015, 3, 1))
+		], "orders")[0][0], 2)
+		self.backend.warehouse({"status": "open"}, "other", datetime.datetime(2015, 1, 1))
+
+	def test_query(self):
+		self.warehouse()
+
+		changes = self.backend.query("orders")
+		self.assertEqual([change.position for change in changes], [1, 2, 3])
+		self.assertEqual(changes[0].source, "ORDERS")
+		self.assertEqual(changes[0].record_date, "2015-01-01 00:00:00.000000")
+
+		self.assertEqual([change.position for change in self.backend.query("orders", {"status": "open"})], [1, 3])
+		self.assertEqual([change.position for change in self.backend.query("orders", {"total": (">", 7), "customer.id": ("in", [2])})], [2])
+		self.assertEqual([change.position for change in self.backend.query("orders", since=datetime.datetime(2015, 2, 1), until=datetime.datetime(2015, 3, 1))], [2])
+		self.assertEqual([change.position for change in self.backend.query("orders", limit=2)], [1, 2])
+
+	def test_stats(self):
+		self.warehouse()
+		stats = self.backend.stats()
+		self.assertEqual(stats["records"], 4)
+		self.assertEqual(stats["rejects"], 1)
+		self.assertEqual(stats["sources"]["ORDERS"]["records"], 3)
+
+	def test_batch_stats(self):
+		stats = {}
+		self.backend.warehouse_many([({"n": 1}, datetime.datetime.now())], "orders", stats=stats)
+		self.assertGreater(stats["bytes_written"], 0)
+		self.assertIn("serialize_ns", stats)
+		self.assertIn("write_ns", stats)
+
+	def test_install_wipes(self):
+		self.warehouse()
+		self.backend.install()
+		self.assertEqual(self.backend.query("orders"), [])
+		self.assertEqual(self.backend.stats()["records"], 0)
+
+	def test_single_warehouse_raises(self):
+		with self.assertRaises(cdls.errors.DatabaseError):
+			self.backend.warehouse(Unserializable(), "orders", datetime.datetime.now())
+
+	def test_watermarks(self):
+		self.assertIsNone(self.backend.get_watermark("orders"))
+		self.backend.set_watermark("orders", "2015-01-01T00:00:00")
+		self.backend.set_watermark("orders ", ["2015-02-01T00:00:00", 7])
+		self.backend.set_watermark("other", 3)
+
+		self.assertEqual(self.backend.get_watermark("ORDERS"), ["2015-02-01T00:00:00", 7])
+		self.assertEqual(self.backend.get_watermark("other"), 3)
+		self.backend.install()
+		self.assertIsNone(self.backend.get_watermark("orders"))
+
+	def test_watermark_types(self):
+		self.backend.set_watermark("orders", (datetime.datetime(2015, 1, 2, 3, 4, 5), 7))
+		self.assertEqual(self.backend.get_watermark("orders"), ["2015-01-02 03:04:05.000000", 7])
+
+		with self.assertRaises(cdls.errors.DatabaseError):
+			self.backend.set_watermark("orders", decimal.Decimal("1.5"))
+		self.assertEqual(self.backend.get_watermark("orders"), ["2015-01-02 03:04:05.000000", 7])
+
+class TestSqliteBackend(BackendContract, unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.original_path = cdls.db._DBPATH
+		cdls.db.close()
+		cdls.db._DBPATH = os.path.join(self.tmp.name, "test.db")
+		self.backend = cdls.backends.create("sqlite")
+		self.backend.install()
+
+	def tearDown(self):
+		cdls.db.close()
+		cdls.db._DBPATH = self.original_path
+		self.tmp.cleanup()
+
+class TestMemoryBackend(BackendContract, unittest.TestCase):
+	def setUp(self):
+		self.backend = cdls.backends.create("memory")
+
+	def test_replay_rejects(self):
+		self.warehouse()
+		self.assertEqual(self.backend.replay_rejects(), (0, 1))
+		self.assertEqual(len(self.backend.rejects), 1)
+
+class TestSegmentBackend(BackendContract, unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.backend = cdls.backends.segment.SegmentBackend(self.tmp.name, 512)
+		self.backend.install()
+
+	def tearDown(self):
+		self.backend.close()
+		self.tmp.cleanup()
+
+	def test_rolls_over_and_reopens(self):
+		self.backend.warehouse_many([({"n": n, "payload": "x" * 100}, datetime.datetime(2015, 1, 1)) for n in range(20)], "orders")
+		self.assertGreater(len([name for name in os.listdir(self.tmp.name) if name.endswith(".seg")]), 1)
+		self.backend.close()
+
+		# A new instance picks up where the old one left off
+		backend = cdls.backends.segment.SegmentBackend(self.tmp.name, 512)
+		backend.warehouse_many([({"n": 20}, datetime.datetime(2015, 1, 1))], "orders")
+		changes = backend.query("orders")
+		self.assertEqual([change.position for change in changes], list(range(1, 22)))
+		self.assertIn('"n": 20', changes[-1].json)
+		backend.close()
+
+	def test_torn_frames_are_ignored(self):
+		self.backend.warehouse_many([({"n": 1}, datetime.datetime(2015, 1, 1))], "orders")
+		self.backend.close()
+
+		# Simulate a crash partway through appending a frame
+		with open(os.path.join(self.tmp.name, "ORDERS-000001.seg"), "ab") as fp:
+			fp.write(b"\xff\x00\x00")
+		self.assertEqual(len(self.backend.query("orders")), 1)
+
+		self.backend.warehouse_many([({"n": 2}, datetime.datetime(2015, 1, 1))], "orders")
+		self.assertEqual([change.position for change in self.backend.query("orders")], [1, 2])
+
+	def test_similar_source_names(self):
+		for n, source in enumerate(("a.b", "a_b", "a b", "a-b", "é")):
+			self.backend.warehouse_many([({"n": n}, datetime.datetime(2015, 1, 1))], source)
+
+		for n, source in enumerate(("a.b", "a_b", "a b", "a-b", "é")):
+			changes = self.backend.query(source)
+			self.assertEqual(len(changes), 1)
+			self.assertIn('"n": {}'.format(n), changes[0].json)
+		self.assertEqual(sorted(self.backend.stats()["sources"]), ["A B", "A-B", "A.B", "A_B", "É"])
+
+class TestCreate(unittest.TestCase):
+	def test_by_name(self):
+		self.assertIs(cdls.backends.create("sqlite"), cdls.db)
+		self.assertIsInstance(cdls.backends.create("cdls.backends.memory.MemoryBackend"), cdls.backends.memory.MemoryBackend)
+		with self.assertRaises(cdls.errors.CDLSError):
+			cdls.backends.create("nope")
+
+if "__main__" == __name__:
+	unittest.main()
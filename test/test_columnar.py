@@ -0,0 +1,86 @@
+import unittest
+import datetime
+import os
+import tempfile
+
+import cdls.columnar
+import cdls.db
+import cdls.errors
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.original_path = cdls.db._DBPATH
+		cdls.db.close()
+		cdls.db._DBPATH = os.path.join(self.tmp.name, "test.db")
+		cdls.db.install()
+		cdls.db.configure_source("orders", {"projections": {"total": "real", "status": "text"}})
+
+		records = []
+		for n in range(30):
+			record = {"status": ["open", "shipped", "lost"][n % 3], "total": n * 1.5, "customer": {"id": n % 4}}
+			if n == 7:
+				del record["total"], record["status"]
+			records.append((record, datetime.datetime(2015, 1 + n % 2, 1, 12)))
+		cdls.db.warehouse_many(records, "orders")
+		self.snapshot = os.path.join(self.tmp.name, "snapshot")
+
+	def tearDown(self):
+		cdls.db.configure_source("orders", {})
+		cdls.db.close()
+		cdls.db._DBPATH = self.original_path
+		self.tmp.cleanup()
+
+	def test_projections_by_default(self):
+		self.assertEqual(cdls.columnar.write_snapshot("orders", self.snapshot), 30)
+
+		with cdls.columnar.Snapshot(self.snapshot) as snapshot:
+			self.assertEqual(snapshot.rows, 30)
+			self.assertEqual(sorted(snapshot.columns), ["record_date", "seq", "status", "total"])
+
+			self.assertEqual(sorted(snapshot.column("seq")), list(range(1, 31)))
+
+			by_n = dict(zip([None if t is None else round(t / 1.5) for t in snapshot.values("total")], snapshot.values("status")))
+			self.assertEqual(by_n[4], "shipped")
+			self.assertIsNone(by_n[None])
+			self.assertEqual(snapshot.valid("total").tolist().count(0), 1)
+			self.assertEqual(sorted(snapshot.dictionary("status")), ["lost", "open", "shipped"])
+			self.assertEqual(set(snapshot.column("record_date")), {1420113600000000, 1422792000000000})
+
+	def test_fields_and_date_range(self):
+		rows = cdls.columnar.write_snapshot("orders", self.snapshot, {"customer.id": "integer"}, since=datetime.datetime(2015, 2, 1))
+		self.assertEqual(rows, 15)
+
+		with cdls.columnar.Snapshot(self.snapshot) as snapshot:
+			self.assertIsNone(snapshot.valid("customer.id"))
+			self.assertEqual(sum(snapshot.column("customer.id")), sum(n % 4 for n in range(1, 30, 2)))
+			with self.assertRaises(cdls.errors.CDLSError):
+				snapshot.dictionary("customer.id")
+
+	def test_integer_field_with_fractions_becomes_real(self):
+		self.assertEqual(cdls.columnar.write_snapshot("orders", self.snapshot, {"total": "integer"}), 30)
+
+		with cdls.columnar.Snapshot(self.snapshot) as snapshot:
+			self.assertEqual(snapshot.columns["total"]["type"], "real")
+			totals = sorted(total for total in snapshot.values("total") if total is not None)
+			self.assertEqual(totals, sorted(n * 1.5 for n in range(30) if n != 7))
+
+	def test_empty(self):
+		self.assertEqual(cdls.columnar.write_snapshot("nothing", self.snapshot, {"a": "text"}), 0)
+		with cdls.columnar.Snapshot(self.snapshot) as snapshot:
+			self.assertEqual(len(snapshot.column("a")), 0)
+
+	def test_incomplete(self):
+		with self.assertRaises(cdls.errors.CDLSError):
+			cdls.columnar.Snapshot(self.snapshot)
+		with self.assertRaises(cdls.errors.CDLSError):
+			cdls.columnar.write_snapshot("orders", self.snapshot, {"a": "blob"})
+
+	def test_colliding_names(self):
+		for fields in ({"seq": "integer"}, {"record_date": "text"}, {"a b": "text", "a_b": "text"}, {"Total": "real", "total": "real"}):
+			with self.assertRaises(cdls.errors.CDLSError):
+				cdls.columnar.write_snapshot("orders", self.snapshot, fields)
+		self.assertFalse(os.path.exists(self.snapshot))
+
+if "__main__" == __name__:
+	unittest.main()
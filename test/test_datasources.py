@@ -1,9 +1,17 @@
 import unittest
 import sys
 import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest.mock
 
 sys.path.append("/Users/david/code/python/CDLS")
+import cdls.backends.memory
 import cdls.datasources
+import cdls.errors
 
 class TestDateParser(unittest.TestCase):
 	def setUp():
@@ -19,5 +27,305 @@ class TestDateParser(unittest.TestCase):
 			self.assertIsInstance(date_object, datetime.datetime)
 			self.assertEqual(date_object, expected)
 
+class TestLatencyHistogram(unittest.TestCase):
+	def test_percentiles_within_bucket_precision(self):
+		histogram = cdls.datasources.LatencyHistogram()
+		for value in range(1, 10001):
+			histogram.add(value * 1000)
+
+		for q in (50, 99):
+			expected = q * 100 * 1000
+			actual = histogram.percentile(q)
+			self.assertGreaterEqual(actual, expected)
+			self.assertLess(actual, expected * 1.125)
+
+	def test_empty(self):
+		self.assertEqual(cdls.datasources.LatencyHistogram().percentile(99), 0)
+
+class TestLoadReport(unittest.TestCase):
+	def test_json_form(self):
+		class FakeSource:
+			def get_identifier(self):
+				return "fake"
+
+		report = cdls.datasources.LoadReport(FakeSource())
+		report.start(0)
+		report.mark_record(1000000)
+		report.mark_record(3000000)
+		report.finish(2000000000)
+
+		values = json.loads(report.to_json())
+		self.assertEqual(values["number_processed"], 2)
+		self.assertEqual(values["rate"], 1.0)
+		self.assertEqual(set(values["phase_seconds"]), set(cdls.datasources.PHASES))
+		self.assertIn("rec/s", str(report))
+
+	@unittest.skipIf(cdls.datasources.resource is None, "resource is not available")
+	def test_peak_rss_is_in_kilobytes(self):
+		usage = unittest.mock.Mock(ru_maxrss=2097152)
+		with unittest.mock.patch.object(cdls.datasources.resource, "getrusage", return_value=usage):
+			with unittest.mock.patch.object(cdls.datasources.sys, "platform", "darwin"):
+				self.assertEqual(cdls.datasources._get_peak_rss(), 2048)
+			with unittest.mock.patch.object(cdls.datasources.sys, "platform", "linux"):
+				self.assertEqual(cdls.datasources._get_peak_rss(), 2097152)
+
+class TestLogSampler(unittest.TestCase):
+	def test_first_then_every(self):
+		sampler = cdls.datasources.LogSampler(3, 10)
+		allowed = [n for n in range(1, 41) if sampler.allow("info", "Found record {}")]
+
+		self.assertEqual(allowed, [1, 2, 3, 13, 23, 33])
+		self.assertEqual(sampler.drain(), [(("info", "Found record {}"), (40, 34))])
+		self.assertEqual(sampler.drain(), [])
+
+	def test_disabled_levels_are_not_sampled(self):
+		class QuietLogger:
+			def is_enabled(self, level, tag=None):
+				return level != "debug"
+
+			def __getattr__(self, name):
+				return lambda *args, **kwargs: "logged"
+
+		datasource = cdls.datasources.SyntheticDataSource({"id": "synthetic", "description": "test"})
+		datasource.register_logger(QuietLogger())
+		for n in range(20):
+			self.assertIsNone(datasource._log("Found record {}", n, level="debug"))
+		self.assertEqual(datasource._log("Loaded", level="info"), "logged")
+		self.assertEqual(datasource._log_sampler.drain(), [])
+
+	def test_templates_are_counted_separately(self):
+		sampler = cdls.datasources.LogSampler(1, 0)
+		self.assertTrue(sampler.allow("info", "a"))
+		self.assertTrue(sampler.allow("info", "b"))
+		self.assertTrue(sampler.allow("warn", "a"))
+		self.assertFalse(sampler.allow("info", "a"))
+
+class TestSyntheticDataSource(unittest.TestCase):
+	class FakeDatabase:
+		def __init__(self):
+			self.records = []
+
+		def warehouse_many(self, records, source, workers=None, stats=None):
+			self.records.extend(records)
+			return []
+
+	class FakeLogger:
+		def __getattr__(self, name):
+			return lambda *args, **kwargs: None
+
+	def load(self, **config):
+		config.update({"id": "synthetic", "description": "test"})
+		datasource = cdls.datasources.SyntheticDataSource(config)
+		datasource.register_database(self.FakeDatabase())
+		datasource.register_logger(self.FakeLogger())
+		return datasource, datasource.execute()
+
+	def test_generates_configured_records(self):
+		datasource, report = self.load(record_count=25, payload_size=100, field_count=3, batch_size=10)
+
+		self.assertEqual(report.number_processed, 25)
+		self.assertEqual(len(datasource._db.records), 25)
+
+		record, record_date = datasource._db.records[-1]
+		self.assertEqual(len(record.payload), 100)
+		self.assertEqual(record.field_02, "field_02-24")
+
+	def test_sequential_dates(self):
+		datasource, report = self.load(record_count=10, date_distribution="sequential", date_span_days=10)
+		dates = [record_date for record, record_date in datasource._db.records]
+		self.assertEqual(dates, sorted(dates))
+		self.assertEqual(report.latest_record, dates[-1])
+
+	def test_unknown_distribution(self):
+		with self.assertRaises(cdls.errors.SourceConfigurationError):
+			self.load(date_distribution="bogus")
+
+class TestMemoryBudget(unittest.TestCase):
+	def test_waits_for_room(self):
+		budget = cdls.datasources.MemoryBudget(100)
+		budget.acquire(500)
+		self.assertTrue(budget.over(1))
+
+		thread = threading.Thread(target=budget.acquire, args=(60,))
+		thread.start()
+		thread.join(0.1)
+		self.assertTrue(thread.is_alive())
+
+		budget.release(500)
+		thread.join(1)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual((budget.in_use, budget.peak, budget.waits), (60, 500, 1))
+
+	def test_unlimited(self):
+		budget = cdls.datasources.MemoryBudget(0)
+		budget.add(10 ** 12)
+		self.assertFalse(budget.over(10 ** 12))
+
+class TestAdaptiveBatching(unittest.TestCase):
+	class TimedDatabase:
+		"""Reports each record as taking `record_ns` to write and as
+		`record_bytes` big.
+		"""
+		def __init__(self, record_ns, record_bytes):
+			self.record_ns = record_ns
+			self.record_bytes = record_bytes
+			self.batches = []
+
+		def warehouse_many(self, records, source, workers=None, stats=None):
+			self.batches.append(len(records))
+			stats["write_ns"] = len(records) * self.record_ns
+			stats["bytes_written"] = len(records) * self.record_bytes
+			return []
+
+	def load(self, db, **config):
+		config.update({"id": "synthetic", "description": "test", "record_count": 20000, "payload_size": 10, "field_count": 0})
+		datasource = cdls.datasources.SyntheticDataSource(config)
+		datasource.register_database(db)
+		datasource.register_logger(TestSyntheticDataSource.FakeLogger())
+		return datasource.execute()
+
+	def test_grows_toward_target_commit_time(self):
+		db = self.TimedDatabase(1000, 100)
+		report = self.load(db, target_commit_seconds=0.01)
+
+		self.assertEqual(db.batches, [500, 1000, 2000, 4000, 8000, 4500])
+		self.assertEqual(report.batch_size, 10000)
+		self.assertEqual(report.as_dict()["batch_size"], 10000)
+
+	def test_shrinks_toward_target_commit_time(self):
+		db = self.TimedDatabase(10 ** 6, 100)
+		report = self.load(db, target_commit_seconds=0.05)
+		self.assertEqual(db.batches[:4], [500, 250, 125, 62])
+		self.assertEqual(report.batch_size, 50)
+
+	def test_stays_within_memory_budget(self):
+		db = self.TimedDatabase(1000, 1000)
+		report = self.load(db, memory_budget_bytes=100000)
+
+		self.assertEqual(max(db.batches[1:]), 50)
+		self.assertEqual(report.memory_budget, 100000)
+		self.assertLessEqual(report.peak_in_flight, 100000)
+		self.assertGreater(report.peak_in_flight, 0)
+
+	def test_fixed_batch_size(self):
+		db = self.TimedDatabase(1000, 100)
+		self.load(db, batch_size=4000)
+		self.assertEqual(db.batches, [4000] * 5)
+
+class TestSqlDataSource(unittest.TestCase):
+	class FailingBackend(cdls.backends.memory.MemoryBackend):
+		"""Fails every write after the first `writes`. """
+		def __init__(self, writes):
+			super().__init__()
+			self.writes = writes
+
+		def warehouse_many(self, records, source, workers=None, stats=None, reject=True):
+			if not self.writes:
+				raise cdls.errors.DatabaseError("disk full")
+			self.writes -= 1
+			return super().warehouse_many(records, source, workers, stats, reject)
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.upstream = os.path.join(self.tmp.name, "upstream.db")
+		with sqlite3.connect(self.upstream) as connection:
+			connection.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, status TEXT, placed_on TEXT)")
+			self.add_orders(connection, range(1, 26))
+		connection.close()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def add_orders(self, connection, ids):
+		connection.executemany("INSERT INTO orders VALUES (?, ?, ?)",
+		                       [(n, "open" if n % 2 else "shipped", "2015-01-{:02d}T12:00:00".format(n % 28 + 1)) for n in ids])
+
+	def load(self, db, **overrides):
+		config = {
+			"id": "orders",
+			"description": "test",
+			"database": self.upstream,
+			"query": "SELECT id, status, placed_on FROM orders WHERE status != 'lost'",
+			"key_column": "id",
+			"date_column": "placed_on",
+			"page_size": 10,
+			"fetch_size": 3,
+			"batch_size": 4
+		}
+		config.update(overrides)
+		datasource = cdls.datasources.SqlDataSource(config)
+		datasource.register_database(db)
+		datasource.register_logger(TestSyntheticDataSource.FakeLogger())
+		return datasource.execute()
+
+	def loaded_ids(self, db):
+		return [json.loads(change.json)["$contents"]["id"] for change in db.query("orders")]
+
+	def test_pages_and_resumes(self):
+		db = cdls.backends.memory.MemoryBackend()
+		report = self.load(db)
+		self.assertTrue(report.successful)
+		self.assertEqual(report.number_processed, 25)
+		self.assertEqual(self.loaded_ids(db), list(range(1, 26)))
+		self.assertEqual(db.query("orders")[0].record_date, "2015-01-02 12:00:00.000000")
+		self.assertEqual(db.get_watermark("orders"), 25)
+
+		# Only new rows are pulled next time
+		with sqlite3.connect(self.upstream) as connection:
+			self.add_orders(connection, range(26, 31))
+		connection.close()
+		self.assertEqual(self.load(db).number_processed, 5)
+		self.assertEqual(self.loaded_ids(db), list(range(1, 31)))
+
+	def test_failed_load_resumes_from_committed_page(self):
+		db = self.FailingBackend(3)
+		with self.assertRaises(cdls.errors.DatabaseError):
+			self.load(db)
+		self.assertEqual(db.get_watermark("orders"), 10)
+
+		db.writes = 100
+		self.load(db)
+		self.assertEqual(sorted(set(self.loaded_ids(db))), list(range(1, 26)))
+		self.assertEqual(self.loaded_ids(db)[-15:], list(range(11, 26)))
+
+	def test_configuration_errors(self):
+		with self.assertRaises(cdls.errors.SourceConfigurationError):
+			self.load(cdls.backends.memory.MemoryBackend(), key_column="id; DROP TABLE orders")
+		self.assertFalse(self.load(cdls.backends.memory.MemoryBackend(), key_column="placed").successful)
+		self.assertFalse(self.load(cdls.backends.memory.MemoryBackend(), query="SELECT * FROM nothing").successful)
+		with self.assertRaises(cdls.errors.SourceConfigurationError):
+			self.load(cdls.backends.memory.MemoryBackend(), key_type="blob")
+
+	def test_key_types(self):
+		db = cdls.backends.memory.MemoryBackend()
+		report = self.load(db, key_column="placed_on", key_type="text", page_size=20)
+		self.assertEqual(report.number_processed, 25)
+		self.assertEqual(db.get_watermark("orders"), "2015-01-26T12:00:00")
+
+		# A key that doesn't match its type fails the load before saving it
+		db = cdls.backends.memory.MemoryBackend()
+		report = self.load(db, key_column="placed_on")
+		self.assertFalse(report.successful)
+		self.assertEqual((db.records, db.get_watermark("orders")), ([], None))
+
+	def test_timestamp_keys(self):
+		with sqlite3.connect(self.upstream) as connection:
+			connection.execute("CREATE TABLE events (id INTEGER, happened_on TIMESTAMP)")
+			connection.executemany("INSERT INTO events VALUES (?, ?)", [(n, "2015-01-{:02d} 12:00:00".format(n)) for n in range(1, 26)])
+		connection.close()
+
+		db = cdls.backends.memory.MemoryBackend()
+		config = {"query": "SELECT id, happened_on FROM events", "key_column": "happened_on", "key_type": "timestamp", "date_column": None,
+		          "connect_args": {"detect_types": sqlite3.PARSE_DECLTYPES}}
+		self.assertTrue(self.load(db, page_size=20, **config).successful)
+		self.assertEqual(db.get_watermark("orders"), "2015-01-25T12:00:00")
+
+		# Resumes from the stored timestamp
+		with sqlite3.connect(self.upstream) as connection:
+			connection.execute("INSERT INTO events VALUES (26, '2015-01-26 12:00:00')")
+		connection.close()
+		self.assertEqual(self.load(db, **config).number_processed, 1)
+		self.assertEqual(db.get_watermark("orders"), "2015-01-26T12:00:00")
+
 if "__main__" == __name__:
 	unittest.main()
@@ -1,9 +1,18 @@
 import unittest
 import sys
 import datetime
+import decimal
+import os
+import tempfile
+import threading
+import unittest.mock
 
 sys.path.append("/Users/david/code/python/CDLS")
+import cdls.caching
+import cdls.config
 import cdls.db
+import cdls.errors
+import cdls.serialization
 
 class TestDatabase(unittest.TestCase):
 	def setUp(self):
@@ -16,5 +25,406 @@ class TestDatabase(unittest.TestCase):
 		import datetime
 		cdls.db.warehouse({"foo":"bar"}, "fake", datetime.datetime.now())
 
+class Flaky:
+	"""Fails to serialize until `broken` is switched off. """
+	broken = True
+
+	def __init__(self, n):
+		self.n = n
+
+	@property
+	def __dict__(self):
+		if Flaky.broken:
+			raise TypeError("still broken")
+		return {"n": self.n}
+
+class ScratchDatabaseTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.original_path = cdls.db._DBPATH
+		cdls.db._conn = None
+		cdls.db._DBPATH = os.path.join(self.tmp.name, "test.db")
+		cdls.db.install()
+
+	def tearDown(self):
+		cdls.db.close()
+		cdls.db._DBPATH = self.original_path
+		self.tmp.cleanup()
+
+	def query(self, sql):
+		return cdls.db._connect().execute(sql).fetchall()
+
+class TestRejects(ScratchDatabaseTestCase):
+	def tearDown(self):
+		Flaky.broken = True
+		super().tearDown()
+
+	def test_bad_records_are_rejected_and_the_rest_committed(self):
+		now = datetime.datetime.now()
+		records = [({"n": 0}, now), (Flaky(1), now), ({"n": 2}, now)]
+		errors = cdls.db.warehouse_many(records, "fake")
+
+		self.assertEqual([index for index, error in errors], [1])
+		self.assertEqual(self.query("SELECT COUNT(*) FROM warehouse"), [(2,)])
+		rejects = self.query("SELECT source_identifier, error_type, error_message, payload_text FROM warehouse_rejects")
+		self.assertEqual(rejects[0][:2], ("FAKE", "TypeError"))
+		self.assertIn("still broken", rejects[0][2])
+
+	def test_replay(self):
+		class Order:
+			def __init__(self, n):
+				self.n = n
+
+		# A GUID clash fails the second row on its own
+		now = datetime.datetime(2015, 1, 2, 3, 4, 5)
+		with unittest.mock.patch("uuid.uuid1", return_value="same"):
+			self.assertEqual(len(cdls.db.warehouse_many([(Order(1), now), (Order(2), now)], "fake")), 1)
+			self.assertEqual(cdls.db.replay_rejects("fake"), (0, 1))
+		self.assertEqual(self.query("SELECT replay_count FROM warehouse_rejects"), [(1,)])
+
+		self.assertEqual(cdls.db.replay_rejects(), (1, 0))
+		self.assertEqual(self.query("SELECT COUNT(*) FROM warehouse_rejects"), [(0,)])
+		self.assertEqual(self.query("SELECT record_date, json FROM warehouse ORDER BY seq")[1],
+		                 ("2015-01-02 03:04:05.000000", cdls.serialization.encode(Order(2))))
+
+	def test_unencodable_rejects_are_salvaged_and_replayed(self):
+		now = datetime.datetime(2015, 1, 2, 3, 4, 5)
+		errors = cdls.db.warehouse_many([({"n": 1, "total": decimal.Decimal("1.5")}, now)], "fake", workers=0)
+		self.assertEqual(len(errors), 1)
+		(payload_text, payload_repr) = self.query("SELECT payload_text, payload_repr FROM warehouse_rejects")[0]
+		self.assertIn("Decimal('1.5')", payload_repr)
+
+		# Once the encoder handles the value, the salvaged document goes in
+		tojson = cdls.serialization._tojson
+		with unittest.mock.patch("cdls.serialization._tojson", lambda o: str(o) if isinstance(o, decimal.Decimal) else tojson(o)):
+			self.assertEqual(cdls.db.replay_rejects(), (1, 0))
+		self.assertEqual(self.query("SELECT COUNT(*) FROM warehouse_rejects"), [(0,)])
+		self.assertEqual(self.query("SELECT json_extract(json, '$.\"$contents\".total') FROM warehouse"), [("1.5",)])
+
+	def test_unserializable_rejects_are_not_replayed(self):
+		cdls.db.warehouse_many([(Flaky(1), datetime.datetime.now())], "fake")
+		Flaky.broken = False
+		self.assertEqual(cdls.db.replay_rejects(), (0, 1))
+		self.assertEqual(self.query("SELECT COUNT(*) FROM warehouse"), [(0,)])
+
+	def test_single_warehouse_still_raises(self):
+		with self.assertRaises(cdls.errors.DatabaseError):
+			cdls.db.warehouse(Flaky(1), "fake", datetime.datetime.now())
+		self.assertEqual(self.query("SELECT COUNT(*) FROM warehouse_rejects"), [(0,)])
+
+class TestChangeFeed(ScratchDatabaseTestCase):
+	def warehouse(self, source, count):
+		cdls.db.warehouse_many([({"n": n}, datetime.datetime.now()) for n in range(count)], source)
+
+	def test_read_and_commit(self):
+		self.warehouse("fake", 5)
+
+		changes = cdls.db.read_changes("consumer", limit=3)
+		self.assertEqual([change.position for change in changes], [1, 2, 3])
+
+		# Reading alone doesn't move the cursor
+		self.assertEqual(cdls.db.read_changes("consumer", limit=3), changes)
+
+		cdls.db.commit_cursor("consumer", changes[-1].position)
+		self.warehouse("fake", 1)
+		self.assertEqual([change.position for change in cdls.db.read_changes("consumer")], [4, 5, 6])
+		self.assertEqual(cdls.db.read_changes("other", limit=1)[0].position, 1)
+
+	def test_filter_by_source(self):
+		self.warehouse("a", 2)
+		self.warehouse("b", 2)
+		changes = cdls.db.read_changes("consumer", source="b")
+		self.assertEqual([(change.position, change.source) for change in changes], [(3, "B"), (4, "B")])
+
+class TestSearch(ScratchDatabaseTestCase):
+	def setUp(self):
+		super().setUp()
+		cdls.db.configure_source("articles", {"search_fields": ["title", "author.name"]})
+
+	def tearDown(self):
+		cdls.db._sources.clear()
+		super().tearDown()
+
+	def test_search(self):
+		now = datetime.datetime.now()
+		cdls.db.warehouse_many([
+			({"title": "Quarterly widget report", "author": {"name": "Ada"}}, now),
+			({"title": "Gadget inventory", "author": {"name": "Grace"}}, now),
+			({"title": "Widget recall", "author": {"name": "Grace"}, "body": "gadget"}, now)
+		], "articles")
+		cdls.db.warehouse_many([({"title": "widget"}, now)], "unindexed")
+
+		results = cdls.db.search_warehouse("widget")
+		self.assertEqual(len(results), 2)
+		self.assertEqual(set(result.source for result in results), {"ARTICLES"})
+		self.assertIn("[Widget]", results[0].snippet + results[1].snippet)
+
+		# Nested fields are indexed, unlisted fields aren't
+		self.assertEqual(len(cdls.db.search_warehouse("grace")), 2)
+		self.assertEqual(len(cdls.db.search_warehouse("gadget")), 1)
+		self.assertEqual(cdls.db.search_warehouse("widget", source="other"), [])
+
+	def test_rejected_records_are_not_indexed(self):
+		now = datetime.datetime.now()
+		cdls.db.warehouse_many([({"title": "widget"}, now), (Flaky(1), now)], "articles")
+		self.assertEqual(len(cdls.db.search_warehouse("widget")), 1)
+		(name,) = self.query("SELECT name FROM warehouse_partitions")[0]
+		self.assertEqual(self.query("SELECT COUNT(*) FROM `{}_FTS`".format(name)), [(1,)])
+
+class TestProjections(ScratchDatabaseTestCase):
+	def setUp(self):
+		super().setUp()
+		cdls.db.configure_source("orders", {"projections": {"status": "text", "total": "real", "customer.id": "integer"}})
+
+	def tearDown(self):
+		cdls.db._sources.clear()
+		super().tearDown()
+
+	def warehouse(self):
+		now = datetime.datetime.now()
+		cdls.db.warehouse_many([
+			({"status": "open", "total": 10.5, "customer": {"id": 1}, "note": "a"}, now),
+			({"status": "shipped", "total": "25", "customer": {"id": 2}, "note": "b"}, now),
+			({"status": "open", "total": "n/a", "customer": {"id": 2}, "note": "c"}, now)
+		], "orders")
+
+	def test_filters_are_pushed_down(self):
+		self.warehouse()
+
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("orders", {"status": "open"})], [1, 3])
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("orders", {"total": (">", 20)})], [2])
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("orders", {"customer.id": ("in", [2]), "status": "open"})], [3])
+
+		(name,) = self.query("SELECT name FROM warehouse_partitions")[0]
+		plan = " ".join(row[3] for row in self.query("EXPLAIN QUERY PLAN SELECT seq FROM `{}_P` WHERE p_status = 'open'".format(name)))
+		self.assertIn("{}_P_P_STATUS".format(name), plan)
+
+	def test_unprojected_fields_fall_back_to_json(self):
+		self.warehouse()
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("orders", {"note": "b", "status": "shipped"})], [2])
+		self.assertEqual(cdls.db.query_warehouse("other", {"note": "b"}), [])
+
+	def test_new_projections_are_backfilled(self):
+		self.warehouse()
+		cdls.db.configure_source("orders", {"projections": {"status": "text", "note": "text"}})
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("orders", {"note": ("!=", "a")})], [2, 3])
+
+	def test_unsupported_type(self):
+		with self.assertRaises(cdls.errors.SourceConfigurationError):
+			cdls.db.configure_source("orders", {"projections": {"status": "blob"}})
+
+class TestPartitions(ScratchDatabaseTestCase):
+	def setUp(self):
+		super().setUp()
+		cdls.db.configure_source("logs", {"retention_days": 60, "search_fields": ["message"], "projections": {"level": "text"}})
+
+	def tearDown(self):
+		cdls.db._sources.clear()
+		super().tearDown()
+
+	def warehouse(self):
+		cdls.db.warehouse_many([
+			({"message": "january", "level": "info"}, datetime.datetime(2015, 1, 31, 23, 59)),
+			({"message": "february", "level": "warn"}, datetime.datetime(2015, 2, 1)),
+			({"message": "december", "level": "info"}, datetime.datetime(2014, 12, 25))
+		], "logs")
+		cdls.db.warehouse_many([({"message": "other"}, datetime.datetime(2015, 1, 1))], "other")
+
+	def test_partitions_by_source_and_month(self):
+		self.warehouse()
+		self.assertEqual(self.query("SELECT name, range_start FROM warehouse_partitions ORDER BY name"), [
+			("WAREHOUSE_PART_LOGS_201412", "2014-12-01 00:00:00.000000"),
+			("WAREHOUSE_PART_LOGS_201501", "2015-01-01 00:00:00.000000"),
+			("WAREHOUSE_PART_LOGS_201502", "2015-02-01 00:00:00.000000"),
+			("WAREHOUSE_PART_OTHER_201501", "2015-01-01 00:00:00.000000")
+		])
+
+		# SEQ is global, so the view and change feed read in write order
+		self.assertEqual(self.query("SELECT seq, source_identifier FROM warehouse ORDER BY seq"),
+		                 [(1, "LOGS"), (2, "LOGS"), (3, "LOGS"), (4, "OTHER")])
+		self.assertEqual([change.position for change in cdls.db.read_changes("consumer", source="logs")], [1, 2, 3])
+
+	def test_date_range_prunes_partitions(self):
+		self.warehouse()
+		since, until = datetime.datetime(2015, 1, 15), datetime.datetime(2015, 2, 1)
+		self.assertEqual(cdls.db._source_partitions(cdls.db._connect(), "LOGS", since, until), ["WAREHOUSE_PART_LOGS_201501"])
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("logs", since=since, until=until)], [1])
+		self.assertEqual([change.position for change in cdls.db.query_warehouse("logs", {"level": "info"}, since=datetime.datetime(2015, 1, 1))], [1])
+
+	def test_failed_batch_forgets_its_tables(self):
+		index_fulltext = cdls.db._index_fulltext
+		def failing_index(*args):
+			index_fulltext(*args)
+			raise cdls.errors.DatabaseError("injected")
+
+		with unittest.mock.patch("cdls.db._index_fulltext", failing_index):
+			with self.assertRaises(cdls.errors.DatabaseError):
+				self.warehouse()
+		self.assertEqual(self.query("SELECT COUNT(*) FROM sqlite_master WHERE name GLOB 'WAREHOUSE_PART_*'"), [(0,)])
+
+		# The next batch creates them again
+		self.warehouse()
+		self.assertEqual(len(cdls.db.search_warehouse("january")), 1)
+		self.assertEqual(len(cdls.db.query_warehouse("logs", {"level": "info"})), 2)
+
+	def test_retention_drops_whole_partitions(self):
+		self.warehouse()
+		dropped = cdls.db.apply_retention(now=datetime.datetime(2015, 4, 15))
+
+		# January ended more than 60 days ago but February hasn't
+		self.assertEqual(dropped, ["WAREHOUSE_PART_LOGS_201412", "WAREHOUSE_PART_LOGS_201501"])
+		self.assertEqual(self.query("SELECT seq FROM warehouse ORDER BY seq"), [(2,), (4,)])
+		self.assertEqual([result.guid for result in cdls.db.search_warehouse("january OR december")], [])
+		self.assertEqual(len(cdls.db.search_warehouse("february")), 1)
+
+		# Their full-text indexes and projection tables went with them
+		self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name LIKE 'WAREHOUSE_PART_LOGS_%' AND name NOT LIKE '%FTS_%' ORDER BY name"), [
+			("WAREHOUSE_PART_LOGS_201502",),
+			("WAREHOUSE_PART_LOGS_201502_FTS",),
+			("WAREHOUSE_PART_LOGS_201502_GUID",),
+			("WAREHOUSE_PART_LOGS_201502_P",),
+			("WAREHOUSE_PART_LOGS_201502_P_P_LEVEL",)
+		])
+
+		# Writing to a dropped month brings the partition back
+		cdls.db.warehouse_many([({"message": "late"}, datetime.datetime(2015, 1, 2))], "logs")
+		self.assertEqual(self.query("SELECT seq FROM warehouse_src_logs ORDER BY seq"), [(2,), (5,)])
+
+class TestRecordCache(ScratchDatabaseTestCase):
+	def setUp(self):
+		super().setUp()
+		cdls.db._cache = cdls.caching.LRUCache(256)
+		cdls.db.warehouse_many([({"n": n}, datetime.datetime(2015, 1 + n % 2, 1)) for n in range(10)], "fake")
+		self.guids = [row[0] for row in self.query("SELECT guid FROM warehouse ORDER BY seq")]
+
+	def tearDown(self):
+		cdls.db._cache = cdls.caching.LRUCache(cdls.config.DB_CACHE_MAX_BYTES)
+		super().tearDown()
+
+	def test_get_many(self):
+		records = cdls.db.get_many([self.guids[3], "missing", self.guids[1]])
+		self.assertEqual(list(records), [self.guids[3], self.guids[1]])
+		self.assertEqual(records[self.guids[3]].data, {"n": 3})
+		self.assertEqual(records[self.guids[1]].source, "FAKE")
+		self.assertEqual(cdls.db.cache_stats()["misses"], 3)
+
+		self.assertEqual(cdls.db.get(self.guids[3]), records[self.guids[3]])
+		self.assertIsNone(cdls.db.get("missing"))
+		stats = cdls.db.cache_stats()
+		self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 4, 2))
+
+	def test_evicts_least_recently_used(self):
+		cdls.db.get_many(self.guids)
+		stats = cdls.db.cache_stats()
+		self.assertGreater(stats["evictions"], 0)
+		self.assertLessEqual(stats["size"], 256)
+
+		# The most recent lookups survive
+		cdls.db.get(self.guids[-1])
+		self.assertEqual(cdls.db.cache_stats()["hits"], 1)
+
+	def test_invalidation(self):
+		cdls.db.get_many(self.guids[:3])
+		cdls.db._cache.put("NEW", "stale", 1)
+		cdls.db.apply_retention()
+		self.assertEqual(cdls.db.cache_stats()["entries"], 4)
+
+		# Writes drop their GUIDs, dropped partitions drop everything
+		with unittest.mock.patch("uuid.uuid1", return_value="new"):
+			cdls.db.warehouse({"n": 10}, "fake", datetime.datetime(2015, 1, 1))
+		self.assertEqual(cdls.db.get("NEW").data, {"n": 10})
+
+		cdls.db.configure_source("fake", {"retention_days": 1})
+		self.assertEqual(len(cdls.db.apply_retention(now=datetime.datetime(2016, 1, 1))), 2)
+		self.assertEqual(cdls.db.cache_stats()["entries"], 0)
+		self.assertIsNone(cdls.db.get(self.guids[0]))
+		cdls.db._sources.clear()
+
+class TestShards(ScratchDatabaseTestCase):
+	def setUp(self):
+		cdls.config.DB_SHARD_COUNT = 2
+		super().setUp()
+		cdls.db.configure_source("pinned", {"shard": "Pinned"})
+
+	def tearDown(self):
+		cdls.config.DB_SHARD_COUNT = 0
+		cdls.db._sources.clear()
+		super().tearDown()
+
+	def warehouse(self, source, count):
+		cdls.db.warehouse_many([({"n": n}, datetime.datetime(2015, 1, 1)) for n in range(count)], source)
+
+	def test_sources_write_to_their_own_shards(self):
+		for source in ("pinned", "a", "b", "c"):
+			self.warehouse(source, 2)
+
+		shards = sorted(os.path.basename(path) for path in os.listdir(self.tmp.name) if path.endswith(".db"))
+		self.assertIn("test.shard-pinned.db", shards)
+		self.assertEqual(self.query("SELECT name FROM shard_pinned.warehouse_partitions"), [("WAREHOUSE_PART_PINNED_201501",)])
+		self.assertEqual(self.query("SELECT COUNT(*) FROM main.warehouse_partitions"), [(0,)])
+
+		# The facade reads across every shard in SEQ order
+		positions = [change.position for change in cdls.db.read_changes("consumer")]
+		self.assertEqual(len(positions), 8)
+		self.assertEqual(positions, sorted(set(positions)))
+		self.assertEqual([change.source for change in cdls.db.read_changes("consumer", source="c")], ["C", "C"])
+
+		cdls.db.install()
+		self.assertEqual([path for path in os.listdir(self.tmp.name) if ".shard-" in path], [])
+
+	def test_concurrent_writers(self):
+		threads = [threading.Thread(target=lambda source=source: [self.warehouse(source, 50) for n in range(10)])
+		           for source in ("pinned", "a", "b", "c")]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(self.query("SELECT COUNT(*), COUNT(DISTINCT seq) FROM warehouse"), [(2000, 2000)])
+
+	def test_failed_batch_rolls_back_new_partitions(self):
+		with unittest.mock.patch("cdls.db._insert_isolated", side_effect=cdls.errors.DatabaseError("injected")):
+			with self.assertRaises(cdls.errors.DatabaseError):
+				self.warehouse("pinned", 2)
+		self.assertEqual(self.query("SELECT COUNT(*) FROM shard_pinned.sqlite_master WHERE name GLOB 'WAREHOUSE_PART_*'"), [(0,)])
+
+		self.warehouse("pinned", 2)
+		self.assertEqual(self.query("SELECT COUNT(*) FROM shard_pinned.warehouse"), [(2,)])
+
+	def test_change_feed_waits_for_reserved_seq(self):
+		cdls.db.configure_source("other", {"shard": "Other"})
+		original = cdls.config.DB_SEQ_BLOCK_SIZE
+		cdls.config.DB_SEQ_BLOCK_SIZE = 100
+		try:
+			# Each shard reserves a block, then they commit interleaved
+			self.warehouse("pinned", 10)
+			self.warehouse("other", 10)
+			changes = cdls.db.read_changes("consumer")
+			self.assertEqual(len(changes), 20)
+			cdls.db.commit_cursor("consumer", changes[-1].position)
+
+			# Rows committed after the read still come after the cursor
+			self.warehouse("pinned", 10)
+			self.warehouse("other", 10)
+			changes = cdls.db.read_changes("consumer")
+			self.assertEqual([change.source for change in changes], ["PINNED"] * 10 + ["OTHER"] * 10)
+		finally:
+			cdls.config.DB_SEQ_BLOCK_SIZE = original
+
+	def test_seq_is_reserved_in_blocks(self):
+		original = cdls.config.DB_SEQ_BLOCK_SIZE
+		cdls.config.DB_SEQ_BLOCK_SIZE = 100
+		try:
+			for n in range(3):
+				self.warehouse("pinned", 10)
+			self.assertEqual(self.query("SELECT value FROM main.cdls_sequences"), [(100,)])
+			self.assertEqual(self.query("SELECT MIN(seq), MAX(seq) FROM shard_pinned.warehouse"), [(1, 30)])
+
+			# A batch bigger than what's left gets a block of its own
+			self.warehouse("pinned", 150)
+			self.assertEqual(self.query("SELECT value FROM main.cdls_sequences"), [(250,)])
+		finally:
+			cdls.config.DB_SEQ_BLOCK_SIZE = original
+
 if "__main__" == __name__:
 	unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import csv
+import datetime
+import gzip
+import json
+import os
+import tempfile
+
+import cdls.config
+import cdls.db
+import cdls.errors
+import cdls.exporting
+
+class TestExport(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.original_path = cdls.db._DBPATH
+		cdls.db.close()
+		cdls.db._DBPATH = os.path.join(self.tmp.name, "test.db")
+		cdls.db.install()
+
+		records = [({"n": n, "text": "line\nbreak"}, datetime.datetime(2015, 1 + n % 3, 1 + n % 28)) for n in range(50)]
+		cdls.db.warehouse_many(records, "orders")
+		cdls.db.warehouse({"n": -1}, "other", datetime.datetime(2015, 1, 1))
+
+	def tearDown(self):
+		cdls.db.close()
+		cdls.db._DBPATH = self.original_path
+		self.tmp.cleanup()
+
+	def read_jsonl(self, path):
+		opener = gzip.open if path.endswith(".gz") else open
+		with opener(path, "rt") as fp:
+			return [json.loads(line) for line in fp]
+
+	def test_jsonl(self):
+		path = os.path.join(self.tmp.name, "orders.jsonl")
+		result = cdls.exporting.export("orders", path)
+		self.assertEqual(result, cdls.exporting.ExportResult(50, [path]))
+
+		lines = self.read_jsonl(path)
+		self.assertEqual(sorted(line["document"]["$contents"]["n"] for line in lines), list(range(50)))
+		self.assertEqual(lines[0]["document"]["$contents"]["text"], "line\nbreak")
+		self.assertEqual(set(line["source"] for line in lines), {"ORDERS"})
+
+	def test_csv_gzip_date_range(self):
+		path = os.path.join(self.tmp.name, "orders.csv.gz")
+		result = cdls.exporting.export("orders", path, "csv", since=datetime.datetime(2015, 2, 1), until=datetime.datetime(2015, 3, 1), compress=True)
+
+		with gzip.open(path, "rt", newline="") as fp:
+			rows = list(csv.DictReader(fp))
+		self.assertEqual(result.rows, len(rows))
+		self.assertEqual(sorted(json.loads(row["document"])["$contents"]["n"] for row in rows), [n for n in range(50) if n % 3 == 1])
+
+	def test_parts_in_parallel(self):
+		directory = os.path.join(self.tmp.name, "parts")
+		result = cdls.exporting.export("orders", directory, part_rows=7, compress=True, workers=3)
+
+		self.assertEqual(result.rows, 50)
+		seqs = []
+		for path in result.files:
+			lines = self.read_jsonl(path)
+			self.assertLessEqual(len(lines), 7)
+			seqs.extend(line["seq"] for line in lines)
+		self.assertEqual(len(seqs), 50)
+		self.assertEqual(len(set(seqs)), 50)
+
+	def test_ranges_cover_partitions(self):
+		ranges = cdls.db.export_ranges("orders", rows=10)
+		self.assertEqual(len(set(r.partition for r in ranges)), 3)
+		self.assertEqual(sum(len(batch) for r in ranges for batch in cdls.db.read_range(r, batch_size=4)), 50)
+
+	def test_unknown_format(self):
+		with self.assertRaises(cdls.errors.CDLSError):
+			cdls.exporting.export("orders", os.path.join(self.tmp.name, "x"), "xml")
+
+if "__main__" == __name__:
+	unittest.main()
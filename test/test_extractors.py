@@ -0,0 +1,36 @@
+import unittest
+import io
+import json
+
+import cdls.errors
+import cdls.extractors
+
+class TestJsonDocuments(unittest.TestCase):
+	def test_streams_array_across_chunks(self):
+		documents = [{"n": n, "text": "é" * n, "real": n * 1.5} for n in range(50)] + [1234567, "x", None, [1, 2]]
+		data = json.dumps(documents, indent=2).encode()
+
+		for chunk_size in (1, 3, 64, 65536):
+			self.assertEqual(list(cdls.extractors.json_documents(io.BytesIO(data), chunk_size)), documents)
+
+	def test_single_document(self):
+		self.assertEqual(list(cdls.extractors.json_documents(io.BytesIO(b' {"a": 1} '), 2)), [{"a": 1}])
+		self.assertEqual(list(cdls.extractors.json_documents(io.BytesIO(b"[]"))), [])
+		self.assertEqual(list(cdls.extractors.json_documents(io.BytesIO(b""))), [])
+
+	def test_invalid(self):
+		for data in (b"[1,", b"[1 2]", b"[1,]", b'{"a":', b"\xff"):
+			with self.assertRaises(cdls.errors.ExtractError):
+				list(cdls.extractors.json_documents(io.BytesIO(data), 1))
+
+class TestJsonLines(unittest.TestCase):
+	def test_lines(self):
+		self.assertEqual(list(cdls.extractors.extract("jsonl", io.BytesIO(b'{"a": 1}\n\n2\n'))), [{"a": 1}, 2])
+
+		with self.assertRaises(cdls.errors.ExtractError):
+			list(cdls.extractors.extract("jsonl", io.BytesIO(b"{}\n{\n")))
+		with self.assertRaises(cdls.errors.ExtractError):
+			cdls.extractors.extract("xml", io.BytesIO(b""))
+
+if "__main__" == __name__:
+	unittest.main()
@@ -0,0 +1,189 @@
+import unittest
+import contextlib
+import glob
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+
+import cdls.config
+import cdls.errors
+import cdls.logging
+
+class TestLogEntry(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.original_outfile = cdls.logging._OUTFILE
+		cdls.logging._OUTFILE = os.path.join(self.tmp.name, "test.log")
+
+	def tearDown(self):
+		cdls.logging.flush()
+		cdls.logging._OUTFILE = self.original_outfile
+		cdls.config.LOGGING_CONTEXT = True
+		cdls.config.LOGGING_LEVEL = "info"
+		cdls.config.LOGGING_SOURCE_LEVELS = {}
+		cdls.config.LOGGING_OUTPUT = "text"
+		cdls.config.LOGGING_MAX_BYTES = 67108864
+		self.tmp.cleanup()
+
+	def log(self, *args, **kwargs):
+		with contextlib.redirect_stdout(io.StringIO()):
+			return cdls.logging.info(*args, **kwargs)
+
+	def test_context_is_invoking_method(self):
+		output = self.log("hello {}", "world", tag="fake")
+		self.assertTrue(output.endswith("[fake.log:] hello world"))
+
+	def test_context_can_be_disabled(self):
+		cdls.config.LOGGING_CONTEXT = False
+		self.assertTrue(self.log("hello", tag="fake").endswith("[fake:] hello"))
+		self.assertTrue(self.log("hello").endswith("- hello"))
+
+	def test_explicit_context(self):
+		self.assertTrue(self.log("hello", context="ctx").endswith("[ctx:] hello"))
+
+	def test_sink_writes_on_flush(self):
+		for n in range(100):
+			self.log("record {}", n)
+		cdls.logging.flush()
+
+		with open(cdls.logging._OUTFILE) as fp:
+			lines = fp.read().splitlines()
+		self.assertEqual(len(lines), 100)
+		self.assertTrue(lines[-1].endswith("record 99"))
+
+	def test_synchronous_mode(self):
+		cdls.config.LOGGING_ASYNC = False
+		try:
+			self.log("hello")
+			with open(cdls.logging._OUTFILE) as fp:
+				self.assertTrue(fp.read().strip().endswith("hello"))
+		finally:
+			cdls.config.LOGGING_ASYNC = True
+
+	def test_level_filtering(self):
+		self.assertIsNone(cdls.logging.debug("hidden {}", object()))
+
+		cdls.config.LOGGING_LEVEL = "warn"
+		self.assertIsNone(self.log("hidden"))
+		self.assertIsNotNone(cdls.logging.error("shown"))
+
+	def test_unknown_level(self):
+		cdls.config.LOGGING_LEVEL = "verbose"
+		with self.assertRaisesRegex(cdls.errors.ConfigurationError, "debug, info, warn, error"):
+			cdls.logging.check_config()
+		with self.assertRaises(cdls.errors.ConfigurationError):
+			self.log("hello")
+
+		cdls.config.LOGGING_LEVEL = "info"
+		cdls.config.LOGGING_SOURCE_LEVELS = {"fake": "loud"}
+		with self.assertRaisesRegex(cdls.errors.ConfigurationError, "LOGGING_SOURCE_LEVELS"):
+			cdls.logging.check_config()
+
+	def test_per_source_levels(self):
+		cdls.config.LOGGING_SOURCE_LEVELS = {"chatty": "error", "quiet": "debug"}
+		self.assertIsNone(self.log("hidden", tag="chatty"))
+		self.assertTrue(cdls.logging.is_enabled("debug", "quiet"))
+		self.assertFalse(cdls.logging.is_enabled("debug", "other"))
+		self.assertIsNotNone(self.log("shown", tag="other"))
+
+	def test_json_output(self):
+		cdls.config.LOGGING_OUTPUT = "json"
+		self.log("hello {}", "world", tag="fake")
+		cdls.logging.flush()
+
+		with open(cdls.logging._OUTFILE) as fp:
+			record = json.loads(fp.readline())
+		self.assertEqual(record["level"], "INFO")
+		self.assertEqual(record["tag"], "fake")
+		self.assertEqual(record["context"], "log")
+		self.assertEqual(record["message"], "hello world")
+
+	def test_rotation_compresses_and_prunes(self):
+		cdls.config.LOGGING_MAX_BYTES = 1024
+		original_backup_count = cdls.config.LOGGING_BACKUP_COUNT
+		cdls.config.LOGGING_BACKUP_COUNT = 2
+		try:
+			for n in range(200):
+				self.log("record {}", n)
+				if n % 20 == 0:
+					cdls.logging.flush()
+			cdls.logging.flush()
+
+			for thread in threading.enumerate():
+				if thread.name == "cdls-log-gzip":
+					thread.join()
+		finally:
+			cdls.config.LOGGING_BACKUP_COUNT = original_backup_count
+
+		segments = sorted(glob.glob(cdls.logging._OUTFILE + ".*"))
+		self.assertEqual(len(segments), 2)
+		for segment in segments:
+			self.assertTrue(segment.endswith(".gz"))
+			with gzip.open(segment, "rt") as fp:
+				self.assertIn("record", fp.read())
+
+	def test_rotation_of_a_rotated_file_is_skipped(self):
+		cdls.config.LOGGING_MAX_BYTES = 10
+		original_compress = cdls.config.LOGGING_COMPRESS
+		cdls.config.LOGGING_COMPRESS = False
+		try:
+			with open(cdls.logging._OUTFILE, "w") as fp:
+				fp.write("x" * 20)
+
+			# Two threads found the file full; only the first rotates it
+			cdls.logging._rotate(cdls.logging._OUTFILE)
+			cdls.logging._rotate(cdls.logging._OUTFILE)
+			with open(cdls.logging._OUTFILE, "w") as fp:
+				fp.write("x")
+			cdls.logging._rotate(cdls.logging._OUTFILE)
+		finally:
+			cdls.config.LOGGING_COMPRESS = original_compress
+
+		self.assertEqual(len(glob.glob(cdls.logging._OUTFILE + ".*")), 1)
+		self.assertTrue(os.path.exists(cdls.logging._OUTFILE))
+
+	def test_pruning_skips_segments_being_compressed(self):
+		original_backup_count = cdls.config.LOGGING_BACKUP_COUNT
+		cdls.config.LOGGING_BACKUP_COUNT = 1
+		segments = [cdls.logging._OUTFILE + ".2015010{}".format(n) for n in range(1, 4)]
+		for segment in segments:
+			with open(segment, "w") as fp:
+				fp.write("x")
+
+		cdls.logging._compressing.add(segments[0])
+		try:
+			cdls.logging._prune_segments(cdls.logging._OUTFILE)
+		finally:
+			cdls.logging._compressing.discard(segments[0])
+			cdls.config.LOGGING_BACKUP_COUNT = original_backup_count
+
+		self.assertEqual(sorted(glob.glob(cdls.logging._OUTFILE + ".*")), [segments[0], segments[2]])
+
+	def test_sink_drops_records_once_closing(self):
+		sink = cdls.logging._Sink(2, "drop_oldest")
+		stop = threading.Event()
+
+		def produce():
+			while not stop.is_set():
+				sink.put("record", False, None)
+		producer = threading.Thread(target=produce, daemon=True)
+		producer.start()
+
+		# Records racing the close can't evict the stop sentinel
+		closer = threading.Thread(target=sink.close, daemon=True)
+		closer.start()
+		closer.join(5)
+		stop.set()
+		producer.join()
+		self.assertFalse(closer.is_alive())
+
+		dropped = sink.dropped
+		sink.put("record", False, None)
+		self.assertEqual(sink.dropped, dropped + 1)
+		self.assertTrue(sink._queue.empty())
+
+if "__main__" == __name__:
+	unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import io
+import os
+import tempfile
+import threading
+import unittest.mock
+
+import cdls.errors
+import cdls.metrics
+
+class TestMetrics(unittest.TestCase):
+	def test_counter_and_gauge(self):
+		counter = cdls.metrics.counter("test_things_total", "Things", ("source",))
+		counter.labels("a").inc()
+		counter.labels("a").inc(2)
+		gauge = cdls.metrics.gauge("test_depth", "Depth")
+		gauge.set(7)
+
+		output = cdls.metrics.render()
+		self.assertIn("# TYPE test_things_total counter", output)
+		self.assertIn('test_things_total{source="a"} 3', output)
+		self.assertIn("test_depth 7", output)
+
+	def test_histogram_buckets_are_cumulative(self):
+		histogram = cdls.metrics.histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+		for value in (0.05, 0.5, 0.5, 5.0):
+			histogram.observe(value)
+
+		output = cdls.metrics.render()
+		self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', output)
+		self.assertIn('test_latency_seconds_bucket{le="1.0"} 3', output)
+		self.assertIn('test_latency_seconds_bucket{le="+Inf"} 4', output)
+		self.assertIn("test_latency_seconds_count 4", output)
+
+	def test_infinite_bounds_and_values(self):
+		histogram = cdls.metrics.histogram("test_size_bytes", "Size", buckets=(10, float("inf")))
+		histogram.observe(float("inf"))
+		cdls.metrics.gauge("test_ratio", "Ratio").set(float("-inf"))
+
+		output = cdls.metrics.render()
+		self.assertEqual(output.count('test_size_bytes_bucket{le="+Inf"} 1'), 1)
+		self.assertNotIn('le="inf"', output)
+		self.assertIn("test_size_bytes_sum +Inf", output)
+		self.assertIn("test_ratio -Inf", output)
+
+	def test_render_while_adding_labels(self):
+		counter = cdls.metrics.counter("test_busy_total", "Busy", ("n",))
+		thread = threading.Thread(target=lambda: [counter.labels(n).inc() for n in range(20000)])
+		thread.start()
+		while thread.is_alive():
+			cdls.metrics.render()
+		thread.join()
+		self.assertIn('test_busy_total{n="19999"} 1', cdls.metrics.render())
+
+	def test_same_name_returns_same_metric(self):
+		self.assertIs(cdls.metrics.counter("test_same_total", "x"), cdls.metrics.counter("test_same_total", "x"))
+
+	def test_write_textfile(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, "metrics", "cdls.prom")
+			cdls.metrics.write_textfile(path)
+			self.assertEqual(os.listdir(os.path.dirname(path)), ["cdls.prom"])
+
+	def test_failed_export_goes_to_stderr(self):
+		exporter = cdls.metrics._Exporter("unused", 3600)
+		exporter._stopped.set()
+		with unittest.mock.patch("cdls.metrics.write_textfile", side_effect=ValueError("bad sample")), \
+		     unittest.mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+			exporter.stop()
+		self.assertIn("bad sample", stderr.getvalue())
+
+	def test_base_metric_has_no_children(self):
+		with self.assertRaises(cdls.errors.CDLSError):
+			cdls.metrics._Metric("test_base", "x", ())._new_child()
+
+if "__main__" == __name__:
+	unittest.main()
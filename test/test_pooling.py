@@ -0,0 +1,172 @@
+import unittest
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import cdls.backends.memory
+import cdls.datasources
+import cdls.errors
+import cdls.pooling
+
+class FakeLogger:
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: None
+
+class FakeAPI(http.server.ThreadingHTTPServer):
+	"""Serves 25 items, newest `updated` last, as numbered pages. """
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(("127.0.0.1", 0), FakeHandler)
+		self.items = [{"id": n, "updated": n, "created_on": "2015-01-{:02d}T00:00:00".format(n % 28 + 1)} for n in range(1, 26)]
+		self.requests = []
+		self.connections = 0
+		self.in_flight = 0
+		self.most_in_flight = 0
+		self.lock = threading.Lock()
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:{}".format(self.server_address[1])
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		params = dict(urllib.parse.parse_qsl(url.query))
+		with self.server.lock:
+			self.server.requests.append(params)
+			self.server.in_flight += 1
+			self.server.most_in_flight = max(self.server.most_in_flight, self.server.in_flight)
+
+		try:
+			time.sleep(0.02)
+			if url.path == "/missing":
+				self.send_response(404)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+
+			items = [item for item in self.server.items if item["updated"] > int(params.get("since", 0))]
+			if "page" in params:
+				size = int(params["limit"])
+				items = items[(int(params["page"]) - 1) * size:int(params["page"]) * size]
+
+			if url.path == "/lines":
+				body = "".join(json.dumps(item) + "\n" for item in items).encode()
+			else:
+				body = json.dumps(items).encode()
+
+			# Chunked, like a streaming API would send it
+			self.send_response(200)
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			for n in range(0, len(body), 100):
+				chunk = body[n:n + 100]
+				self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+			self.wfile.write(b"0\r\n\r\n")
+		finally:
+			with self.server.lock:
+				self.server.in_flight -= 1
+
+	def log_message(self, *args):
+		pass
+
+class TestConnectionPool(unittest.TestCase):
+	def setUp(self):
+		self.api = FakeAPI()
+		threading.Thread(target=self.api.serve_forever, daemon=True).start()
+		self.pool = cdls.pooling.ConnectionPool(2, 5)
+
+	def tearDown(self):
+		self.pool.close()
+		self.api.shutdown()
+		self.api.server_close()
+
+	def test_keep_alive(self):
+		for n in range(5):
+			with self.pool.request(self.api.url + "/items") as response:
+				self.assertEqual(len(json.loads(response.read())), 25)
+
+		self.assertEqual(self.api.connections, 1)
+		self.assertEqual(self.pool.stats(), {"opened": 1, "reused": 4, "idle": 1})
+
+	def test_abandoned_responses_close(self):
+		with self.pool.request(self.api.url + "/items") as response:
+			response.read(10)
+		self.assertEqual(self.pool.stats()["idle"], 0)
+
+	def test_errors(self):
+		with self.assertRaises(cdls.errors.ExtractError):
+			with self.pool.request("ftp://127.0.0.1/"):
+				pass
+		with self.assertRaises(cdls.errors.ExtractError):
+			with self.pool.request("http://127.0.0.1:1/"):
+				pass
+
+class TestHttpDataSource(unittest.TestCase):
+	def setUp(self):
+		self.api = FakeAPI()
+		threading.Thread(target=self.api.serve_forever, daemon=True).start()
+		self.db = cdls.backends.memory.MemoryBackend()
+
+	def tearDown(self):
+		self.api.shutdown()
+		self.api.server_close()
+
+	def datasource(self, path, **config):
+		config.update({"id": "api", "description": "test", "url": self.api.url + path})
+		datasource = cdls.datasources.HttpDataSource(config)
+		datasource.register_database(self.db)
+		datasource.register_logger(FakeLogger())
+		return datasource
+
+	def loaded_ids(self):
+		return [json.loads(change.json)["$contents"]["id"] for change in self.db.query("api")]
+
+	def test_concurrent_pages(self):
+		datasource = self.datasource("/items", page_param="page", page_size_param="limit", page_size=3,
+		                             concurrency=4, connections_per_host=2, watermark_field="updated")
+		report = datasource.execute()
+
+		self.assertTrue(report.successful)
+		self.assertEqual(report.number_processed, 25)
+		self.assertGreater(report.bytes_read, 0)
+		self.assertEqual(self.loaded_ids(), list(range(1, 26)))
+		self.assertEqual(self.db.query("api")[0].record_date, "2015-01-02 00:00:00.000000")
+		self.assertEqual(self.db.get_watermark("api"), 25)
+
+		# Never more than the per-host limit at once, over kept-alive connections
+		self.assertEqual(self.api.most_in_flight, 2)
+		self.assertLessEqual(self.api.connections, 2)
+
+	def test_incremental(self):
+		self.db.set_watermark("api", 20)
+		report = self.datasource("/lines", format="jsonl", watermark_field="updated").execute()
+
+		self.assertEqual(self.api.requests, [{"since": "20"}])
+		self.assertEqual(report.number_processed, 5)
+		self.assertEqual(self.loaded_ids(), [21, 22, 23, 24, 25])
+		self.assertEqual(self.db.get_watermark("api"), 25)
+
+	def test_failed_load_keeps_watermark(self):
+		self.db.set_watermark("api", 20)
+		report = self.datasource("/missing", watermark_field="updated").execute()
+
+		self.assertFalse(report.successful)
+		self.assertEqual(self.db.get_watermark("api"), 20)
+
+	def test_bad_format(self):
+		with self.assertRaises(cdls.errors.SourceConfigurationError):
+			self.datasource("/items", format="xml")
+
+if "__main__" == __name__:
+	unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+import os
+import tempfile
+import time
+
+import cdls.profiling
+
+def busy_wait(seconds):
+	end = time.perf_counter() + seconds
+	while time.perf_counter() < end:
+		pass
+
+class TestProfiler(unittest.TestCase):
+	def test_profile_writes_stats_and_collapsed_stacks(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			profiler = cdls.profiling.Profiler(tmp, 0.001)
+			with profiler.profile("fake"):
+				busy_wait(0.1)
+
+			stats_path, collapsed_path = profiler.results["fake"].paths
+			with open(collapsed_path) as fp:
+				lines = fp.read().splitlines()
+
+			self.assertTrue(lines)
+			for line in lines:
+				stack, count = line.rsplit(" ", 1)
+				self.assertGreater(int(count), 0)
+			self.assertTrue(any("busy_wait" in line for line in lines))
+			self.assertTrue(os.path.exists(stats_path))
+			self.assertIn("test_profiling.py:busy_wait", profiler.summary("fake"))
+
+if "__main__" == __name__:
+	unittest.main()
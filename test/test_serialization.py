@@ -0,0 +1,83 @@
+import unittest
+import datetime
+import json
+import os
+
+import cdls.serialization
+
+class Record:
+	def __init__(self, n):
+		self.id = n
+		self.title = "record {}".format(n)
+
+class Unserializable:
+	__slots__ = ("id",)
+
+class KillsWorker:
+	"""Takes down whichever worker process unpickles it. """
+	def __reduce__(self):
+		return (os._exit, (1,))
+
+class TestEncodeBatch(unittest.TestCase):
+	def setUp(self):
+		self.now = datetime.datetime(2015, 1, 1, 12, 0, 0)
+
+	def tearDown(self):
+		cdls.serialization.shutdown()
+
+	def test_preserves_order_across_workers(self):
+		records = [(Record(n), self.now) for n in range(1000)]
+		results = cdls.serialization.encode_batch(records, "fake", workers=2)
+
+		self.assertEqual(len(results), 1000)
+		for n, (params, error) in enumerate(results):
+			self.assertIsNone(error)
+			self.assertEqual(params[1], "FAKE")
+			self.assertEqual(json.loads(params[3])["$contents"]["id"], n)
+
+	def test_reports_per_record_errors(self):
+		records = [(Record(0), self.now), (Unserializable(), self.now), (Record(2), self.now)]
+		results = cdls.serialization.encode_batch(records, "fake", workers=0)
+
+		self.assertIsNotNone(results[0][0])
+		self.assertIsNone(results[1][0])
+		self.assertEqual(results[1][1][0], "AttributeError")
+		self.assertIn("JSON-serialization failed", results[1][1][1])
+		self.assertIsNotNone(results[2][0])
+
+	def test_falls_back_when_records_cannot_be_pickled(self):
+		class LocalRecord:
+			pass
+
+		records = []
+		for n in range(600):
+			data = LocalRecord()
+			data.id = n
+			records.append((data, self.now))
+
+		results = cdls.serialization.encode_batch(records, "fake", workers=2)
+		self.assertEqual([json.loads(p[3])["$contents"]["id"] for p, e in results], list(range(600)))
+
+	def test_recovers_from_a_dead_worker(self):
+		records = [(Record(n), self.now) for n in range(600)]
+		records[300] = (KillsWorker(), self.now)
+
+		results = cdls.serialization.encode_batch(records, "fake", workers=2)
+		self.assertEqual(len(results), 600)
+		self.assertTrue(all(error is None for params, error in results))
+		self.assertNotIn(2, cdls.serialization._executors)
+
+		# The next batch gets a working pool
+		results = cdls.serialization.encode_batch(records[:300], "fake", workers=2)
+		self.assertEqual([json.loads(p[3])["$contents"]["id"] for p, e in results], list(range(300)))
+		self.assertIn(2, cdls.serialization._executors)
+
+	def test_pool_per_number_of_workers(self):
+		records = [(Record(n), self.now) for n in range(300)]
+		cdls.serialization.encode_batch(records, "fake", workers=1)
+		cdls.serialization.encode_batch(records, "fake", workers=2)
+		self.assertEqual(sorted(cdls.serialization._executors), [1, 2])
+		self.assertEqual(cdls.serialization._executors[2]._max_workers, 2)
+
+if "__main__" == __name__:
+	unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import json
+import os
+import tempfile
+
+import cdls.config
+import cdls.tracing
+
+class TestTracing(unittest.TestCase):
+	def setUp(self):
+		cdls.tracing.clear()
+
+	def tearDown(self):
+		cdls.config.TRACING_ENABLED = True
+		cdls.tracing.clear()
+
+	def export(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, "trace.json")
+			cdls.tracing.export(path)
+			with open(path) as fp:
+				return [e for e in json.load(fp)["traceEvents"] if e["ph"] == "X"]
+
+	def test_nested_spans(self):
+		with cdls.tracing.span("outer", source="fake"):
+			with cdls.tracing.span("inner"):
+				pass
+
+		inner, outer = self.export()
+		self.assertEqual((inner["name"], outer["name"]), ("inner", "outer"))
+		self.assertEqual(outer["args"], {"source": "fake"})
+		self.assertGreaterEqual(inner["ts"], outer["ts"])
+		self.assertLessEqual(inner["ts"] + inner["dur"], outer["ts"] + outer["dur"])
+
+	def test_errors_are_annotated(self):
+		with self.assertRaises(KeyError):
+			with cdls.tracing.span("failing"):
+				raise KeyError()
+		self.assertEqual(self.export()[0]["args"], {"error": "KeyError"})
+
+	def test_disabled(self):
+		cdls.config.TRACING_ENABLED = False
+		with cdls.tracing.span("ignored"):
+			pass
+		self.assertEqual(self.export(), [])
+
+if "__main__" == __name__:
+	unittest.main()
@@ -0,0 +1,222 @@
+import unittest
+import datetime
+import errno
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest.mock
+
+import cdls.backends.memory
+import cdls.datasources
+import cdls.errors
+import cdls.watching
+
+class FakeLogger:
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: None
+
+class WatcherContract:
+	use_inotify = None
+
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def write(self, name, text):
+		with open(os.path.join(self.tmp.name, name), "w") as fp:
+			fp.write(text)
+		return os.path.join(self.tmp.name, name)
+
+	def test_existing_files(self):
+		path = self.write("old.jsonl", "{}\n")
+		with cdls.watching.Watcher(self.tmp.name, 0.1, 0.05, self.use_inotify) as watcher:
+			self.assertEqual(watcher.wait(2), [path])
+			self.assertEqual(watcher.wait(0.2), [])
+
+	def test_waits_for_writes_to_settle(self):
+		with cdls.watching.Watcher(self.tmp.name, 0.3, 0.05, self.use_inotify) as watcher:
+			def writer():
+				with open(os.path.join(self.tmp.name, "slow.jsonl"), "w") as fp:
+					for n in range(5):
+						fp.write("{}\n")
+						fp.flush()
+						time.sleep(0.1)
+				self.write(".hidden", "x")
+				self.write("upload.part", "x")
+
+			thread = threading.Thread(target=writer)
+			thread.start()
+			settled = watcher.wait(5)
+			thread.join()
+
+			self.assertEqual([os.path.basename(path) for path in settled], ["slow.jsonl"])
+			self.assertEqual(os.path.getsize(settled[0]), 15)
+			self.assertEqual(watcher.wait(0.5), [])
+
+	def test_forgotten_files_come_back_when_changed(self):
+		path = self.write("bad.json", "{")
+		with cdls.watching.Watcher(self.tmp.name, 0.1, 0.05, self.use_inotify) as watcher:
+			self.assertEqual(watcher.wait(2), [path])
+			watcher.forget(path)
+			self.assertEqual(watcher.wait(0.3), [])
+
+			self.write("bad.json", "{}")
+			self.assertEqual(watcher.wait(2), [path])
+
+@unittest.skipUnless(cdls.watching._libc, "inotify isn't available")
+class TestInotifyWatcher(WatcherContract, unittest.TestCase):
+	use_inotify = True
+
+	def test_mode(self):
+		with cdls.watching.Watcher(self.tmp.name, 0.1, 0.05, self.use_inotify) as watcher:
+			self.assertEqual(watcher.mode, "inotify")
+
+class TestPollingWatcher(WatcherContract, unittest.TestCase):
+	use_inotify = False
+
+class TestLocalFileDataSource(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.queue = os.path.join(self.tmp.name, "queue")
+		self.archive = os.path.join(self.tmp.name, "archive")
+		os.makedirs(self.queue)
+
+		self.db = cdls.backends.memory.MemoryBackend()
+		self.datasource = cdls.datasources.LocalFileDataSource({
+			"id": "local",
+			"description": "test",
+			"queue_path": self.queue,
+			"archive_path": self.archive,
+			"watch_settle_seconds": 0.1,
+			"watch_poll_interval": 0.05,
+			"watch_concurrency": 2
+		})
+		self.datasource.register_database(self.db)
+		self.datasource.register_logger(FakeLogger())
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def queue_file(self, name, text):
+		with open(os.path.join(self.queue, name + ".tmp"), "w") as fp:
+			fp.write(text)
+		os.replace(os.path.join(self.queue, name + ".tmp"), os.path.join(self.queue, name))
+
+	def test_execute(self):
+		self.queue_file("a.jsonl", '{"n": 1, "created_on": "2015-01-02T03:04:05"}\n{"n": 2}\n')
+		self.queue_file("b.json", '[{"n": 3}, 4]')
+		self.queue_file("broken.json", '{"n":')
+		self.queue_file("ignored.txt", "hello")
+
+		report = self.datasource.execute()
+		self.assertFalse(report.successful)
+		self.assertEqual(report.number_processed, 4)
+
+		contents = [json.loads(change.json)["$contents"] for change in self.db.query("local")]
+		self.assertEqual([content.get("n", content.get("value")) for content in contents], [1, 2, 3, 4])
+		self.assertEqual(self.db.query("local")[0].record_date, "2015-01-02 03:04:05.000000")
+		self.assertEqual(sorted(os.listdir(self.archive)), ["a.jsonl", "b.json"])
+		self.assertEqual(sorted(os.listdir(self.queue)), ["broken.json", "ignored.txt"])
+
+	def test_file_over_memory_budget(self):
+		batches = []
+		warehouse_many = self.db.warehouse_many
+		self.db.warehouse_many = lambda records, *args, **kwargs: batches.append(len(records)) or warehouse_many(records, *args, **kwargs)
+		self.datasource._budget.limit = 4000
+
+		self.queue_file("big.jsonl", "".join('{{"n": {}}}\n'.format(n) for n in range(500)))
+		self.assertGreater(os.path.getsize(os.path.join(self.queue, "big.jsonl")), 4000)
+
+		report = self.datasource.execute()
+		self.assertTrue(report.successful)
+		self.assertEqual(sum(batches), 500)
+		self.assertLess(len(batches), 50)
+		self.assertEqual(self.datasource._budget.in_use, 0)
+
+	def test_watch(self):
+		stop = threading.Event()
+		result = {}
+		thread = threading.Thread(target=lambda: result.update(report=self.datasource.watch(stop)))
+		thread.start()
+		try:
+			for n in range(5):
+				self.queue_file("{}.jsonl".format(n), '{{"n": {}}}\n'.format(n))
+
+			deadline = time.monotonic() + 5
+			while len(self.db.records) < 5 and time.monotonic() < deadline:
+				time.sleep(0.05)
+		finally:
+			stop.set()
+			thread.join()
+
+		self.assertEqual(len(self.db.records), 5)
+		self.assertTrue(result["report"].successful)
+		self.assertEqual(result["report"].number_processed, 5)
+		self.assertEqual(os.listdir(self.queue), [])
+		self.assertEqual(len(os.listdir(self.archive)), 5)
+
+	def test_watch_reports_failures(self):
+		ingest_file = self.datasource._ingest_file
+		def flaky_ingest(path, held=0):
+			if "crash" in path:
+				self.datasource._budget.release(held)
+				raise RuntimeError("unexpected")
+			return ingest_file(path, held)
+		self.datasource._ingest_file = flaky_ingest
+
+		stop = threading.Event()
+		result = {}
+		thread = threading.Thread(target=lambda: result.update(report=self.datasource.watch(stop)))
+		thread.start()
+		try:
+			self.queue_file("broken.json", '{"n":')
+			self.queue_file("crash.jsonl", '{"n": 1}\n')
+			self.queue_file("fine.jsonl", '{"n": 2}\n')
+
+			deadline = time.monotonic() + 5
+			while (len(self.db.records) < 1 or self.datasource._budget.in_use) and time.monotonic() < deadline:
+				time.sleep(0.05)
+			time.sleep(0.2)
+		finally:
+			stop.set()
+			thread.join()
+
+		self.assertFalse(result["report"].successful)
+		self.assertEqual(len(self.db.records), 1)
+		self.assertEqual(sorted(os.listdir(self.queue)), ["broken.json", "crash.jsonl"])
+
+	def test_failed_file_leaves_nothing_pending(self):
+		save = self.datasource._save
+		def flaky_save(record):
+			if getattr(record, "fail", False):
+				raise cdls.errors.DatabaseError("unexpected")
+			save(record)
+		self.datasource._save = flaky_save
+
+		self.queue_file("a.jsonl", '{"n": 1}\n{"fail": true}\n')
+		self.queue_file("b.jsonl", '{"n": 2}\n')
+		with self.assertRaises(cdls.errors.DatabaseError):
+			self.datasource._ingest_file(os.path.join(self.queue, "a.jsonl"))
+		self.assertTrue(self.datasource._ingest_file(os.path.join(self.queue, "b.jsonl")))
+
+		contents = [json.loads(change.json)["$contents"] for change in self.db.query("local")]
+		self.assertEqual([content["n"] for content in contents], [2])
+		self.assertEqual(self.datasource._budget.in_use, 0)
+		self.assertEqual(os.listdir(self.queue), ["a.jsonl"])
+
+	def test_archives_across_filesystems(self):
+		self.queue_file("a.jsonl", '{"n": 1}\n')
+		exdev = OSError(errno.EXDEV, "Invalid cross-device link")
+		with unittest.mock.patch("os.rename", side_effect=exdev), unittest.mock.patch("os.replace", side_effect=exdev):
+			report = self.datasource.execute()
+
+		self.assertTrue(report.successful)
+		self.assertEqual(os.listdir(self.queue), [])
+		self.assertEqual(os.listdir(self.archive), ["a.jsonl"])
+
+if "__main__" == __name__:
+	unittest.main()